@@ -13,9 +13,33 @@ bot_list_data = None
 # number of commands that can be processed at once. set to None to automatically use OS cpu core count.
 # set to -1 to remove limit.
 workers = None
+# path to an SQLite database to use as a job store. when set, commands are put in it for worker processes to run
+# instead of running in the bot. run workers with `poetry run python src/worker.py` on this machine or any other with
+# the same config and access to the database, i.e. over a shared volume with working file locks. when using this, set `workers` to how many
+# commands all of your workers can run at once.
+job_store = None
+# number of commands each worker runs at once. set to None to use OS cpu core count.
+worker_jobs = None
+# number of threads for running pyvips and other blocking code. set to None to use OS cpu core count.
+parallel_workers = None
+# maximum number of commands that can wait in the queue once all workers are busy. set to None for no limit.
+max_queue_length = None
+# don't start new commands while free memory or free space in the temp dir are below these many bytes.
+# a command will always run if nothing else is running.
+min_free_memory = 500_000_000
+min_free_temp_space = 500_000_000
 # manually specify tempdir rather than using OS's default
 # temp dir defaults to /dev/shm (in-memory) if available and this var is None
 override_temp_dir = None
+# don't start new commands while the temp files of running commands add up to more than this many bytes. set to None for
+# no limit. a command will always run if nothing else is running. the download cache counts too, and is shrunk to make
+# room first.
+temp_budget = None
+# when the temp dir is in memory (/dev/shm) and there's less than this many bytes of free memory, new temp files go in
+# the OS's disk-backed temp dir instead
+temp_spill_below = 1_000_000_000
+# temp files that no running command owns are removed after this many seconds, i.e. ones left behind by crashes
+temp_orphan_age = 3600
 # NOTICE is recommended, INFO prints more information about what bot is doing, WARNING only prints errors.
 log_level = "NOTICE"
 # amount of seconds cooldown per user commands have. set to 0 to disable cooldown
@@ -57,6 +81,9 @@ tips = {
 # configured upload limit, in bytes, for files.
 # dont change this unless you have a really good reason to. i dont have error handling for overly large files
 file_upload_limit = 8_388_119
+# when shrinking a video to fit the upload limit, encode this many tries at once at slightly different bitrates.
+# higher values fit in fewer rounds but use that many times the CPU while doing it.
+size_fit_candidates = 1
 # this applies to every command. if any string arguments contain any of these words, the command will instantly
 # fail. this is intended to block hateful language like slurs. not case sensitive.
 # its in the config so i dont have to upload slurs to github...
@@ -78,3 +105,45 @@ max_frames = 1024
 max_temp_file_size = "1G"
 # cap FPS for sanity
 max_fps = 100
+# directory to keep a persistent cache of command results in, so identical commands on identical media are only
+# processed once. set to None to disable the result cache.
+result_cache_dir = None
+# maximum size, in bytes, of the result cache. the least recently used results are removed when it's over this size.
+result_cache_size = 1_000_000_000
+# maximum size, in bytes, of the cache of downloaded media kept in the temp dir. popular attachments are only downloaded
+# once while they're in it. set to 0 to disable the download cache.
+download_cache_size = 250_000_000
+# how long, in seconds, a cached download of a url is reused for
+download_cache_ttl = 600
+# connect some consecutive FFmpeg/vips stages with pipes instead of writing intermediate files to the temp dir. uses
+# less temp space and lets stages run at the same time.
+streaming = False
+# filters that treat every frame on their own (i.e. invert, hue, round corners) split videos at least twice this many
+# seconds long into segments and filter them on idle cores at the same time. set to None to never split videos.
+min_segment_duration = 5
+# resource limits for commands MediaForge runs. keys are the name of the program (i.e. "ffmpeg", "ffprobe", "mimic"),
+# a more specific class of command (i.e. "ffmpeg-geq" for the slow per-pixel filters), or "default" for everything.
+# more specific classes override less specific ones. available limits:
+#   "timeout": wall-clock seconds before the command is killed
+#   "cpu": seconds of CPU time before the command is killed (not on windows)
+#   "memory": bytes of address space the command can use (not on windows). FFmpeg reserves a lot of address space it
+#       never uses, so keep this generous.
+#   "cgroup": path of an existing cgroup v2 directory to run the command in, i.e. to limit real memory use with its
+#       memory.max (not on windows)
+# there's no default timeout, two-pass encodes of big inputs can take a long time
+subprocess_limits = {
+    "ffprobe": {"timeout": 60},
+    "ffmpeg-geq": {"timeout": 300},
+}
+# split the physical cores between the commands running at once, and tell each FFmpeg how many threads to use, instead
+# of every FFmpeg starting a thread per core. a command running alone still gets every core.
+cpu_budget = True
+# also pin each command to its share of the cpus (not on windows or macos)
+cpu_affinity = False
+# io scheduling class of commands: "idle", "best-effort" or None to leave it alone (only on linux)
+subprocess_io_class = None
+# serve prometheus metrics (queue, command stages, subprocesses, caches, temp dir, event loop lag, shard latency) at
+# http://metrics_host:metrics_port/metrics. set to None to disable. anyone who can reach it can see them, so only
+# listen on other interfaces behind a firewall.
+metrics_port = None
+metrics_host = "127.0.0.1"
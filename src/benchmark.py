@@ -0,0 +1,411 @@
+"""
+Benchmarks the processing functions over a synthetic media corpus, generated with FFmpeg's lavfi sources so every
+machine benchmarks the same media.
+
+examples:
+    poetry run python src/benchmark.py run -o results.json
+    poetry run python src/benchmark.py run -k caption --sizes 240 -o new.json --baseline results.json
+    poetry run python src/benchmark.py compare results.json new.json
+
+each run happens in its own process, which records:
+    wall: seconds the processing function took
+    cpu_self, cpu_children: user + system CPU seconds of the process itself (pyvips/PIL) and of its FFmpeg etc.
+        children
+    rss_self, rss_children: peak resident memory of the process (including the python interpreter) and of its
+        largest child, in bytes
+    temp: peak bytes in the temp dir, which is in /dev/shm by default
+
+processing.other.ytdownload isn't benchmarked since it needs the network.
+"""
+import argparse
+import asyncio
+import dataclasses
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, os.getcwd())
+
+import discord
+
+import core.pipeline
+import utils.tempfiles
+
+if sys.platform != "win32":
+    import resource
+
+src = os.path.dirname(os.path.abspath(__file__))
+# (width, height) for each size of visual media
+sizes = {240: (426, 240), 720: (1280, 720), 1080: (1920, 1080)}
+MEDIA = ("image", "gif", "video")
+ANIMATED = ("gif", "video")
+
+
+@dataclasses.dataclass
+class Case:
+    name: str
+    func: typing.Callable
+    # for each media input, the kinds of corpus media it can be. runs are made for every kind of the first input.
+    inputs: list[tuple[str, ...]]
+    args: tuple = ()
+    kwargs: dict = dataclasses.field(default_factory=dict)
+
+
+def cases() -> list[Case]:
+    # imported here so the driver can start without loading everything
+    import processing.common
+    import processing.ffmpeg.caption
+    import processing.ffmpeg.conversion
+    import processing.ffmpeg.creation
+    import processing.ffmpeg.ensuresize
+    import processing.ffmpeg.ffutils
+    import processing.ffmpeg.other
+    import processing.other
+    import processing.sus
+    import processing.vips.caption
+    import processing.vips.creation
+    import processing.vips.other
+    import processing.vips.vipsutils
+    ffcaption = processing.ffmpeg.caption
+    conversion = processing.ffmpeg.conversion
+    ffutils = processing.ffmpeg.ffutils
+    ffother = processing.ffmpeg.other
+    vipscaption = processing.vips.caption
+    vipsutils = processing.vips.vipsutils
+    return [
+        # ffmpeg/caption.py
+        Case("motivate", ffcaption.motivate, [MEDIA], (["top text", "bottom text"],)),
+        Case("freezemotivate", ffcaption.freezemotivate, [ANIMATED], ("top text", "bottom text")),
+        Case("freezemotivateaudio", ffcaption.freezemotivateaudio, [ANIMATED, ("audio",)], ("top text", "bottom text")),
+        Case("twitter_caption", ffcaption.twitter_caption, [MEDIA], (["caption"], True)),
+        # ffmpeg/conversion.py
+        Case("videotogif", conversion.videotogif, [("video",)]),
+        Case("video_reencode", conversion.video_reencode, [ANIMATED]),
+        Case("audio_reencode", conversion.audio_reencode, [("audio",)]),
+        Case("allreencode", conversion.allreencode, [MEDIA + ("audio",)], kwargs={"fail_if_gif": False}),
+        Case("forcereencode", conversion.forcereencode, [MEDIA + ("audio",)]),
+        Case("giftomp4", conversion.giftomp4, [("gif",)]),
+        Case("toaudio", conversion.toaudio, [("video",)]),
+        Case("mediatopng", conversion.mediatopng, [MEDIA]),
+        Case("toapng", conversion.toapng, [ANIMATED]),
+        # ffmpeg/creation.py
+        Case("epicbirthday", processing.ffmpeg.creation.epicbirthday, [], ("happy birthday",)),
+        Case("trollface", processing.ffmpeg.creation.trollface, [MEDIA]),
+        Case("give_me_your_phone_now", processing.ffmpeg.creation.give_me_your_phone_now, [MEDIA]),
+        # ffmpeg/ensuresize.py
+        Case("twopasscapvideo", processing.ffmpeg.ensuresize.twopasscapvideo, [("video", "longvideo")], (1_000_000,)),
+        Case("intelligentdownsize", processing.ffmpeg.ensuresize.intelligentdownsize, [MEDIA], (200_000,)),
+        Case("assurefilesize", processing.ffmpeg.ensuresize.assurefilesize, [MEDIA + ("longvideo",)]),
+        Case("normalize", core.pipeline.normalize, [MEDIA + ("longvideo",)]),
+        # ffmpeg/ffutils.py
+        Case("forceaudio", ffutils.forceaudio, [ANIMATED]),
+        Case("naive_vstack", ffutils.naive_vstack, [MEDIA, ("image",)]),
+        Case("crop", ffutils.crop, [MEDIA], (100, 100, 10, 10)),
+        Case("trim_top", ffutils.trim_top, [MEDIA], (20,)),
+        Case("naive_overlay", ffutils.naive_overlay, [MEDIA, ("image",)]),
+        Case("repeat_shorter_video", ffutils.repeat_shorter_video, [("video",), ("gif",)]),
+        Case("scale2ref", ffutils.scale2ref, [("image",), ("video",)]),
+        Case("changefps", ffutils.changefps, [ANIMATED], (10,)),
+        Case("trim", ffutils.trim, [ANIMATED + ("audio",)], (1,)),
+        Case("resize", ffutils.resize, [MEDIA], ("iw*2", "ih")),
+        # ffmpeg/other.py
+        Case("speed", ffother.speed, [ANIMATED + ("audio",)], (2,)),
+        Case("reverse", ffother.reverse, [ANIMATED]),
+        Case("random", ffother.random, [ANIMATED], (5,), {"seed": 1}),
+        Case("quality", ffother.quality, [ANIMATED], (51, 20)),
+        # long enough to be split into segments, and rotated, which isn't
+        Case("invert", ffother.invert, [MEDIA + ("longvideo", "rotatedvideo")]),
+        Case("pad", ffother.pad, [MEDIA]),
+        Case("gifloop", ffother.gifloop, [("gif",)], (2,)),
+        Case("videoloop", ffother.videoloop, [("video",)], (2,)),
+        Case("imageaudio", ffother.imageaudio, [("image",), ("audio",)]),
+        Case("addaudio", ffother.addaudio, [MEDIA, ("audio",)], (0,)),
+        Case("concatv", ffother.concatv, [ANIMATED, ("video",)]),
+        Case("stack", ffother.stack, [MEDIA, ("image",)], ("vstack",)),
+        Case("overlay", ffother.overlay, [MEDIA, ("image",)], (0.5, "overlay")),
+        Case("rotate", ffother.rotate, [MEDIA], ("90",)),
+        Case("volume", ffother.volume, [("video", "audio")], (2,)),
+        Case("vibrato", ffother.vibrato, [("video", "audio")], (5, 0.5)),
+        Case("pitch", ffother.pitch, [("video", "audio")], (12,)),
+        Case("hue", ffother.hue, [MEDIA], (90,)),
+        Case("tint", ffother.tint, [MEDIA], (discord.Color(0xFF8000),)),
+        Case("round_corners", ffother.round_corners, [MEDIA + ("longvideo", "rotatedvideo")], (50,)),
+        Case("deepfry", ffother.deepfry, [MEDIA], (0.5, 1.5, 1.5, 1.5, 20)),
+        Case("speech_bubble", ffother.speech_bubble, [MEDIA], ("top", "transparent")),
+        # vips/caption.py, through the same wrappers the commands use
+        Case("esmcaption", vipsutils.generic_caption_stack, [MEDIA], (vipscaption.esmcaption, ["caption"])),
+        Case("mediaforge_caption", vipsutils.generic_caption_stack, [MEDIA],
+             (vipscaption.mediaforge_caption, ["caption"])),
+        Case("generic_image_caption", vipsutils.generic_caption_stack, [MEDIA],
+             (vipscaption.generic_image_caption, ["caption"], "rendering/images/eminem.png"), {"reverse": True}),
+        Case("meme", vipsutils.generic_caption_overlay, [MEDIA], (vipscaption.meme, ["top text", "bottom text"])),
+        Case("tenor", vipsutils.generic_caption_overlay, [MEDIA], (vipscaption.tenor, ["top text", "bottom text"])),
+        Case("whisper", vipsutils.generic_caption_overlay, [MEDIA], (vipscaption.whisper, ["caption"])),
+        Case("snapchat", vipsutils.generic_caption_overlay, [MEDIA], (vipscaption.snapchat, ["caption"])),
+        # vips/creation.py
+        Case("yskysn", processing.vips.creation.yskysn, [], (["caption", "NOW!"],)),
+        Case("f1984", processing.vips.creation.f1984, [], (["caption", "JANUARY 1984"],)),
+        # vips/other.py
+        Case("uncaption", processing.vips.other.uncaption, [MEDIA], (0, 10)),
+        Case("jpeg", processing.vips.other.jpeg, [("image",)], (30, 20, 10), {"seed": 1}),
+        # vips/vipsutils.py
+        Case("vips_stack", vipsutils.stack, [("image",), ("image",)], ("vstack",)),
+        Case("fitpng", vipsutils.fitpng, [("image",)], (50_000,)),
+        # sus.py
+        Case("sus", processing.sus.sus, [], ("amogus",), {"seed": 1}),
+        # other.py
+        Case("magickone", processing.other.magickone, [("image",)], (50,)),
+        # common.py
+        Case("tts", processing.common.tts, [], ("the quick brown fox jumps over the lazy dog",)),
+    ]
+
+
+def corpusfile(corpus: str, kind: str, size: typing.Optional[int]) -> str:
+    ext = {"image": "png", "gif": "gif", "video": "mp4", "longvideo": "mp4", "rotatedvideo": "mp4",
+           "audio": "mp3"}[kind]
+    return os.path.join(corpus, f"{kind}_{size}.{ext}" if size else f"{kind}.{ext}")
+
+
+def kindsizes(kind: str, wanted: list[int]) -> list[typing.Optional[int]]:
+    if kind == "audio":
+        return [None]
+    if kind in ["longvideo", "rotatedvideo"]:
+        # long videos are slow enough at one size
+        return [720] if 720 in wanted else []
+    return wanted
+
+
+def othersize(kind: str, size: typing.Optional[int]) -> typing.Optional[int]:
+    # extra inputs match the size of the first one, or are medium sized if it has none
+    return None if kind == "audio" else size or 720
+
+
+def makecorpus(corpus: str):
+    """
+    generates any missing corpus media with lavfi sources, which are the same on every machine
+    """
+    os.makedirs(corpus, exist_ok=True)
+    ffmpeg = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-y"]
+    commands = {corpusfile(corpus, "audio", None): ["-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000:d=5",
+                                                    "-c:a", "libmp3lame"]}
+    for size, (w, h) in sizes.items():
+        video = ["-f", "lavfi", "-i", f"testsrc2=size={w}x{h}:rate=30"]
+        audio = ["-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000"]
+        x264 = ["-c:v", "libx264", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest"]
+        commands[corpusfile(corpus, "image", size)] = [*video, "-frames:v", "1"]
+        commands[corpusfile(corpus, "gif", size)] = ["-f", "lavfi", "-i", f"testsrc2=size={w}x{h}:rate=15", "-t", "2"]
+        commands[corpusfile(corpus, "video", size)] = [*video, *audio, "-t", "3", *x264]
+        if size == 720:
+            commands[corpusfile(corpus, "longvideo", size)] = [*video, *audio, "-t", "20", *x264]
+            # the same with rotation metadata, like videos from phones, made after it since dicts keep their order
+            commands[corpusfile(corpus, "rotatedvideo", size)] = ["-display_rotation", "90", "-i",
+                                                                  corpusfile(corpus, "longvideo", size), "-c", "copy"]
+    for out, args in commands.items():
+        if not os.path.isfile(out):
+            print(f"generating {out}", file=sys.stderr)
+            subprocess.run([*ffmpeg, *args, out], check=True)
+
+
+def cpuseconds(usage) -> float:
+    return usage.ru_utime + usage.ru_stime
+
+
+async def runone(case: Case, files: list[str]):
+    async with utils.tempfiles.TempFileSession():
+        start = time.perf_counter()
+        await core.pipeline.execute(case.func, files, case.args, case.kwargs, run_parallel=True, expectimage=False)
+        return time.perf_counter() - start
+
+
+def one(args: argparse.Namespace):
+    """
+    runs a single benchmark in this process and prints its measurements as json
+    """
+    case = next(case for case in cases() if case.name == args.case)
+    utils.tempfiles.temp_dir = args.tempdir
+    utils.tempfiles.init()
+    result = {"ok": True, "error": None}
+    try:
+        result["wall"] = asyncio.run(runone(case, args.files))
+    except Exception as e:
+        result.update(ok=False, error=f"{type(e).__name__}: {e}")
+    if sys.platform != "win32":
+        me = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in kilobytes on linux and bytes on macos
+        scale = 1 if sys.platform == "darwin" else 1024
+        result.update(cpu_self=cpuseconds(me), cpu_children=cpuseconds(children), rss_self=me.ru_maxrss * scale,
+                      rss_children=children.ru_maxrss * scale)
+    print(json.dumps(result))
+
+
+def dirsize(directory: str) -> int:
+    total = 0
+    for root, _, files in os.walk(directory):
+        for file in files:
+            try:
+                total += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return total
+
+
+def measure(case: Case, files: list[str]) -> dict:
+    """
+    runs one benchmark in a new process, watching its temp dir
+    """
+    tempdir = f"{utils.tempfiles.temp_dir}-benchmark{os.getpid()}"
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "one", case.name, tempdir, *files],
+                               stdout=subprocess.PIPE)
+    peak = 0
+    while process.poll() is None:
+        peak = max(peak, dirsize(tempdir))
+        time.sleep(0.02)
+    stdout, _ = process.communicate()
+    shutil.rmtree(tempdir, ignore_errors=True)
+    try:
+        result = json.loads(stdout.decode().strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        result = {"ok": False, "error": f"benchmark process exited with {process.returncode}"}
+    result["temp"] = peak
+    return result
+
+
+def summarize(runs: list[dict]) -> dict:
+    ok = [run for run in runs if run["ok"]]
+    if not ok:
+        return {"ok": False, "error": runs[0]["error"], "runs": runs}
+    summary = {"ok": True, "runs": runs}
+    for key in ["wall", "cpu_self", "cpu_children"]:
+        if key in ok[0]:
+            summary[key] = statistics.median(run[key] for run in ok)
+    for key in ["rss_self", "rss_children", "temp"]:
+        if key in ok[0]:
+            summary[key] = max(run[key] for run in ok)
+    return summary
+
+
+def ffmpegversion() -> str:
+    try:
+        return subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout.splitlines()[0]
+    except (OSError, IndexError):
+        return "unknown"
+
+
+def run(args: argparse.Namespace):
+    makecorpus(args.corpus)
+    wanted = args.sizes or list(sizes)
+    results = []
+    for case in cases():
+        if args.k and not any(k in case.name for k in args.k):
+            continue
+        runs = [(None, [])] if not case.inputs else \
+            [(f"{kind}@{size}" if size else kind, [corpusfile(args.corpus, kind, size)] +
+              [corpusfile(args.corpus, other[0], othersize(other[0], size)) for other in case.inputs[1:]])
+             for kind in case.inputs[0] for size in kindsizes(kind, wanted)]
+        for name, files in runs:
+            label = f"{case.name} {name or ''}".strip()
+            print(f"{label}...", end=" ", flush=True, file=sys.stderr)
+            summary = summarize([measure(case, files) for _ in range(args.repeat)])
+            results.append({"case": case.name, "input": name, **summary})
+            if summary["ok"]:
+                print(f"{summary['wall']:.2f}s", file=sys.stderr)
+            else:
+                print(f"failed: {summary['error']}", file=sys.stderr)
+    out = {
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "machine": {"platform": platform.platform(), "cpus": os.cpu_count(), "python": platform.python_version(),
+                    "ffmpeg": ffmpegversion()},
+        "repeat": args.repeat,
+        "results": results
+    }
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent=1)
+    print(f"wrote {args.output}", file=sys.stderr)
+    if args.baseline:
+        return comparefiles(args.baseline, args.output, args.threshold)
+    return 0
+
+
+def comparefiles(baselinefile: str, newfile: str, threshold: float) -> int:
+    """
+    prints how each benchmark changed from the baseline
+    :return: 1 if anything got slower or started failing, otherwise 0
+    """
+    with open(baselinefile) as f:
+        baseline = {(r["case"], r["input"]): r for r in json.load(f)["results"]}
+    with open(newfile) as f:
+        new = json.load(f)["results"]
+    regressed = False
+    print(f"{'benchmark':<40} {'wall':>16} {'cpu':>16} {'peak rss':>16} {'peak temp':>16}")
+    for result in new:
+        key = (result["case"], result["input"])
+        label = f"{result['case']} {result['input'] or ''}".strip()
+        if key not in baseline:
+            print(f"{label:<40} new")
+            continue
+        old = baseline[key]
+        if not result["ok"]:
+            regressed |= old["ok"]
+            print(f"{label:<40} failed: {result['error']}")
+            continue
+        if not old["ok"]:
+            print(f"{label:<40} fixed")
+            continue
+        columns = []
+        for key, getter in [("wall", lambda r: r["wall"]),
+                            ("cpu", lambda r: r.get("cpu_self", 0) + r.get("cpu_children", 0)),
+                            ("rss", lambda r: max(r.get("rss_self", 0), r.get("rss_children", 0))),
+                            ("temp", lambda r: r["temp"])]:
+            before, after = getter(old), getter(result)
+            change = (after - before) / before if before else 0
+            # tiny absolute changes are just noise
+            if key == "wall" and change > threshold and after - before > 0.05:
+                regressed = True
+                columns.append(f"{change:+.0%} !")
+            else:
+                columns.append(f"{change:+.0%}")
+        print(f"{label:<40} " + " ".join(f"{c:>16}" for c in columns))
+    return 1 if regressed else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the processing functions over a synthetic corpus.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    runparser = subparsers.add_parser("run", help="run the benchmarks")
+    runparser.add_argument("-o", "--output", default="benchmark.json", help="where to write the results")
+    runparser.add_argument("-k", action="append", help="only run benchmarks whose name contains this, can be repeated")
+    runparser.add_argument("--sizes", type=int, nargs="+", choices=list(sizes), help="only use media of these heights")
+    runparser.add_argument("--repeat", type=int, default=1, help="times to run each benchmark, the median is used")
+    runparser.add_argument("--corpus", default=os.path.join(tempfile.gettempdir(), "mediaforge-benchmark-corpus"),
+                           help="where to keep the generated media")
+    runparser.add_argument("--baseline", help="results to compare against")
+    runparser.add_argument("--threshold", type=float, default=0.1,
+                           help="fraction of wall time a benchmark can get slower by before it's a regression")
+    compareparser = subparsers.add_parser("compare", help="compare two results, exits with 1 if anything regressed")
+    compareparser.add_argument("baseline")
+    compareparser.add_argument("new")
+    compareparser.add_argument("--threshold", type=float, default=0.1)
+    oneparser = subparsers.add_parser("one", help=argparse.SUPPRESS)
+    oneparser.add_argument("case")
+    oneparser.add_argument("tempdir")
+    oneparser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+    if args.command == "run":
+        sys.exit(run(args))
+    elif args.command == "compare":
+        sys.exit(comparefiles(args.baseline, args.new, args.threshold))
+    else:
+        one(args)
+
+
+if __name__ == "__main__":
+    main()
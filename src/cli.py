@@ -0,0 +1,120 @@
+"""
+Runs MediaForge commands on local files, without Discord.
+
+examples:
+    poetry run python src/cli.py list
+    poetry run python src/cli.py run ffmpeg.other.reverse -i input.mp4 -o reversed.mp4
+    poetry run python src/cli.py run vips.vipsutils.generic_caption_stack -i input.mp4 @vips.caption.esmcaption '["x"]'
+"""
+import argparse
+import ast
+import asyncio
+import glob
+import importlib
+import inspect
+import os
+import shutil
+import sys
+
+sys.path.insert(0, os.getcwd())
+
+import core.jobstore
+import core.pipeline
+import processing.common
+import utils.tempfiles
+
+src = os.path.dirname(os.path.abspath(__file__))
+
+
+def findfunc(name: str):
+    """
+    :param name: dotted name of a processing function, with or without the leading "processing."
+    :return: the function
+    """
+    if not name.startswith("processing."):
+        name = "processing." + name
+    parts = name.split(".")
+    # the longest prefix that's a module, the rest is the function in it
+    for i in range(len(parts) - 1, 1, -1):
+        try:
+            importlib.import_module(".".join(parts[:i]))
+        except ImportError:
+            continue
+        return core.jobstore.resolve(f"{'.'.join(parts[:i])}:{'.'.join(parts[i:])}")
+    raise ValueError(f"{name} is not a processing function")
+
+
+def parsearg(arg: str):
+    # @name is a processing function, otherwise try it as a python literal and fall back to a string
+    if arg.startswith("@"):
+        return findfunc(arg[1:])
+    try:
+        return ast.literal_eval(arg)
+    except (ValueError, SyntaxError):
+        return arg
+
+
+def listfuncs():
+    for file in sorted(glob.glob(os.path.join(src, "processing", "**", "*.py"), recursive=True)):
+        module = os.path.splitext(os.path.relpath(file, src))[0].replace(os.sep, ".")
+        for name, func in inspect.getmembers(importlib.import_module(module), inspect.isfunction):
+            if func.__module__ == module and not name.startswith("_"):
+                print(f"{module.removeprefix('processing.')}.{name}{inspect.signature(func)}")
+
+
+async def run(args: argparse.Namespace):
+    func = findfunc(args.func)
+    funcargs = [parsearg(arg) for arg in args.args]
+    kwargs = {}
+    for kwarg in args.kwarg:
+        key, _, value = kwarg.partition("=")
+        kwargs[key] = parsearg(value)
+    async with utils.tempfiles.TempFileSession(), processing.common.accounting(args.func):
+        # work on copies so the originals are never touched
+        files = []
+        for file in args.input:
+            copy = utils.tempfiles.reserve_tempfile(os.path.splitext(file)[1][1:] or None)
+            shutil.copyfile(file, copy)
+            files.append(copy)
+        result = await core.pipeline.run(func, files, *funcargs, resize=not args.no_resize, exempt=args.no_limits,
+                                         run_parallel=True, **kwargs)
+        if isinstance(result, str) and os.path.isfile(result):
+            output = args.output or os.path.basename(result)
+            shutil.copyfile(result, output)
+            print(output)
+        else:
+            print(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs MediaForge commands on local files, without Discord.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="list the processing functions")
+    runparser = subparsers.add_parser("run", help="run a processing function on local files",
+                                      description="Normalizes the inputs, runs the function on them, and reencodes "
+                                                  "and shrinks the result like the bot would.")
+    runparser.add_argument("func", help="processing function, i.e. ffmpeg.other.reverse")
+    runparser.add_argument("args", nargs="*",
+                           help="other args to the function. python literals are parsed, @name is a processing "
+                                "function, anything else is a string.")
+    runparser.add_argument("-i", "--input", action="append", default=[], help="input media, can be repeated")
+    runparser.add_argument("-k", "--kwarg", action="append", default=[], help="keyword arg as key=value")
+    runparser.add_argument("-o", "--output", help="where to save the result")
+    runparser.add_argument("--no-resize", action="store_true", help="don't resize the inputs")
+    runparser.add_argument("--no-limits", action="store_true",
+                           help="skip the size and duration limits, like the bot owner")
+    args = parser.parse_args()
+    if args.command == "list":
+        listfuncs()
+        return
+    # don't share (or wipe) the temp dir of a bot on the same machine
+    utils.tempfiles.temp_dir = f"{utils.tempfiles.temp_dir}-cli{os.getpid()}"
+    utils.tempfiles.init()
+    try:
+        asyncio.run(run(args))
+    finally:
+        utils.tempfiles.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,7 @@
 import discord
 from discord.ext import commands
 
+import core.process
 from core.clogs import logger
 from utils.common import prefix_function
 
@@ -54,6 +55,18 @@ class BotEventsCog(commands.Cog):
                                 f"mention me! Run `{pfx}help` for bot help.", delete_after=10,
                                 mention_author=False)
 
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        # nobody's going to see the result
+        if core.process.cancel(payload.message_id):
+            logger.info(f"Message {payload.message_id} was deleted, cancelled its command.")
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        if str(payload.emoji) == core.process.cancel_emoji and core.process.cancel(payload.message_id,
+                                                                                     payload.user_id):
+            logger.info(f"{payload.user_id} cancelled command {payload.message_id} by reacting.")
+
     @commands.Cog.listener()
     async def on_command_completion(self, ctx):
         if ctx.interaction:
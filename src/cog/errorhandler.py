@@ -1,12 +1,10 @@
 import asyncio
 import datetime
 import difflib
-import glob
 import io
 import traceback
 import urllib.parse
 
-import aiofiles.os
 import discord
 from aiohttp import client_exceptions as aiohttp_client_exceptions
 from discord.ext import commands
@@ -134,15 +132,9 @@ class ErrorHandlerCog(commands.Cog):
                 commanderror = commanderror.original
             logger.error(commanderror, exc_info=(type(commanderror), commanderror, commanderror.__traceback__))
             if "OSError: [Errno 28] No space left on device" in str(commanderror):
-                logger.warn("No space left on device, forcibly clearing temp folder")
-                files = glob.glob(utils.tempfiles.temp_dir + "/*")
-                logger.warn(f"deleting {len(files)} files")
-                logger.debug(files)
-                fls = await asyncio.gather(*[aiofiles.os.remove(file) for file in files],
-                                           return_exceptions=True)
-                for f in fls:
-                    if isinstance(f, Exception):
-                        logger.debug(f)
+                # anything no open session has reserved, running commands still need their files
+                logger.warn("No space left on device, clearing orphaned temp files")
+                await asyncio.to_thread(utils.tempfiles.reclaim, 10)
             is_hosting_issue = isinstance(commanderror, (aiohttp_client_exceptions.ClientOSError,
                                                          aiohttp_client_exceptions.ServerDisconnectedError,
                                                          asyncio.exceptions.TimeoutError))
@@ -105,8 +105,9 @@ class Debug(commands.Cog, name="Owner Only", command_attrs=dict(hidden=True)):
         """
         Clear the /temp folder
         """
-        l = len(glob.glob(utils.tempfiles.temp_dir + "/*"))
-        for f in glob.glob(utils.tempfiles.temp_dir + "/*"):
+        files = [f for f in glob.glob(utils.tempfiles.temp_dir + "/*") if os.path.isfile(f)]
+        l = len(files)
+        for f in files:
             os.remove(f)
         await ctx.send(f"✅ Removed {l} files.")
 
@@ -201,5 +202,20 @@ class Debug(commands.Cog, name="Owner Only", command_attrs=dict(hidden=True)):
             await asyncio.sleep(10)
 
         msg = await ctx.reply("Command entering queue...")
-        await core.queue.enqueue(wait())
+        await core.queue.enqueue(wait(), ctx.author.id, ctx.guild.id if ctx.guild else None)
         await msg.edit(content="Command out of queue.")
+
+    @commands.command()
+    @commands.is_owner()
+    async def queuestate(self, ctx: commands.Context):
+        state = core.queue.scheduler.state()
+        out = f"{len(state['running'])}/{state['slots']} slots in use, {len(state['waiting'])} waiting " \
+              f"(max {state['max_queued']})\n"
+        for name in ["running", "waiting"]:
+            for job in state[name]:
+                out += f"{name}: user {job['user']} guild {job['guild']} cost {job['cost']} " \
+                       f"waited {round(job['waited'], 1)}s ran {round(job['running_for'], 1)}s\n"
+        with io.StringIO() as buf:
+            buf.write(out)
+            buf.seek(0)
+            await ctx.reply(file=discord.File(buf, filename="queue.txt"))
@@ -9,7 +9,9 @@ import regex as re
 from discord.ext import commands
 
 import config
+import core.process
 import core.queue
+import core.resultcache
 import processing.common
 
 import processing.ffmpeg.ffprobe
@@ -144,17 +146,45 @@ class Other(commands.Cog, name="Other"):
         :param ctx: discord context
         """
         embed = discord.Embed(color=discord.Color(0xD262BA), title="Statistics")
+        state = core.queue.scheduler.state()
+        embed.add_field(name="Running Commands", value=f"{len(state['running'])}")
         if core.queue.queue_enabled:
-            embed.add_field(name="Running Commands", value=f"{min(core.queue.queued, core.queue.workers)}")
-            embed.add_field(name="Max Running Commands", value=f"{core.queue.workers}")
-            embed.add_field(name="Queued Commands", value=f"{max(0, core.queue.queued - core.queue.workers)}")
-        else:
-            embed.add_field(name="Running Commands", value=f"{core.queue.queued}")
-            embed.add_field(name="Number of tasks this instance can run at once", value=f"{core.queue.workers}")
+            embed.add_field(name="Max Running Commands", value=f"{state['slots']}")
+            embed.add_field(name="Queued Commands", value=f"{len(state['waiting'])}")
+        pool = processing.common.poolstats()
+        embed.add_field(name="Worker Threads",
+                        value=f"{pool['running']}/{pool['size']} busy, {pool['queued']} waiting, "
+                              f"{round(pool['utilization'] * 100, 1)}% utilization")
+        if core.resultcache.cache is not None:
+            cache = core.resultcache.cache
+            embed.add_field(name="Result Cache Hit Rate",
+                            value=f"{round(cache.hit_rate() * 100, 1)}% ({cache.hits} hits, {cache.misses} misses)")
+        if processing.common.limit_violations:
+            embed.add_field(name="Commands Stopped By Resource Limits",
+                            value="\n".join(f"{cls} {limit}: {n}" for (cls, limit), n in
+                                             processing.common.limit_violations.most_common()))
         if isinstance(self.bot, discord.AutoShardedClient):
             embed.add_field(name="Total Bot Shards", value=f"{len(self.bot.shards)}")
         await ctx.reply(embed=embed)
 
+    @commands.hybrid_command(aliases=["stop", "abort"])
+    async def cancel(self, ctx):
+        """
+        Cancels your running or queued commands.
+
+        Reply to a command or its status message to only cancel that one. You can also react to either with ❌.
+
+        :param ctx: discord context
+        """
+        if ctx.message.reference and ctx.message.reference.message_id:
+            cancelled = int(core.process.cancel(ctx.message.reference.message_id, ctx.author.id))
+        else:
+            cancelled = core.process.cancelall(ctx.author.id)
+        if cancelled:
+            await ctx.reply(f"{config.emojis['check']} Cancelled {cancelled} command(s).")
+        else:
+            await ctx.reply(f"{config.emojis['x']} You have no running commands to cancel.")
+
     @commands.hybrid_command(aliases=["shard", "shardstats", "shardinfo"])
     async def shards(self, ctx):
         """
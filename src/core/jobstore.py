@@ -0,0 +1,355 @@
+"""
+lets processing run on separate worker processes, possibly on other machines, through a shared SQLite database.
+the bot puts jobs in with submit(), and any number of workers (worker.py) take them out, run them, and put the
+results back.
+"""
+import asyncio
+import importlib
+import json
+import os
+import socket
+import time
+import traceback
+import typing
+
+import aiosqlite
+
+import config
+import core.pipeline
+import processing.common
+import utils.tempfiles
+from core.clogs import logger
+from utils.tempfiles import reserve_tempfile
+
+path = config.job_store if hasattr(config, "job_store") else None
+enabled = path is not None
+# seconds between checks for finished jobs and for new jobs
+poll_interval = 0.25
+# seconds between a worker telling the store it's still working on a job
+heartbeat_interval = 5
+# a running job whose worker hasn't checked in for this long is given to another worker
+stale_after = 60
+
+schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL DEFAULT 'queued',
+    func TEXT NOT NULL,
+    args TEXT NOT NULL,
+    kwargs TEXT NOT NULL,
+    created REAL NOT NULL,
+    worker TEXT,
+    heartbeat REAL,
+    result BLOB,
+    result_ext TEXT,
+    error TEXT,
+    nonbug INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+CREATE TABLE IF NOT EXISTS job_inputs (
+    job INTEGER NOT NULL,
+    idx INTEGER NOT NULL,
+    ext TEXT NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (job, idx)
+);
+"""
+
+db: typing.Optional[aiosqlite.Connection] = None
+# one connection is shared by every job, so transactions can't be allowed to interleave
+lock = asyncio.Lock()
+
+
+class JobFailed(Exception):
+    """raised by submit() when a worker failed to run the job"""
+    pass
+
+
+async def connect() -> aiosqlite.Connection:
+    global db
+    async with lock:
+        if db is None:
+            logger.debug(f"connecting to job store {path}")
+            # autocommit, transactions are started explicitly
+            conn = await aiosqlite.connect(path, isolation_level=None)
+            # not WAL, which only works when everything is on the same machine
+            await conn.execute("PRAGMA busy_timeout=30000")
+            await conn.executescript(schema)
+            db = conn
+    return db
+
+
+async def execute(conn: aiosqlite.Connection, sql: str, parameters: tuple) -> int:
+    """
+    runs a single write outside of anyone else's transaction
+    :return: number of rows changed
+    """
+    async with lock:
+        cursor = await conn.execute(sql, parameters)
+        return cursor.rowcount
+
+
+async def fetchone(conn: aiosqlite.Connection, sql: str, parameters: tuple) -> typing.Optional[tuple]:
+    """
+    runs a single read outside of anyone else's transaction
+    :return: the first row
+    """
+    async with lock:
+        async with conn.execute(sql, parameters) as cursor:
+            return await cursor.fetchone()
+
+
+async def fetchall(conn: aiosqlite.Connection, sql: str, parameters: tuple) -> list[tuple]:
+    """
+    runs a single read outside of anyone else's transaction
+    :return: every row
+    """
+    async with lock:
+        async with conn.execute(sql, parameters) as cursor:
+            return list(await cursor.fetchall())
+
+
+def funcname(func: typing.Callable) -> typing.Optional[str]:
+    """
+    :return: the name a worker can find func by, or None if it isn't a processing function
+    """
+    module = getattr(func, "__module__", None)
+    qualname = getattr(func, "__qualname__", None)
+    if not module or not qualname or not module.startswith("processing.") or "<" in qualname:
+        return None
+    name = f"{module}:{qualname}"
+    try:
+        if resolve(name) is not func:
+            return None
+    except (ImportError, AttributeError, ValueError):
+        return None
+    return name
+
+
+def resolve(name: str) -> typing.Callable:
+    """
+    the opposite of funcname(). only ever returns processing functions, since names come from the database.
+    """
+    module, qualname = name.split(":")
+    if not module.startswith("processing."):
+        raise ValueError(f"{name} is not a processing function")
+    obj = importlib.import_module(module)
+    for attr in qualname.split("."):
+        obj = getattr(obj, attr)
+    if not callable(obj):
+        raise ValueError(f"{name} is not callable")
+    return obj
+
+
+def encode(arg):
+    """
+    turns command args into something json can store. raises TypeError for args that can't be sent to a worker.
+    """
+    if isinstance(arg, (str, int, float, bool)) or arg is None:
+        return arg
+    if isinstance(arg, (list, tuple)):
+        return [encode(a) for a in arg]
+    if isinstance(arg, dict) and all(isinstance(k, str) for k in arg):
+        return {"dict": {k: encode(v) for k, v in arg.items()}}
+    if callable(arg) and (name := funcname(arg)) is not None:
+        return {"func": name}
+    raise TypeError(f"{arg!r} can't be sent to a worker")
+
+
+def decode(arg):
+    if isinstance(arg, list):
+        return [decode(a) for a in arg]
+    if isinstance(arg, dict):
+        if "func" in arg:
+            return resolve(arg["func"])
+        return {k: decode(v) for k, v in arg["dict"].items()}
+    return arg
+
+
+def distributable(func: typing.Callable, args: typing.Sequence, kwargs: dict) -> bool:
+    """
+    :return: whether a call can run on a worker instead of here
+    """
+    if not enabled or funcname(func) is None:
+        return False
+    try:
+        encode(args)
+        encode(kwargs)
+    except TypeError:
+        return False
+    return True
+
+
+def readfile(file: str) -> bytes:
+    with open(file, "rb") as f:
+        return f.read()
+
+
+def writefile(file: str, data: bytes):
+    with open(file, "wb") as f:
+        f.write(data)
+
+
+async def delete(conn: aiosqlite.Connection, jobid: int):
+    async with lock:
+        await conn.execute("BEGIN IMMEDIATE")
+        await conn.execute("DELETE FROM job_inputs WHERE job=?", (jobid,))
+        await conn.execute("DELETE FROM jobs WHERE id=?", (jobid,))
+        await conn.execute("COMMIT")
+
+
+async def submit(func: typing.Callable, files: list[str], args: typing.Sequence, kwargs: dict) -> typing.Optional[str]:
+    """
+    runs a processing function on a worker, followed by the usual reencoding and size checks, and waits for it.
+    cancelling this cancels the job on the worker.
+
+    :param func: processing function, must be distributable()
+    :param files: input media, passed as the first args to func
+    :param args: the rest of the args to func
+    :param kwargs: kwargs to func
+    :return: result file
+    """
+    conn = await connect()
+    blobs = await asyncio.gather(*[asyncio.to_thread(readfile, file) for file in files])
+    async with lock:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = await conn.execute("INSERT INTO jobs (func, args, kwargs, created) VALUES (?, ?, ?, ?)",
+                                        (funcname(func), json.dumps(encode(args)), json.dumps(encode(kwargs)),
+                                         time.time()))
+            jobid = cursor.lastrowid
+            await conn.executemany("INSERT INTO job_inputs (job, idx, ext, data) VALUES (?, ?, ?, ?)",
+                                   [(jobid, i, os.path.splitext(file)[1][1:], blob)
+                                    for i, (file, blob) in enumerate(zip(files, blobs))])
+            await conn.execute("COMMIT")
+        except BaseException:
+            await conn.execute("ROLLBACK")
+            raise
+    logger.info(f"Submitted job {jobid} to the job store.")
+    try:
+        while True:
+            await asyncio.sleep(poll_interval)
+            status, heartbeat = await fetchone(conn, "SELECT status, heartbeat FROM jobs WHERE id=?", (jobid,))
+            if status == "running" and heartbeat < time.time() - stale_after:
+                logger.warning(f"Worker running job {jobid} stopped responding, requeueing it.")
+                await execute(conn, "UPDATE jobs SET status='queued', worker=NULL WHERE id=? AND status='running'",
+                              (jobid,))
+            elif status in ["done", "failed"]:
+                break
+        result, ext, error, nonbug = await fetchone(conn, "SELECT result, result_ext, error, nonbug FROM jobs "
+                                                          "WHERE id=?", (jobid,))
+        if status == "failed":
+            if nonbug:
+                raise processing.common.NonBugError(error)
+            raise JobFailed(f"Job {jobid} failed on a worker.") from JobFailed(error)
+        if result is None:
+            return None
+        out = reserve_tempfile(ext or None)
+        await asyncio.to_thread(writefile, out, result)
+        return out
+    finally:
+        # if the job was cancelled, this also tells the worker to stop
+        await delete(conn, jobid)
+
+
+async def claim(conn: aiosqlite.Connection, worker: str) -> typing.Optional[tuple]:
+    async with lock:
+        await conn.execute("BEGIN IMMEDIATE")
+        try:
+            async with conn.execute("SELECT id, func, args, kwargs FROM jobs WHERE status='queued' ORDER BY id "
+                                    "LIMIT 1") as cursor:
+                job = await cursor.fetchone()
+            if job is not None:
+                await conn.execute("UPDATE jobs SET status='running', worker=?, heartbeat=? WHERE id=?",
+                                   (worker, time.time(), job[0]))
+            await conn.execute("COMMIT")
+        except BaseException:
+            await conn.execute("ROLLBACK")
+            raise
+    return job
+
+
+async def work(conn: aiosqlite.Connection, worker: str, job: tuple):
+    jobid, func, args, kwargs = job
+    task = asyncio.current_task()
+    # set when the heartbeat cancels the job, as opposed to the worker being shut down
+    stopped = False
+
+    async def heartbeat():
+        nonlocal stopped
+        while True:
+            await asyncio.sleep(heartbeat_interval)
+            if not await execute(conn, "UPDATE jobs SET heartbeat=? WHERE id=? AND worker=?",
+                                 (time.time(), jobid, worker)):
+                # the bot gave up on it or gave it to someone else
+                logger.info(f"Job {jobid} was cancelled.")
+                stopped = True
+                task.cancel()
+                return
+
+    beat = asyncio.create_task(heartbeat())
+    logger.info(f"Running job {jobid}: {func}")
+    try:
+        async with utils.tempfiles.TempFileSession(), processing.common.accounting(f"job {jobid}"):
+            inputs = await fetchall(conn, "SELECT ext, data FROM job_inputs WHERE job=? ORDER BY idx", (jobid,))
+            files = []
+            for ext, data in inputs:
+                file = reserve_tempfile(ext or None)
+                await asyncio.to_thread(writefile, file, data)
+                files.append(file)
+            result = await core.pipeline.execute(resolve(func), files, decode(json.loads(args)),
+                                                 decode(json.loads(kwargs)), run_parallel=True)
+            data = ext = None
+            if result:
+                data = await asyncio.to_thread(readfile, result)
+                ext = os.path.splitext(result)[1][1:]
+        await execute(conn, "UPDATE jobs SET status='done', result=?, result_ext=? WHERE id=? AND worker=?",
+                      (data, ext, jobid, worker))
+        logger.info(f"Job {jobid} done.")
+    except asyncio.CancelledError:
+        # only the heartbeat's own cancel is handled here, anything else has to stop the worker too
+        if not stopped or task.uncancel():
+            raise
+    except processing.common.NonBugError as e:
+        await execute(conn, "UPDATE jobs SET status='failed', error=?, nonbug=1 WHERE id=? AND worker=?",
+                      (str(e), jobid, worker))
+    except Exception as e:
+        logger.error(e, exc_info=(type(e), e, e.__traceback__))
+        await execute(conn, "UPDATE jobs SET status='failed', error=? WHERE id=? AND worker=?",
+                      ("".join(traceback.format_exception(e)), jobid, worker))
+    finally:
+        beat.cancel()
+
+
+async def runworker(jobs: int):
+    """
+    takes jobs from the job store and runs them, forever
+    :param jobs: how many jobs to run at once
+    """
+    conn = await connect()
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    logger.log(35, f"Worker {worker} running up to {jobs} jobs at once from {path}")
+    utils.tempfiles.startjanitor()
+    slots = asyncio.Semaphore(jobs)
+    # keep references so running jobs aren't garbage collected
+    running = set()
+
+    def done(task: asyncio.Task):
+        running.discard(task)
+        slots.release()
+
+    while True:
+        await slots.acquire()
+        # leave jobs for other workers while this one's temp files are over budget, like the queue does
+        if running and utils.tempfiles.overbudget():
+            slots.release()
+            await asyncio.sleep(poll_interval)
+            continue
+        job = await claim(conn, worker)
+        if job is None:
+            slots.release()
+            await asyncio.sleep(poll_interval)
+            continue
+        task = asyncio.create_task(work(conn, worker, job))
+        running.add(task)
+        task.add_done_callback(done)
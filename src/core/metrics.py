@@ -0,0 +1,256 @@
+"""
+prometheus-style metrics, served over http when config.metrics_port is set.
+"""
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import time
+import typing
+
+from aiohttp import web
+
+import config
+from core.clogs import logger
+
+registry: list["Metric"] = []
+# the command being run, for labelling metrics from code that doesn't know about discord
+command: contextvars.ContextVar[str] = contextvars.ContextVar("command", default="unknown")
+# the stage of the command being run, see stage()
+currentstage: contextvars.ContextVar[typing.Optional[str]] = contextvars.ContextVar("currentstage", default=None)
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def formatlabels(labels: typing.Iterable[tuple[str, typing.Any]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ""
+    return "{" + ",".join(f"{k}=\"{escape(v)}\"" for k, v in labels) + "}"
+
+
+class Metric:
+    def __init__(self, name: str, documentation: str, kind: str, labels: typing.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.kind = kind
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(labels[label] for label in self.labels)
+
+    def samples(self) -> typing.Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}",
+                          *self.samples()])
+
+
+class Counter(Metric):
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = ()):
+        super().__init__(name, documentation, "counter", labels)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{formatlabels(zip(self.labels, key))} {value}"
+
+
+class Gauge(Metric):
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = ()):
+        super().__init__(name, documentation, "gauge", labels)
+        self.values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{formatlabels(zip(self.labels, key))} {value}"
+
+
+class Callback(Metric):
+    """
+    a metric whose values are read from somewhere else when scraped
+    """
+
+    def __init__(self, name: str, documentation: str, kind: str, func: typing.Callable[[], dict],
+                 labels: typing.Sequence[str] = ()):
+        super().__init__(name, documentation, kind, labels)
+        # returns label values (as a tuple in the order of labels) -> value
+        self.func = func
+
+    def samples(self):
+        try:
+            values = self.func()
+        except Exception as e:
+            logger.debug(f"failed to collect {self.name}: {e}")
+            return
+        for key, value in values.items():
+            yield f"{self.name}{formatlabels(zip(self.labels, key))} {value}"
+
+
+class Histogram(Metric):
+    def __init__(self, name: str, documentation: str, labels: typing.Sequence[str] = (),
+                 buckets: typing.Sequence[float] = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)):
+        super().__init__(name, documentation, "histogram", labels)
+        self.buckets = tuple(buckets)
+        # label values -> (count in each bucket, sum, count)
+        self.values: dict[tuple, tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        counts, total, n = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(counts):
+            counts[i] += 1
+        self.values[key] = (counts, total + value, n + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        for key, (counts, total, n) in self.values.items():
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bucket, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket{formatlabels(labels + [('le', bucket)])} {cumulative}"
+            yield f"{self.name}_bucket{formatlabels(labels + [('le', '+Inf')])} {n}"
+            yield f"{self.name}_sum{formatlabels(labels)} {total}"
+            yield f"{self.name}_count{formatlabels(labels)} {n}"
+
+
+stage_seconds = Histogram("mediaforge_stage_seconds", "Time spent in each stage of a command.", ["command", "stage"])
+queue_wait_seconds = Histogram("mediaforge_queue_wait_seconds", "Time commands waited in the queue.")
+subprocesses = Counter("mediaforge_subprocesses_total", "Subprocesses started.", ["binary"])
+subprocess_failures = Counter("mediaforge_subprocess_failures_total", "Subprocesses that exited with an error.",
+                              ["binary"])
+loop_lag = Gauge("mediaforge_event_loop_lag_seconds", "How late the event loop last woke up a sleeping task.")
+loop_lag_seconds = Histogram("mediaforge_event_loop_lag_distribution_seconds", "How late the event loop wakes up "
+                                                                                "sleeping tasks.",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    times a stage of the current command
+    """
+    token = currentstage.set(name)
+    try:
+        with stage_seconds.time(command=command.get(), stage=name):
+            yield
+    finally:
+        currentstage.reset(token)
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+def register(bot):
+    """
+    adds the metrics that read the bot's state when scraped
+    """
+    # imported here since these all use this module
+    import core.queue
+    import core.resultcache
+    import processing.common
+    import utils.tempfiles
+    import utils.web
+
+    Callback("mediaforge_queue_running", "Commands running.", "gauge",
+             lambda: {(): len(core.queue.scheduler.running)})
+    Callback("mediaforge_queue_waiting", "Commands waiting in the queue.", "gauge",
+             lambda: {(): core.queue.scheduler.queued})
+    Callback("mediaforge_queue_slots_used", "Queue slots in use, weighted by cost.", "gauge",
+             lambda: {(): core.queue.scheduler.used})
+
+    def caches():
+        values = {}
+        for name, cache in [("result", core.resultcache.cache), ("download", utils.web.download_cache)]:
+            if cache is not None:
+                values[(name, "hit")] = cache.hits
+                values[(name, "miss")] = cache.misses
+        return values
+
+    Callback("mediaforge_cache_requests_total", "Cache lookups.", "counter", caches, ["cache", "result"])
+    Callback("mediaforge_cache_bytes", "Size of each cache.", "gauge",
+             lambda: {(name,): cache.size for name, cache in
+                      [("result", core.resultcache.cache), ("download", utils.web.download_cache)] if cache},
+             ["cache"])
+    # both are tracked as files are written, a scrape doesn't look at the temp dir itself
+    Callback("mediaforge_temp_bytes", "Bytes in the temp dirs, by what they're for.", "gauge",
+             lambda: {("sessions",): utils.tempfiles.sessionusage(),
+                      ("downloads",): utils.web.download_cache.size if utils.web.download_cache else 0}, ["use"])
+    Callback("mediaforge_limit_violations_total", "Subprocesses stopped for hitting a resource limit.", "counter",
+             lambda: dict(processing.common.limit_violations), ["class", "limit"])
+    Callback("mediaforge_worker_threads_busy", "run_parallel threads running something.", "gauge",
+             lambda: {(): processing.common.poolstats()["running"]})
+    Callback("mediaforge_subprocess_threads", "Threads the running subprocesses were told to use.", "gauge",
+             lambda: {(): processing.common.budget.threads})
+    Callback("mediaforge_worker_threads_queued", "run_parallel calls waiting for a thread.", "gauge",
+             lambda: {(): processing.common.poolstats()["queued"]})
+
+    def subprocessusage():
+        values = {}
+        for (cmd, label), usage in list(processing.common.usage_totals.items()):
+            for mode in ["user", "sys", "wall"]:
+                values[(cmd, label, mode)] = getattr(usage, mode)
+        return values
+
+    Callback("mediaforge_subprocess_seconds_total", "Time used by subprocesses, by command and subprocess.", "counter",
+             subprocessusage, ["command", "subprocess", "mode"])
+    Callback("mediaforge_shard_latency_seconds", "Gateway heartbeat latency of each shard.", "gauge",
+             lambda: {(shard,): latency for shard, latency in bot.latencies}, ["shard"])
+
+
+async def monitorlag(interval: float = 0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - start - interval)
+        loop_lag.set(lag)
+        loop_lag_seconds.observe(lag)
+
+
+async def handler(_: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+lagtask: typing.Optional[asyncio.Task] = None
+
+
+async def start(bot):
+    """
+    starts the metrics endpoint if it's enabled
+    """
+    global lagtask
+    port = config.metrics_port if hasattr(config, "metrics_port") else None
+    if port is None:
+        return
+    host = config.metrics_host if hasattr(config, "metrics_host") else "127.0.0.1"
+    register(bot)
+    app = web.Application()
+    app.router.add_get("/metrics", handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    lagtask = asyncio.create_task(monitorlag())
+    logger.info(f"serving metrics on http://{host}:{port}/metrics")
@@ -0,0 +1,86 @@
+"""
+the discord-free part of running a command: normalizing the inputs, running the processing function, and making sure
+the result can be uploaded. core.process wraps this with discord, core.jobstore with workers, and cli.py with the
+command line.
+"""
+import inspect
+import typing
+
+import core.metrics
+import processing.common
+import processing.ffmpeg.conversion
+import processing.ffmpeg.ensuresize
+from core.clogs import logger
+
+
+async def normalize(media: str, resize=True, exempt=False,
+                    note: typing.Optional[typing.Callable[[str], None]] = None) -> str:
+    """
+    ensures media is within the config resolution, fps and frame count limits, in a single ffmpeg pass
+    :param media: media to normalize
+    :param resize: resize media outside config.min_size and config.max_size?
+    :param exempt: skip the downsizing and duration limits
+    :param note: called with warnings for the user, like core.status.Status.note
+    :return: processed media or original media
+    """
+    plan, resized, tmsg = await processing.ffmpeg.ensuresize.plannormalize(media, resize, exempt)
+    if tmsg:
+        logger.info(tmsg)
+        if note is not None:
+            note(tmsg)
+    media = await plan.run()
+    if resized:
+        (owidth, oheight), (w, h) = resized
+        logger.info(f"Resized from {owidth}x{oheight} to {w}x{h}")
+        if note is not None:
+            note(f"Resized input media from {int(owidth)}x{int(oheight)} to {int(w)}x{int(h)}.")
+    return media
+
+
+async def execute(func: typing.Callable, files: list[str], args: typing.Sequence, kwargs: dict,
+                  run_parallel=False, expectimage=True):
+    """
+    runs a processing function on already normalized media
+    :param func: processing function
+    :param files: input media, passed as the first args to func
+    :param args: the rest of the args to func
+    :param kwargs: kwargs to func
+    :param run_parallel: for sync functions only, run without blocking
+    :param expectimage: is func supposed to return media? if so, it's reencoded and shrunk to fit the upload limit
+    :return: the result of func
+    """
+    args = files + list(args)
+    with core.metrics.stage("process"):
+        # some commands arent coros (usually no-ops) so this is a good check to make
+        if inspect.iscoroutinefunction(func):
+            result = await func(*args, **kwargs)
+        else:
+            if run_parallel:
+                result = await processing.common.run_parallel(func, *args, **kwargs)
+            else:
+                logger.warning(f"{func} is not coroutine")
+                result = func(*args, **kwargs)
+    if expectimage and result:
+        with core.metrics.stage("reencode"):
+            result = await processing.ffmpeg.conversion.allreencode(result, fail_if_gif=False)
+        with core.metrics.stage("assurefilesize"):
+            result = await processing.ffmpeg.ensuresize.assurefilesize(result)
+    return result
+
+
+async def run(func: typing.Callable, files: list[str], *args, resize=True, exempt=False, run_parallel=False,
+              expectimage=True, **kwargs):
+    """
+    runs a command on local files, the same way process() does for discord. must be called in a TempFileSession.
+    :param func: processing function
+    :param files: input media
+    :param args: any non-media args to func
+    :param resize: automatically up/downsize the inputs?
+    :param exempt: skip the downsizing and duration limits
+    :param run_parallel: for sync functions only, run without blocking
+    :param expectimage: is func supposed to return media?
+    :return: the result of func
+    """
+    with core.metrics.stage("normalize"):
+        files = [await normalize(file, resize, exempt) for file in files]
+    return await execute(func, files, args, kwargs, run_parallel, expectimage)
@@ -3,20 +3,53 @@ import inspect
 import typing
 
 import discord
+import humanize
 from discord.ext import commands
 
 import config
 import processing.common
-import processing.ffmpeg.conversion
-import processing.ffmpeg.ensuresize
 
 import processing.ffmpeg.ffprobe
-from core import queue
+from core import jobstore, metrics, pipeline, queue, resultcache
+from core.status import Status
 from core.clogs import logger
 from utils.scandiscord import imagesearch
 from utils.web import saveurls
 import utils.tempfiles
 
+# reacting with this to a command or its status message cancels it
+cancel_emoji = "❌"
+# id of the command message or status message -> (id of the command author, task running the command)
+running: dict[int, tuple[int, asyncio.Task]] = {}
+# what the status message calls each stage with ffmpeg commands in it, see core.metrics.stage()
+stagenames = {"normalize": "Preparing", "process": "Processing", "reencode": "Reencoding",
+              "assurefilesize": "Shrinking"}
+
+
+def cancel(message_id: int, user: typing.Optional[int] = None) -> bool:
+    """
+    cancels a running command, killing any processes it's running and removing it from the queue
+    :param message_id: id of the command message or the status message
+    :param user: if not None, only cancel it if this user ran it
+    :return: whether anything was cancelled
+    """
+    if message_id not in running:
+        return False
+    author, task = running[message_id]
+    if user is not None and user != author:
+        return False
+    logger.info(f"Cancelling command {message_id}")
+    return task.cancel()
+
+
+def cancelall(user: int) -> int:
+    """
+    cancels every running command of a user
+    :return: how many commands were cancelled
+    """
+    tasks = {task for author, task in running.values() if author == user}
+    return sum(task.cancel() for task in tasks)
+
 
 async def process(ctx: commands.Context, func: callable, inputs: list, *args,
                   resize=True, expectimage=True, uploadresult=True, run_parallel=False, **kwargs):
@@ -37,105 +70,128 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
     """
 
     result = None
-    msg: typing.Optional[discord.Message] = None
+    task = asyncio.current_task()
+    running[ctx.message.id] = (ctx.author.id, task)
+    metrics.command.set(ctx.command.qualified_name if ctx.command else "unknown")
 
-    async def reply(st):
-        return await ctx.reply(f"{config.emojis['working']} {st}", mention_author=False)
+    def onmessage(msg: discord.Message):
+        running[msg.id] = (ctx.author.id, task)
 
-    async def updatestatus(st):
-        nonlocal msg
-        try:
-            if msg is None:
-                msg = await reply(st)
-            else:
-                msg = await msg.edit(content=f"{config.emojis['working']} {st}",
-                                     allowed_mentions=discord.AllowedMentions.none())
-        except discord.NotFound:
-            msg = await reply(st)
+    status = Status(ctx, onmessage)
+
+    def onprogress(done: float, eta: typing.Optional[float], step: str):
+        # every ffmpeg command starts over from 0%, so say which one it is
+        stage, _, npass = step.partition(" pass ")
+        st = stagenames.get(stage, "Processing")
+        if npass:
+            st += f" (pass {npass} of 2)"
+        st += f"... {done:.0%}"
+        if eta is not None:
+            st += f", about {humanize.naturaldelta(eta)} left"
+        status.update(st)
 
     if inputs:
         # nothing to download sometimes
-        await updatestatus(f"Downloading...")
+        status.update("Downloading...")
 
     try:
-        async with utils.tempfiles.TempFileSession():
+        async with utils.tempfiles.TempFileSession(), \
+                processing.common.accounting(f"{metrics.command.get()} ({ctx.message.id})"):
             # get media from channel
             if inputs:
-                urls = await imagesearch(ctx, len(inputs))
-                files = await saveurls(urls)
+                with metrics.stage("download"):
+                    urls = await imagesearch(ctx, len(inputs))
+                    files = await saveurls(urls)
             else:
                 files = []
             # if media found or none needed
             if files or not inputs:
-                # check that each file is correct type
-                for i, file in enumerate(files):
-                    # if file is incorrect type
-                    if (imtype := await processing.ffmpeg.ffprobe.mediatype(file)) not in inputs[i]:
-                        # send message and break
-                        await ctx.reply(
-                            f"{config.emojis['warning']} Media #{i + 1} is {imtype}, it must be: "
-                            f"{', '.join(inputs[i])}")
-                        logger.info(f"Media {i} type {imtype} is not in {inputs[i]}")
-                        break
+                cachekey = None
+                # also identifies identical commands running at the same time, so it's needed without the cache too
+                if expectimage and resultcache.repeatable(func, args, kwargs):
+                    # owners skip the size checks so their results aren't the same as everyone else's
+                    cachekey = await resultcache.key(files, func, args, kwargs, resize,
+                                                     await ctx.bot.is_owner(ctx.author))
+                    result = await resultcache.get(cachekey)
+                if result is None:
+                    # check that each file is correct type
+                    for i, file in enumerate(files):
+                        with metrics.stage("probe"):
+                            imtype = await processing.ffmpeg.ffprobe.mediatype(file)
+                        # if file is incorrect type
+                        if imtype not in inputs[i]:
+                            # send message and break
+                            await ctx.reply(
+                                f"{config.emojis['warning']} Media #{i + 1} is {imtype}, it must be: "
+                                f"{', '.join(inputs[i])}")
+                            logger.info(f"Media {i} type {imtype} is not in {inputs[i]}")
+                            break
+                        else:
+                            # send warning for apng
+                            if await processing.ffmpeg.ffprobe.is_apng(file):
+                                asyncio.create_task(
+                                    ctx.reply(f"{config.emojis['warning']} Media #{i + 1} is an apng, w"
+                                              f"hich FFmpeg and MediaForge have limited support for. Ex"
+                                              f"pect errors.", delete_after=10))
+                    # files are of correcte type, begin to process
                     else:
-                        # send warning for apng
-                        if await processing.ffmpeg.ffprobe.is_apng(file):
-                            asyncio.create_task(
-                                ctx.reply(f"{config.emojis['warning']} Media #{i + 1} is an apng, w"
-                                          f"hich FFmpeg and MediaForge have limited support for. Ex"
-                                          f"pect errors.", delete_after=10))
-                        # resize if needed
-                        if resize:
-                            files[i] = await processing.ffmpeg.ffutils.ensuresize(ctx, file, config.min_size, config.max_size)
-                # files are of correcte type, begin to process
-                else:
-                    # only update with queue message if there is a queue
-                    if queue.queue_enabled and queue.sem.locked():
-                        await updatestatus("Your command is in the queue...")
-
-                    # run func
-                    async def run():
-                        nonlocal args
-                        nonlocal files
-                        logger.info("Processing...")
-                        await updatestatus("Processing...")
-                        # remove too long videossss
-                        for i, f in enumerate(files):
-                            files[i] = await processing.ffmpeg.ensuresize.ensureduration(f, ctx)
-                        # prepare args
-                        if inputs:
-                            args = files + list(args)
-                        # some commands arent coros (usually no-ops) so this is a good check to make
-                        if inspect.iscoroutinefunction(func):
-                            command_result = await func(*args, **kwargs)
+                        # only update with queue message if there is a queue
+                        cost = await queue.estimate_cost(files, func)
+                        if queue.queue_enabled and queue.scheduler.full():
+                            status.update("Your command is in the queue...")
+
+                        # run func
+                        async def run():
+                            nonlocal files
+                            logger.info("Processing...")
+                            status.update("Processing...")
+                            processing.common.progress.set(onprogress)
+                            # resize and remove too long videossss
+                            with metrics.stage("normalize"):
+                                exempt = await ctx.bot.is_owner(ctx.author)
+                                if exempt:
+                                    logger.debug(f"bot owner is exempt from downsize and duration checks.")
+                                for i, f in enumerate(files):
+                                    files[i] = await pipeline.normalize(f, resize, exempt, status.note)
+                            # hand the actual work off to a worker in distributed mode
+                            if expectimage and (inspect.iscoroutinefunction(func) or run_parallel) and \
+                                    jobstore.distributable(func, args, kwargs):
+                                return await jobstore.submit(func, files, args, kwargs)
+                            return await pipeline.execute(func, files, args, kwargs, run_parallel, expectimage)
+
+                        async def enqueue():
+                            res = await queue.enqueue(run(), ctx.author.id, ctx.guild.id if ctx.guild else None,
+                                                      cost)
+                            # only here so commands waiting on this one don't all cache the same thing
+                            if cachekey and res:
+                                await resultcache.put(cachekey, res)
+                            return res
+
+                        if cachekey:
+                            # people tend to all run the same command on the same thing at once
+                            result = await resultcache.coalesce(cachekey, enqueue)
                         else:
-                            if run_parallel:
-                                command_result = await processing.common.run_parallel(func, *args, **kwargs)
+                            result = await enqueue()
+                        # check results are as expected
+                        if expectimage:  # file expected
+                            if not result:
+                                raise processing.common.ReturnedNothing(f"Expected image, {func} returned nothing.")
+                        else:  # status string expected
+                            if not result:
+                                raise processing.common.ReturnedNothing(f"Expected string, {func} returned nothing.")
                             else:
-                                logger.warning(f"{func} is not coroutine")
-                                command_result = func(*args, **kwargs)
-                        if expectimage and command_result:
-                            command_result = await processing.ffmpeg.conversion.allreencode(command_result, fail_if_gif=False)
-                            command_result = await processing.ffmpeg.ensuresize.assurefilesize(command_result)
-                        return command_result
-
-                    result = await queue.enqueue(run())
-                    # check results are as expected
-                    if expectimage:  # file expected
-                        if not result:
-                            raise processing.common.ReturnedNothing(f"Expected image, {func} returned nothing.")
-                    else:  # status string expected
-                        if not result:
-                            raise processing.common.ReturnedNothing(f"Expected string, {func} returned nothing.")
-                        else:
-                            await ctx.reply(result)
+                                await ctx.reply(result)
 
-                    # if we need to upload image, do that
-                    if result and expectimage:
-                        logger.info("Uploading...")
-                        await updatestatus("Uploading...")
-                        if uploadresult:
+                # if we need to upload image, do that
+                processing.common.progress.set(None)
+                if result and expectimage:
+                    logger.info("Uploading...")
+                    status.update("Uploading...")
+                    if uploadresult:
+                        with metrics.stage("upload"):
                             if ctx.interaction:
+                                msg = await status.message()
+                                await status.close(delete=False)
                                 await msg.edit(content="", attachments=[discord.File(result)])
                             else:
                                 await ctx.reply(file=discord.File(result))
@@ -143,14 +199,20 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
             else:  # no media found but media expected
                 logger.info("No media found.")
                 if ctx.interaction:
-                    await msg.edit(content=f"{config.emojis['x']} No file found.")
+                    await status.close(f"{config.emojis['x']} No file found.")
                 else:
                     await ctx.reply(f"{config.emojis['x']} No file found.")
+    except asyncio.CancelledError:
+        logger.info("Command cancelled.")
+        await status.close(f"{config.emojis['x']} Cancelled." if ctx.interaction and status.msg else None)
+        raise
     except Exception as e:
-        if msg is not None and not ctx.interaction:
-            await msg.delete()
+        await status.close(delete=not ctx.interaction)
         raise e
+    finally:
+        processing.common.progress.set(None)
+        for k in [k for k, (_, t) in running.items() if t is task]:
+            del running[k]
     # delete message
-    if msg is not None and not ctx.interaction:
-        await msg.delete()
+    await status.close(delete=not ctx.interaction)
     return result
@@ -1,29 +1,265 @@
 import asyncio
+import collections
+import itertools
+import math
 import os
+import time
 import typing
 
+import psutil
+
 import config
+import core.metrics
+import utils.tempfiles
+from core.clogs import logger
+from processing.common import NonBugError
+from processing.ffmpeg.ffprobe import mediatype, get_resolution, get_frame_rate, get_duration
+
+# seconds a job has to wait to lose one step of short-job priority, so long jobs can't starve
+aging = 10
+# half-life in seconds of how long past usage counts against a user or guild
+usage_halflife = 60
+# seconds a job can wait before smaller jobs stop being let in ahead of it
+starvation = 30
+# pixels * frames that make up one unit of cost, roughly a short 1080p gif
+cost_unit = 50_000_000
+# don't start new jobs while there's less than this much free memory or temp space
+min_free_memory = config.min_free_memory if hasattr(config, "min_free_memory") else 0
+min_free_temp_space = config.min_free_temp_space if hasattr(config, "min_free_temp_space") else 0
+
+
+class Job:
+    def __init__(self, user: typing.Hashable, guild: typing.Hashable, cost: float, seq: int):
+        self.user = user
+        self.guild = guild
+        self.cost = cost
+        self.seq = seq
+        # how many slots the job takes, set by the scheduler
+        self.units = 1
+        self.enqueued = time.monotonic()
+        self.started: typing.Optional[float] = None
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def info(self, now: float) -> dict:
+        return {
+            "user": self.user,
+            "guild": self.guild,
+            "cost": self.cost,
+            "units": self.units,
+            "waited": (self.started or now) - self.enqueued,
+            "running_for": now - self.started if self.started is not None else 0
+        }
+
+
+class Scheduler:
+    """
+    runs jobs in a fixed number of slots. each job takes as many slots as its estimated cost, up to all of them.
+    when slots free up, the next job is picked fairly: users and then guilds with the least running jobs and least
+    recent usage go first, then cheaper jobs, then older jobs. if the best job doesn't fit, smaller ones can go ahead
+    of it until it's waited too long.
+    jobs from the same user always run in the order they were submitted.
+    """
+
+    def __init__(self, slots: float, max_queued: typing.Optional[int] = None):
+        self.slots = slots
+        self.max_queued = max_queued
+        # user -> their waiting jobs, oldest first
+        self.waiting: dict[typing.Hashable, collections.deque[Job]] = {}
+        self.running: list[Job] = []
+        self.seq = itertools.count()
+        # user or guild -> (decayed cost of jobs they've started, when that was last updated)
+        self.usage: dict[typing.Hashable, tuple[float, float]] = {}
+        self.retry: typing.Optional[asyncio.TimerHandle] = None
+
+    @property
+    def queued(self) -> int:
+        return sum(len(jobs) for jobs in self.waiting.values())
+
+    @property
+    def used(self) -> int:
+        return sum(job.units for job in self.running)
+
+    def full(self) -> bool:
+        return self.used >= self.slots
+
+    @staticmethod
+    def resources_available() -> bool:
+        if min_free_memory and psutil.virtual_memory().available < min_free_memory:
+            return False
+        if utils.tempfiles.overbudget():
+            return False
+        if min_free_temp_space:
+            try:
+                if psutil.disk_usage(utils.tempfiles.temp_dir).free < min_free_temp_space:
+                    return False
+            except OSError:
+                pass
+        return True
+
+    def getusage(self, key: typing.Hashable, now: float) -> float:
+        if key not in self.usage:
+            return 0
+        value, updated = self.usage[key]
+        return value * 0.5 ** ((now - updated) / usage_halflife)
+
+    def addusage(self, key: typing.Hashable, cost: float, now: float):
+        value = self.getusage(key, now) + cost
+        self.usage[key] = (value, now)
+        # forget anyone who hasn't used the bot in a while
+        for k in [k for k, (v, t) in self.usage.items() if v * 0.5 ** ((now - t) / usage_halflife) < 0.01]:
+            del self.usage[k]
+
+    def priority(self, job: Job, now: float):
+        user_running = sum(1 for j in self.running if j.user == job.user)
+        guild_running = sum(1 for j in self.running if job.guild is not None and j.guild == job.guild)
+        user_usage = round(self.getusage(("user", job.user), now))
+        guild_usage = round(self.getusage(("guild", job.guild), now)) if job.guild is not None else 0
+        # short jobs go first, but the boost fades the longer a job waits
+        costclass = max(0, math.ceil(math.log2(max(job.cost, 1))) - int((now - job.enqueued) // aging))
+        return user_running, guild_running, user_usage, guild_usage, costclass, job.seq
+
+    def pick(self) -> typing.Optional[Job]:
+        now = time.monotonic()
+        # only the oldest job of each user is a candidate, which keeps each user FIFO
+        for job in sorted((jobs[0] for jobs in self.waiting.values()), key=lambda j: self.priority(j, now)):
+            if self.used + job.units <= self.slots:
+                return job
+            if now - job.enqueued > starvation:
+                # hold the free slots for it
+                return None
+        return None
+
+    def dispatch(self):
+        while self.waiting:
+            # always let something run on an idle box, or nothing would ever free up
+            if self.running and not self.resources_available():
+                logger.info("Low on memory or temp space, holding the queue.")
+                if self.retry is None:
+                    self.retry = asyncio.get_running_loop().call_later(1, self.retrydispatch)
+                return
+            job = self.pick()
+            if job is None:
+                return
+            now = time.monotonic()
+            jobs = self.waiting[job.user]
+            jobs.popleft()
+            if not jobs:
+                del self.waiting[job.user]
+            job.started = now
+            core.metrics.queue_wait_seconds.observe(now - job.enqueued)
+            self.addusage(("user", job.user), job.cost, now)
+            if job.guild is not None:
+                self.addusage(("guild", job.guild), job.cost, now)
+            self.running.append(job)
+            job.ready.set_result(None)
+
+    def retrydispatch(self):
+        self.retry = None
+        self.dispatch()
+
+    def remove(self, job: Job):
+        if job in self.running:
+            self.running.remove(job)
+        elif job.user in self.waiting and job in self.waiting[job.user]:
+            self.waiting[job.user].remove(job)
+            if not self.waiting[job.user]:
+                del self.waiting[job.user]
+        self.dispatch()
+
+    async def run(self, task: typing.Coroutine, user: typing.Hashable = None, guild: typing.Hashable = None,
+                  cost: float = 1):
+        """
+        waits for a slot and runs task in it
+        :param task: coroutine to run
+        :param user: who the job is for
+        :param guild: what guild the job is for, if any
+        :param cost: estimated cost of the job, relative to a small image
+        :return: the result of task
+        """
+        if self.max_queued is not None and self.full() and self.queued >= self.max_queued:
+            task.close()
+            raise NonBugError("MediaForge is too busy right now. Try again in a bit.")
+        job = Job(user, guild, cost, next(self.seq))
+        job.units = min(max(1, math.ceil(cost)), self.slots)
+        self.waiting.setdefault(user, collections.deque()).append(job)
+        self.dispatch()
+        try:
+            await job.ready
+            return await task
+        finally:
+            # never started if cancelled while waiting
+            task.close()
+            self.remove(job)
+
+    def state(self) -> dict:
+        """
+        :return: snapshot of the scheduler for introspection
+        """
+        now = time.monotonic()
+        return {
+            "slots": self.slots,
+            "used": self.used,
+            "max_queued": self.max_queued,
+            "running": [job.info(now) for job in self.running],
+            "waiting": [job.info(now) for jobs in self.waiting.values() for job in jobs]
+        }
+
 
 queue_enabled = config.workers != -1
 if queue_enabled:
     workers = config.workers or os.cpu_count() or 1
-    sem = asyncio.Semaphore(workers)
-queued = 0
-
-
-async def enqueue(task: typing.Coroutine):
-    if not queue_enabled:
-        return await task
-    global queued
-    queued += 1
-    # only allows a certain amount of tasks inside the context at once
-    # quick tests show that its roughly FIFO but there are libraries if needed
-    async with sem:
-        try:
-            res = await task
-        except Exception as e:
-            queued -= 1
-            raise e
-        else:
-            queued -= 1
-            return res
+else:
+    workers = math.inf
+scheduler = Scheduler(workers, config.max_queue_length if hasattr(config, "max_queue_length") else None)
+
+
+async def estimate_cost(files: list[str], func: typing.Callable) -> float:
+    """
+    estimates how expensive a command will be from its inputs
+    :param files: input media
+    :param func: processing function
+    :return: cost, in units of cost_unit pixels * frames, at least 1
+    """
+    max_frames = config.max_frames if hasattr(config, "max_frames") else None
+    pixels = 0
+    for file in files:
+        mt = await mediatype(file)
+        if mt not in ["VIDEO", "GIF", "IMAGE"]:
+            continue
+        w, h = await get_resolution(file)
+        # inputs get downsized to max_size before processing
+        scale = min(1, config.max_size / max(w, h))
+        frames = 1
+        if mt != "IMAGE":
+            try:
+                frames = await get_frame_rate(file) * await get_duration(file)
+            except Exception as e:
+                logger.debug(e)
+            if max_frames is not None:
+                frames = min(frames, max_frames)
+        pixels += w * h * scale ** 2 * frames
+    return max(1, pixels / cost_unit * getattr(func, "cost_multiplier", 1))
+
+
+def idle_cores() -> int:
+    """
+    :return: how many cores neither the queue's jobs nor anything else on the machine are using right now, for jobs
+        that can split themselves up to use more of them
+    """
+    # the load average also catches work the queue doesn't know about, like jobs from the job store or other programs
+    idle = (os.cpu_count() or 1) - psutil.getloadavg()[0]
+    if queue_enabled:
+        idle = min(idle, scheduler.slots - scheduler.used)
+    return max(0, math.floor(idle))
+
+
+def queued() -> int:
+    """
+    :return: number of running and waiting jobs
+    """
+    return len(scheduler.running) + scheduler.queued
+
+
+async def enqueue(task: typing.Coroutine, user: typing.Hashable = None, guild: typing.Hashable = None,
+                  cost: float = 1):
+    return await scheduler.run(task, user, guild, cost)
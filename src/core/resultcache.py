@@ -0,0 +1,191 @@
+import asyncio
+import glob
+import hashlib
+import os
+import shutil
+import typing
+
+import config
+from core.clogs import logger
+from utils.diskcache import DiskCache, hash_file
+from utils.tempfiles import reserve_tempfile, temp_file_name
+
+cache: typing.Optional[DiskCache] = None
+# cache key -> the command making that result right now
+inflight: dict[str, "Flight"] = {}
+
+
+def processing_version():
+    """
+    hash of the processing code, so results from an older version of a command are never served
+    """
+    src = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    h = hashlib.sha256()
+    for file in sorted(glob.glob(os.path.join(src, "processing", "**", "*.py"), recursive=True)):
+        with open(file, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+version = processing_version()
+
+
+def init():
+    global cache
+    cache_dir = config.result_cache_dir if hasattr(config, "result_cache_dir") else None
+    if cache_dir is None:
+        logger.debug("result cache disabled")
+        return
+    cache_size = config.result_cache_size if hasattr(config, "result_cache_size") else 1_000_000_000
+    cache = DiskCache(cache_dir, cache_size)
+
+
+def stable_repr(arg) -> str:
+    """
+    repr() that doesn't change between runs, i.e. no memory addresses for functions
+    """
+    if callable(arg) and hasattr(arg, "__qualname__"):
+        return f"{arg.__module__}.{arg.__qualname__}"
+    if isinstance(arg, (list, tuple)):
+        return f"{type(arg).__name__}({', '.join(stable_repr(a) for a in arg)})"
+    if isinstance(arg, dict):
+        return "{" + ", ".join(f"{stable_repr(k)}: {stable_repr(v)}" for k, v in sorted(arg.items())) + "}"
+    return repr(arg)
+
+
+def repeatable(func: typing.Callable, args: tuple, kwargs: dict) -> bool:
+    """
+    :param func: processing function
+    :param args: non-media args to func
+    :param kwargs: kwargs to func
+    :return: whether calling func with these args always gives the same result
+    """
+    random = getattr(func, "nondeterministic", False)
+    if callable(random):
+        random = random(*args, **kwargs)
+    # random commands are only repeatable with a fixed seed
+    return not random or kwargs.get("seed") is not None
+
+
+def settings() -> str:
+    """
+    the config values that change what commands output, so a persistent cache doesn't outlive them
+    """
+    return stable_repr([getattr(config, name, None) for name in
+                        ["max_size", "min_size", "max_fps", "max_frames", "file_upload_limit"]])
+
+
+async def key(files: list[str], func: typing.Callable, args: tuple, kwargs: dict, *extra) -> str:
+    """
+    content-addressed cache key for a command
+    :param files: input files
+    :param func: processing function
+    :param args: non-media args to func
+    :param kwargs: kwargs to func
+    :param extra: anything else that affects the output
+    :return: cache key
+    """
+    hashes = await asyncio.gather(*[asyncio.to_thread(hash_file, file) for file in files])
+    h = hashlib.sha256()
+    for part in [version, settings(), *hashes, stable_repr(func), stable_repr(args), stable_repr(kwargs), stable_repr(extra)]:
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+async def get(k: str) -> typing.Optional[str]:
+    """
+    :param k: cache key
+    :return: a tempfile copy of the cached result, or None on a miss
+    """
+    if cache is None:
+        return None
+    out = temp_file_name(cache.extension(k))
+    if await cache.get(k, out):
+        logger.info(f"result cache hit ({cache.hits} hits, {cache.misses} misses)")
+        return reserve_tempfile(out)
+    return None
+
+
+class Flight:
+    """
+    a command being run that identical commands wait for instead of running it again
+    """
+
+    def __init__(self):
+        self.future: asyncio.Future[typing.Optional[str]] = asyncio.get_running_loop().create_future()
+        self.waiters = 0
+        # set once everyone waiting has their own copy of the result
+        self.copied = asyncio.Event()
+        self.copied.set()
+
+    def join(self):
+        self.waiters += 1
+        self.copied.clear()
+
+    def leave(self):
+        self.waiters -= 1
+        if not self.waiters:
+            self.copied.set()
+
+
+async def copy(result: str) -> str:
+    out = reserve_tempfile(os.path.splitext(result)[1][1:] or None)
+    try:
+        os.link(result, out)
+    except OSError:
+        await asyncio.to_thread(shutil.copyfile, result, out)
+    return out
+
+
+async def coalesce(k: str, run: typing.Callable[[], typing.Awaitable[typing.Optional[str]]]) -> typing.Optional[str]:
+    """
+    runs a command, unless an identical one is already running, in which case it waits for that one and gets a copy
+    of its result. works without the cache.
+    :param k: cache key of the command
+    :param run: runs the command
+    :return: the result, a tempfile of the current session
+    """
+    while (flight := inflight.get(k)) is not None:
+        logger.info("Identical command already running, waiting for it.")
+        flight.join()
+        try:
+            await asyncio.wait([flight.future])
+            if flight.future.cancelled():
+                # whoever started it gave up, so run it here or wait for whoever else does
+                continue
+            if flight.future.exception():
+                raise flight.future.exception()
+            result = flight.future.result()
+            return await copy(result) if result else result
+        finally:
+            flight.leave()
+    flight = Flight()
+    inflight[k] = flight
+    try:
+        result = await run()
+    except Exception as e:
+        flight.future.set_exception(e)
+        # mark as retrieved so asyncio doesn't complain when nobody else was waiting
+        flight.future.exception()
+        raise
+    except BaseException:
+        flight.future.cancel()
+        raise
+    finally:
+        del inflight[k]
+    flight.future.set_result(result)
+    # the result is deleted along with this command's tempfiles, so it has to outlive everyone copying it
+    await flight.copied.wait()
+    return result
+
+
+async def put(k: str, result: str):
+    # results without an extension can't be told apart from a bare extension by reserve_tempfile()
+    if cache is None or "." not in os.path.basename(result):
+        return
+    try:
+        await cache.put(k, result)
+    except OSError as e:
+        # a full cache disk shouldn't fail the command
+        logger.warning(f"failed to cache result: {e}")
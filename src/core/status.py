@@ -0,0 +1,150 @@
+"""
+the "working" message a command replies with while it runs, kept up to date without spending discord's rate limits
+on it.
+"""
+import asyncio
+import time
+import typing
+
+import discord
+from discord.ext import commands
+
+import config
+from core.clogs import logger
+
+# seconds between edits of the same status message
+min_interval = 2
+# an edit that takes this long was probably held back by discord's rate limits
+slow_edit = 1
+# most seconds between edits after backing off
+max_interval = 30
+# stages that finish within this many seconds never get a message at all
+grace = 1
+
+
+class Status:
+    """
+    merges updates to a command's status message and sends them at most every min_interval seconds, backing off when
+    discord rate limits it. only the latest update is ever sent.
+    """
+
+    def __init__(self, ctx: commands.Context,
+                 onmessage: typing.Optional[typing.Callable[[discord.Message], None]] = None):
+        """
+        :param ctx: discord context of the command
+        :param onmessage: called with the status message whenever a new one is sent
+        """
+        self.ctx = ctx
+        self.onmessage = onmessage
+        self.msg: typing.Optional[typing.Union[discord.Message, discord.WebhookMessage]] = None
+        self.stage: typing.Optional[str] = None
+        # warnings and such shown above the stage
+        self.notes: list[str] = []
+        # what the message says right now
+        self.shown: typing.Optional[str] = None
+        self.lastedit = 0.0
+        self.interval = min_interval
+        self.task: typing.Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+        self.closed = False
+
+    @property
+    def content(self) -> str:
+        return "\n".join(self.notes + ([f"{config.emojis['working']} {self.stage}"] if self.stage else []))
+
+    def update(self, stage: str):
+        """
+        sets what the command is doing. returns immediately, the message is edited later.
+        """
+        self.stage = stage
+        self.schedule()
+
+    def note(self, note: str):
+        """
+        adds a line above the stage for the rest of the command, instead of a separate reply
+        """
+        self.notes.append(note)
+        self.schedule()
+
+    def schedule(self):
+        if self.closed:
+            return
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush())
+
+    async def flush(self):
+        # slash commands have to be responded to within 3 seconds, so they can't wait out the grace period
+        if self.msg is None and not self.ctx.interaction:
+            await asyncio.sleep(grace)
+        while not self.closed and self.content != self.shown:
+            await asyncio.sleep(max(0.0, self.lastedit + self.interval - time.monotonic()))
+            if self.closed:
+                return
+            try:
+                await self.send()
+            except discord.HTTPException as e:
+                if e.status != 429:
+                    logger.debug(f"failed to update status message: {e}")
+                    return
+                self.backoff()
+
+    async def send(self):
+        async with self.lock:
+            content = self.content
+            if content == self.shown:
+                return
+            start = time.monotonic()
+            try:
+                if self.msg is None:
+                    await self.reply(content)
+                else:
+                    await self.msg.edit(content=content, allowed_mentions=discord.AllowedMentions.none())
+            except discord.NotFound:
+                # someone deleted it
+                await self.reply(content)
+            self.shown = content
+            self.lastedit = time.monotonic()
+            if self.lastedit - start > slow_edit:
+                self.backoff()
+            else:
+                self.interval = max(min_interval, self.interval / 2)
+
+    async def reply(self, content: str):
+        self.msg = await self.ctx.reply(content, mention_author=False)
+        if self.onmessage is not None:
+            self.onmessage(self.msg)
+
+    def backoff(self):
+        self.interval = min(self.interval * 2, max_interval)
+        logger.debug(f"status messages rate limited, editing every {self.interval}s")
+
+    async def message(self) -> typing.Union[discord.Message, discord.WebhookMessage]:
+        """
+        sends the latest update right away if it hasn't been, for when the message itself is needed
+        :return: the status message
+        """
+        await self.send()
+        return self.msg
+
+    async def close(self, content: typing.Optional[str] = None, delete=True):
+        """
+        stops updating the message and deletes it, or with content, leaves it saying that instead
+        :param content: what to leave the message saying
+        :param delete: if false and there's no content, leave the message as it is
+        """
+        self.closed = True
+        # let a message that's already being sent finish, or it'd be left behind
+        async with self.lock:
+            if self.task is not None:
+                self.task.cancel()
+            if self.msg is None:
+                if content is not None:
+                    await self.ctx.reply(content, mention_author=False)
+                return
+            try:
+                if content is not None:
+                    await self.msg.edit(content=content)
+                elif delete:
+                    await self.msg.delete()
+            except discord.NotFound:
+                pass
@@ -9,7 +9,7 @@ import sys
 import traceback
 
 sys.path.insert(0, os.getcwd())
-from utils import tempfiles
+from utils import tempfiles, web
 
 try:
     # pip libs
@@ -39,7 +39,8 @@ except ModuleNotFoundError as e:
 
 # project files
 import core.database
-from core import heartbeat
+from core import heartbeat, metrics, resultcache
+import processing.common
 from utils.common import *
 from core.clogs import logger
 import config
@@ -139,6 +140,9 @@ def init():
     downloadttsvoices()
     heartbeat.init()
     tempfiles.init()
+    processing.common.init()
+    web.init()
+    resultcache.init()
 
 
 class MyBot(commands.AutoShardedBot):
@@ -163,6 +167,8 @@ class MyBot(commands.AutoShardedBot):
             bot.add_cog(BotEventsCog(bot)),
 
         )
+        await metrics.start(self)
+        tempfiles.startjanitor()
 
 
 if __name__ == "__main__":
@@ -1,15 +1,60 @@
 import asyncio
+import collections
 import concurrent.futures
+import contextlib
+import contextvars
 import functools
+import math
 import os
+import signal
 import subprocess
 import sys
+import threading
+import time
 import typing
 
+import psutil
+
+import config
+import core.metrics
 import utils.tempfiles
 from core.clogs import logger
 from utils.tempfiles import reserve_tempfile
 
+if sys.platform != "win32":
+    import resource
+
+# connect consecutive stages with pipes instead of tempfiles where possible
+streaming = config.streaming if hasattr(config, "streaming") else False
+# command class -> resource limits, see config.example.py
+subprocess_limits = config.subprocess_limits if hasattr(config, "subprocess_limits") else {}
+# (command class, limit) -> how many times a command was stopped for hitting it
+limit_violations = collections.Counter()
+# (command, subprocess label) -> resource usage of every subprocess it ran
+usage_totals: dict[tuple[str, str], "Usage"] = {}
+# resource usage of the subprocesses of the job running in this context, see accounting()
+receipt: contextvars.ContextVar[typing.Optional["Receipt"]] = contextvars.ContextVar("receipt", default=None)
+# called with (fraction done, estimated seconds left, step) as ffmpeg commands of the job running in this context
+# progress. step is the stage of the command (see core.metrics.stage()) the ffmpeg command is part of, with " pass N"
+# for two pass encodes, since each one starts over from 0.
+progress: contextvars.ContextVar[typing.Optional[typing.Callable[[float, typing.Optional[float], str], typing.Any]]] = \
+    contextvars.ContextVar("progress", default=None)
+# share the cores between subprocesses instead of letting each ffmpeg start a thread per core, see config.example.py
+cpu_budget = config.cpu_budget if hasattr(config, "cpu_budget") else True
+# pin subprocesses to their share of the cpus
+cpu_affinity = config.cpu_affinity if hasattr(config, "cpu_affinity") else False
+# io scheduling class of subprocesses, "idle", "best-effort" or None to leave it alone
+io_class = config.subprocess_io_class if hasattr(config, "subprocess_io_class") else None
+# long-lived threads for run_parallel()
+pool: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+pool_size = (config.parallel_workers if hasattr(config, "parallel_workers") else None) or os.cpu_count() or 1
+pool_started = time.monotonic()
+pool_lock = threading.Lock()
+pool_queued = 0
+pool_running = 0
+pool_busy = 0.0
+pool_calls = 0
+
 
 class NonBugError(Exception):
     """When this is raised instead of a normal Exception, on_command_error() will not attach a traceback or github
@@ -27,47 +72,591 @@ class ReturnedNothing(Exception):
     pass
 
 
-# https://fredrikaverpil.github.io/2017/06/20/async-and-await-with-subprocesses/
-async def run_command(*args: str):
+def nondeterministic(func: typing.Optional[typing.Callable] = None, when: typing.Optional[typing.Callable] = None):
     """
-    run a cli command
+    marks a processing function as random. its results are only cached when it's called with a `seed` kwarg.
+    :param when: if given, it's only random when this returns true for the args that come after its media
+    """
+    if func is None:
+        return functools.partial(nondeterministic, when=when)
+    func.nondeterministic = when or True
+    return func
 
-    :param args: the args of the command, what would normally be seperated by a space
-    :return: the result of the command
+
+def commandclass(args: typing.Sequence[str], limitclass: typing.Optional[str] = None) -> str:
+    return limitclass or os.path.splitext(os.path.basename(args[0]))[0]
+
+
+def limits(cls: str) -> dict:
+    """
+    :param cls: command class, the name of the binary or one passed to run_command()
+    :return: the resource limits for it, falling back to the binary's and then the default ones
     """
+    lim = dict(subprocess_limits.get("default", {}))
+    for key in [cls.split("-")[0], cls]:
+        lim.update(subprocess_limits.get(key, {}))
+    return lim
+
+
+class Allotment:
+    """a subprocess's share of the cpu, from CPUBudget"""
+
+    def __init__(self, job: int, threads: int, cpus: typing.Optional[set[int]] = None):
+        self.job = job
+        self.threads = threads
+        # cpus to pin it to, if any
+        self.cpus = cpus
+        self.released = False
 
+    def args(self, args: typing.Sequence[str]) -> list[str]:
+        """
+        :param args: an ffmpeg command with a single output, given last like every command here does
+        :return: args with ffmpeg told to use this many threads, if it's ffmpeg and wasn't already told
+        """
+        if binaryname(args) != "ffmpeg" or "-threads" in args or len(args) < 2:
+            return list(args)
+        threads = str(self.threads)
+        out = [args[0], "-filter_threads", threads, "-filter_complex_threads", threads]
+        for arg in args[1:-1]:
+            # before an input it's for that input's decoder
+            if arg == "-i":
+                out += ["-threads", threads]
+            out.append(arg)
+        # and before the output for its encoders. something that isn't an output there would make ffmpeg fail with
+        # "trailing option(s) found", so leave those as they are and ffmpeg picks its own encoder threads
+        if args[-2] == "-i" or (args[-1].startswith("-") and args[-1] != "-"):
+            return out + [args[-1]]
+        return out + ["-threads", threads, args[-1]]
+
+
+class CPUBudget:
+    """
+    splits the physical cores between the jobs running subprocesses right now, and each job's share between its
+    subprocesses running at the same time, so all together they run about one thread per core. a job alone on the
+    machine gets all of them. subprocesses only get what's left of their job's share, and every subprocess gets at
+    least one thread, so that's the most it goes over.
+    """
+
+    def __init__(self, cores: int):
+        self.cores = cores
+        # job -> how many of its subprocesses are running
+        self.running: collections.Counter[int] = collections.Counter()
+        # job -> how many threads those have
+        self.held: collections.Counter[int] = collections.Counter()
+        self.threads = 0
+        self.cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        # where the next pinned subprocess starts, so they're spread over every cpu
+        self.nextcpu = 0
+
+    def acquire(self, n: int = 1) -> list[Allotment]:
+        """
+        :param n: how many subprocesses are starting together, which split the threads evenly
+        """
+        # subprocesses run outside of any job share one budget
+        job = id(receipt.get())
+        self.running[job] += n
+        share = math.floor(self.cores / len(self.running))
+        free = min(share - self.held[job], self.cores - self.threads)
+        threads = max(1, math.floor(free / n))
+        allotments = []
+        for _ in range(n):
+            cpus = None
+            if cpu_affinity and self.cpus:
+                # in logical cpus, which can be more than the physical cores
+                count = min(len(self.cpus), math.ceil(threads * len(self.cpus) / self.cores))
+                cpus = {self.cpus[(self.nextcpu + i) % len(self.cpus)] for i in range(count)}
+                self.nextcpu = (self.nextcpu + count) % len(self.cpus)
+            self.threads += threads
+            self.held[job] += threads
+            allotments.append(Allotment(job, threads, cpus))
+        return allotments
+
+    def release(self, allotment: Allotment):
+        # whoever handed it to a command can release it again in case the command never started
+        if allotment.released:
+            return
+        allotment.released = True
+        self.threads -= allotment.threads
+        self.held[allotment.job] -= allotment.threads
+        self.running[allotment.job] -= 1
+        if self.running[allotment.job] <= 0:
+            del self.running[allotment.job]
+            del self.held[allotment.job]
+
+
+budget = CPUBudget(psutil.cpu_count(logical=False) or os.cpu_count() or 1)
+
+
+def allot(n: int = 1) -> list[typing.Optional[Allotment]]:
+    """
+    :param n: how many subprocesses are about to start together
+    :return: the share of the cpu for each of them, which has to be given back with budget.release(), or Nones if
+        the budget is off
+    """
+    if not cpu_budget:
+        return [None] * n
+    return budget.acquire(n)
+
+
+def ionice(pid: int):
+    """
+    puts a started subprocess in the configured io scheduling class. this is done from here and not in preexec_fn
+    because psutil isn't safe to use between fork and exec in a process with threads.
+    """
+    ioclass = {"idle": getattr(psutil, "IOPRIO_CLASS_IDLE", None),
+               "best-effort": getattr(psutil, "IOPRIO_CLASS_BE", None)}.get(io_class)
+    if ioclass is None or sys.platform == "win32":
+        return
+    try:
+        psutil.Process(pid).ionice(ioclass)
+    except (OSError, psutil.Error):
+        # it might have already exited
+        pass
+
+
+def nicekwargs(lim: typing.Optional[dict] = None, allotment: typing.Optional[Allotment] = None):
     # https://stackoverflow.com/a/56884806/9044183
     # set proccess priority low
     if sys.platform == "win32":
         startupinfo = subprocess.STARTUPINFO()
         startupinfo.dwFlags |= subprocess.BELOW_NORMAL_PRIORITY_CLASS
-        nicekwargs = {"startupinfo": startupinfo}
+        return {"startupinfo": startupinfo}
     else:
-        nicekwargs = {"preexec_fn": lambda: os.nice(10)}
+        lim = lim or {}
+
+        def preexec():
+            os.nice(10)
+            if allotment is not None and allotment.cpus:
+                try:
+                    os.sched_setaffinity(0, allotment.cpus)
+                except OSError:
+                    pass
+            if lim.get("cpu"):
+                # SIGXCPU at the soft limit, SIGKILL if it ignores that
+                resource.setrlimit(resource.RLIMIT_CPU, (int(lim["cpu"]), int(lim["cpu"]) + 5))
+            if lim.get("memory"):
+                resource.setrlimit(resource.RLIMIT_AS, (int(lim["memory"]), int(lim["memory"])))
+            if lim.get("cgroup"):
+                # the cgroup has to already exist and be writable by us
+                try:
+                    with open(os.path.join(lim["cgroup"], "cgroup.procs"), "w") as f:
+                        f.write("0")
+                except OSError:
+                    pass
+
+        # own process group so killprocess() gets any children too
+        return {"preexec_fn": preexec, "start_new_session": True}
+
+
+def limitexceeded(cls: str, limit: str, message: str):
+    limit_violations[(cls, limit)] += 1
+    logger.warning(f"{cls} exceeded its {limit} limit")
+    return NonBugError(message)
+
+
+def checklimits(cls: str, lim: dict, returncode: int, result: str, cputime: typing.Optional[float] = None):
+    """
+    raises a NonBugError if a failed command looks like it was stopped by one of its limits
+    :param cputime: user + sys seconds the command used, if known
+    """
+    if sys.platform == "win32":
+        return
+    # SIGKILL could just as well be the OOM killer or anything else, so only blame the cpu limit if it was reached
+    if lim.get("cpu") and (returncode == -signal.SIGXCPU or
+                           (returncode == -signal.SIGKILL and cputime is not None and cputime >= lim["cpu"])):
+        raise limitexceeded(cls, "cpu", f"Processing your media used more than {lim['cpu']} seconds of CPU time "
+                                        f"and was stopped.")
+    # ffmpeg and most C programs say the former, node says the latter
+    outofmemory = "cannot allocate memory" in result.lower() or "out of memory" in result.lower()
+    if (lim.get("memory") and outofmemory) or \
+            (lim.get("cgroup") and returncode == -signal.SIGKILL):
+        raise limitexceeded(cls, "memory", "Processing your media used too much memory and was stopped.")
+
+
+def timedout(cls: str, lim: dict):
+    return limitexceeded(cls, "timeout", f"Processing your media took longer than {lim['timeout']} seconds "
+                                         f"and was stopped.")
+
+
+class Usage:
+    """resources used by one or more subprocesses"""
+
+    def __init__(self):
+        self.count = 0
+        self.user = 0.0
+        self.sys = 0.0
+        self.wall = 0.0
+        # bytes, of the biggest one
+        self.maxrss = 0
+
+    def add(self, user: float, sys: float, wall: float, maxrss: int):
+        self.count += 1
+        self.user += user
+        self.sys += sys
+        self.wall += wall
+        self.maxrss = max(self.maxrss, maxrss)
+
+    def merge(self, other: "Usage"):
+        self.count += other.count - 1
+        self.add(other.user, other.sys, other.wall, other.maxrss)
+
+    def __str__(self):
+        return f"{self.count}x {self.wall:.2f}s wall, {self.user:.2f}s user, {self.sys:.2f}s sys, " \
+               f"{self.maxrss / 1_000_000:.0f}MB max rss"
+
+
+class Receipt(dict[str, Usage]):
+    """subprocess label -> resources used by a job's subprocesses with that label"""
+
+    def __str__(self):
+        total = Usage()
+        for usage in self.values():
+            total.merge(usage)
+        return "; ".join([f"{label}: {usage}" for label, usage in self.items()] + [f"total: {total}"])
+
+
+@contextlib.asynccontextmanager
+async def accounting(name: str):
+    """
+    collects the resource usage of every subprocess the code inside starts, and logs it as a receipt once it's done.
+    async so it can go in the same async with as a TempFileSession.
+    :param name: what to call the job in the log
+    """
+    job = Receipt()
+    token = receipt.set(job)
+    try:
+        yield job
+    finally:
+        receipt.reset(token)
+        if job:
+            logger.info(f"Cost receipt for {name}: {job}")
+
+
+def usagelabel(args: typing.Sequence[str], cls: str) -> str:
+    # tell the passes of a two pass encode apart
+    if "-pass" in args[:-1]:
+        return f"{cls} pass {args[list(args).index('-pass') + 1]}"
+    return cls
+
+
+def account(label: str, wall: float, rusage, job: typing.Optional[Receipt]):
+    # ru_maxrss is kilobytes on linux and bytes on macos
+    maxrss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    usage = (rusage.ru_utime, rusage.ru_stime, wall, maxrss)
+    key = (core.metrics.command.get(), label)
+    usage_totals.setdefault(key, Usage()).add(*usage)
+    if job is not None:
+        job.setdefault(label, Usage()).add(*usage)
+    logger.debug(f"{label}: {wall:.2f}s wall, {rusage.ru_utime:.2f}s user, {rusage.ru_stime:.2f}s sys, "
+                 f"{maxrss / 1_000_000:.0f}MB max rss")
+
+
+class Child:
+    """
+    a subprocess with the parts of asyncio.subprocess.Process's interface we use, that's reaped with os.wait4() so
+    its resource usage can be accounted for. asyncio reaps its own subprocesses and throws that away.
+    """
+
+    def __init__(self, popen: subprocess.Popen, label: str):
+        self.popen = popen
+        self.pid = popen.pid
+        self.returncode: typing.Optional[int] = None
+        # user + sys seconds, once it's exited
+        self.cputime: typing.Optional[float] = None
+        self.label = label
+        self.receipt = receipt.get()
+        self.context = contextvars.copy_context()
+        self.started = time.perf_counter()
+        self.loop = asyncio.get_running_loop()
+        self.exited = self.loop.create_future()
+        # like asyncio's own ThreadedChildWatcher, a thread per child blocked waiting for it
+        threading.Thread(target=self.reap, name=f"reap-{self.pid}", daemon=True).start()
+
+    def reap(self):
+        _, status, rusage = os.wait4(self.pid, 0)
+        wall = time.perf_counter() - self.started
+        try:
+            self.loop.call_soon_threadsafe(self.reaped, os.waitstatus_to_exitcode(status), wall, rusage)
+        except RuntimeError:
+            # loop closed while it was running
+            pass
+
+    def reaped(self, returncode: int, wall: float, rusage):
+        # stops Popen from trying to reap it again
+        self.returncode = self.popen.returncode = returncode
+        self.cputime = rusage.ru_utime + rusage.ru_stime
+        self.context.run(account, self.label, wall, rusage, self.receipt)
+        if not self.exited.done():
+            self.exited.set_result(returncode)
+
+    async def wait(self) -> int:
+        return await asyncio.shield(self.exited)
+
+    async def communicate(self, input: typing.Optional[bytes] = None) -> tuple[typing.Optional[bytes], ...]:
+        async def read(pipe) -> typing.Optional[bytes]:
+            if pipe is None:
+                return None
+            reader = asyncio.StreamReader()
+            transport, _ = await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+            try:
+                return await reader.read()
+            finally:
+                transport.close()
+
+        async def write(pipe):
+            if pipe is None:
+                return
+            transport, protocol = await self.loop.connect_write_pipe(
+                lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()), pipe)
+            writer = asyncio.StreamWriter(transport, protocol, None, self.loop)
+            try:
+                writer.write(input)
+                await writer.drain()
+            except (BrokenPipeError, ConnectionResetError):
+                # it exited without reading everything, same as Popen.communicate()
+                pass
+            finally:
+                writer.close()
+
+        _, stdout, stderr = await asyncio.gather(write(self.popen.stdin), read(self.popen.stdout),
+                                                 read(self.popen.stderr))
+        await self.wait()
+        return stdout, stderr
+
+
+class ProgressWatcher:
+    """
+    follows an ffmpeg command's -progress output and passes how far along it is to a progress callback
+    """
+
+    def __init__(self, callback: typing.Callable, duration: typing.Optional[float], frames: typing.Optional[float],
+                 step: str):
+        self.callback = callback
+        self.duration = duration
+        self.frames = frames
+        self.step = step
+        self.read, self.write = os.pipe()
+        self.started = time.perf_counter()
+        self.task: typing.Optional[asyncio.Task] = None
+
+    @classmethod
+    def create(cls, args: typing.Sequence[str]) -> typing.Optional["ProgressWatcher"]:
+        """
+        :return: a watcher for an ffmpeg command if anyone wants its progress and its length is known, otherwise None
+        """
+        callback = progress.get()
+        if callback is None or sys.platform == "win32" or commandclass(args) != "ffmpeg" or "-progress" in args:
+            return None
+        # the first input is what it's going through. inputs with a forced format, like the concat demuxer's lists or
+        # lavfi sources, can't be probed.
+        inputs = []
+        forced = False
+        for i, arg in enumerate(args[:-1]):
+            if arg == "-f":
+                forced = True
+            elif arg == "-i":
+                if not forced:
+                    inputs.append(args[i + 1])
+                forced = False
+        if not inputs:
+            return None
+        import processing.ffmpeg.ffprobe
+        # intermediates usually haven't been probed, and probing them here would be another process per command just
+        # for the progress bar, so those don't get one
+        info = processing.ffmpeg.ffprobe.cached(inputs[0])
+        if info is None:
+            return None
+        duration = info.duration
+        frames = None
+        if duration and info.r_frame_rate and info.r_frame_rate != "0/0":
+            num, _, den = info.r_frame_rate.partition("/")
+            frames = duration * float(num) / float(den or 1)
+        if not duration:
+            return None
+        return cls(callback, duration, frames, usagelabel(args, core.metrics.currentstage.get() or "process"))
+
+    def args(self, args: typing.Sequence[str]) -> list[str]:
+        return [args[0], "-progress", f"pipe:{self.write}", *args[1:]]
+
+    def start(self):
+        # the child has its own copy now
+        os.close(self.write)
+        self.task = asyncio.create_task(self.follow())
+
+    def stop(self):
+        if self.task is None:
+            os.close(self.write)
+            os.close(self.read)
+        # follow() stops by itself once the command exits and closes the pipe, but anything after this is too late
+        self.callback = None
+
+    async def follow(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                                    os.fdopen(self.read, "rb"))
+        try:
+            values = {}
+            async for line in reader:
+                key, _, value = line.decode(errors="ignore").strip().partition("=")
+                # each block of key=value lines ends with progress=continue or progress=end
+                if key == "progress":
+                    self.report(values)
+                    values = {}
+                else:
+                    values[key] = value
+        finally:
+            transport.close()
+
+    def report(self, values: dict):
+        done = None
+        # out_time_ms is also microseconds, older versions only have that one
+        outtime = values.get("out_time_us", values.get("out_time_ms", "N/A"))
+        if outtime.lstrip("-").isdigit():
+            done = int(outtime) / 1_000_000 / self.duration
+        if self.frames and values.get("frame", "").isdigit():
+            done = max(done or 0.0, int(values["frame"]) / self.frames)
+        if done is None:
+            return
+        # trimming and speed changes make the output a different length than the input
+        done = min(max(done, 0.0), 1.0)
+        elapsed = time.perf_counter() - self.started
+        eta = elapsed * (1 - done) / done if done > 0.01 else None
+        if self.callback is None:
+            return
+        try:
+            self.callback(done, eta, self.step)
+        except Exception as e:
+            logger.debug(f"progress callback failed: {e}")
+
+
+async def spawn(args: typing.Sequence[str], label: str, **kwargs):
+    """
+    starts a subprocess like asyncio.create_subprocess_exec(), recording its resource usage once it exits
+    :param args: the args of the command
+    :param label: what to record its usage as
+    :param kwargs: passed to subprocess.Popen
+    :return: the process
+    """
+    if sys.platform == "win32":
+        # no os.wait4() and asyncio can only use windows pipes in its own way
+        return await asyncio.create_subprocess_exec(*args, **kwargs)
+    return Child(subprocess.Popen(args, **kwargs), label)
+
+
+def killprocess(process: typing.Union[asyncio.subprocess.Process, "Child"]):
+    """
+    kills a process started with nicekwargs() and everything it started
+    """
+    if process.returncode is not None:
+        return
+    logger.info(f"Killing PID {process.pid}")
+    try:
+        if sys.platform == "win32":
+            process.kill()
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def decode_output(stdout: typing.Optional[bytes], stderr: typing.Optional[bytes]):
+    stdout = stdout or b""
+    stderr = stderr or b""
+    try:
+        return stdout.decode().strip() + stderr.decode().strip()
+    except UnicodeDecodeError:
+        return stdout.decode("ascii", 'ignore').strip() + stderr.decode("ascii", 'ignore').strip()
+
+
+def costly(multiplier: float):
+    """
+    marks a processing function as more expensive per pixel than most, for the queue's cost estimate
+    :param multiplier: how many times more expensive
+    """
+
+    def decorator(func: typing.Callable):
+        func.cost_multiplier = multiplier
+        return func
+
+    return decorator
+
+
+# https://fredrikaverpil.github.io/2017/06/20/async-and-await-with-subprocesses/
+def binaryname(args: typing.Sequence[str]) -> str:
+    return os.path.splitext(os.path.basename(args[0]))[0]
+
+
+async def run_command(*args: str, input: typing.Optional[bytes] = None, limitclass: typing.Optional[str] = None,
+                      allotment: typing.Optional[Allotment] = None):
+    """
+    run a cli command
+
+    :param args: the args of the command, what would normally be seperated by a space
+    :param input: optionally send this to the command's stdin
+    :param limitclass: use the resource limits of this command class instead of the binary's
+    :param allotment: its share of the cpu from allot(), for commands started together. it's released when the command
+        finishes. by default it gets its own.
+    :return: the result of the command
+    """
+    cls = commandclass(args, limitclass)
+    lim = limits(cls)
+    watcher = ProgressWatcher.create(args)
+    extra = {}
+    if watcher is not None:
+        args = watcher.args(args)
+        extra["pass_fds"] = (watcher.write,)
+    if allotment is None:
+        allotment = allot()[0]
+    if allotment is not None:
+        args = allotment.args(args)
 
     # Create subprocess
-    process = await asyncio.create_subprocess_exec(
-        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
-        **nicekwargs
-    )
+    try:
+        process = await spawn(
+            args, usagelabel(args, cls), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.PIPE if input is not None else None,
+            **nicekwargs(lim, allotment), **extra
+        )
+    except BaseException:
+        if watcher is not None:
+            watcher.stop()
+        if allotment is not None:
+            budget.release(allotment)
+        raise
+    if watcher is not None:
+        watcher.start()
+    ionice(process.pid)
 
     # Status
     logger.info(f"'{args[0]}' started with PID {process.pid}")
     logger.debug(f"PID {process.pid}: {args}")
+    core.metrics.subprocesses.inc(binary=binaryname(args))
 
     # Wait for the subprocess to finish
-    stdout, stderr = await process.communicate()
-
     try:
-        result = stdout.decode().strip() + stderr.decode().strip()
-    except UnicodeDecodeError:
-        result = stdout.decode("ascii", 'ignore').strip() + stderr.decode("ascii", 'ignore').strip()
+        stdout, stderr = await asyncio.wait_for(process.communicate(input), lim.get("timeout"))
+    except asyncio.TimeoutError:
+        killprocess(process)
+        raise timedout(cls, lim)
+    except asyncio.CancelledError:
+        # the command was cancelled, don't leave it running
+        killprocess(process)
+        raise
+    finally:
+        if watcher is not None:
+            watcher.stop()
+        if allotment is not None:
+            budget.release(allotment)
+
+    result = decode_output(stdout, stderr)
     # Progress
     if process.returncode == 0:
         logger.debug(f"PID {process.pid} Done.")
         logger.debug(f"Results: {result}")
     else:
-
+        core.metrics.subprocess_failures.inc(binary=binaryname(args))
+        checklimits(cls, lim, process.returncode, result, getattr(process, "cputime", None))
         logger.error(
             f"PID {process.pid} Failed: {args} result: {result}",
         )
@@ -79,6 +668,89 @@ async def run_command(*args: str):
     return result
 
 
+async def run_piped(*commands: typing.Sequence[str]):
+    """
+    runs several commands at once, with each command's stdout connected to the next one's stdin by an OS pipe.
+    intermediate results never touch the temp dir and the commands run at the same time.
+
+    :param commands: the args of each command
+    :return: the combined result of the commands
+    """
+    processes = []
+    classes = [commandclass(args) for args in commands]
+    lims = [limits(cls) for cls in classes]
+    # the stages run at the same time, so they split the job's share of the cpu
+    allotments = allot(len(commands))
+    commands = [allotment.args(args) if allotment is not None else args
+                for args, allotment in zip(commands, allotments)]
+    try:
+        stdin = None
+        # ends of pipes that are still ours to close
+        fds = set()
+
+        def close(fd):
+            os.close(fd)
+            fds.discard(fd)
+
+        try:
+            for i, (args, lim) in enumerate(zip(commands, lims)):
+                last = i == len(commands) - 1
+                if not last:
+                    read, write = os.pipe()
+                    fds.update([read, write])
+                process = await spawn(
+                    args, usagelabel(args, classes[i]), stdin=stdin, stdout=asyncio.subprocess.PIPE if last else write,
+                    stderr=asyncio.subprocess.PIPE, **nicekwargs(lim, allotments[i])
+                )
+                ionice(process.pid)
+                logger.info(f"'{args[0]}' started with PID {process.pid}")
+                logger.debug(f"PID {process.pid}: {args}")
+                core.metrics.subprocesses.inc(binary=binaryname(args))
+                processes.append(process)
+                # the child has its own copies of these now
+                if stdin is not None:
+                    close(stdin)
+                    stdin = None
+                if not last:
+                    close(write)
+                    stdin = read
+        except BaseException:
+            # a later stage failed to start, don't leave the earlier ones running
+            for process in processes:
+                killprocess(process)
+            await asyncio.gather(*[process.wait() for process in processes], return_exceptions=True)
+            raise
+        finally:
+            for fd in list(fds):
+                close(fd)
+        # the stages run together, so the whole pipeline gets the shortest timeout
+        timeouts = [(lim["timeout"], i) for i, lim in enumerate(lims) if lim.get("timeout")]
+        try:
+            outputs = await asyncio.wait_for(asyncio.gather(*[process.communicate() for process in processes]),
+                                             min(timeouts)[0] if timeouts else None)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            for process in processes:
+                killprocess(process)
+            if isinstance(e, asyncio.TimeoutError):
+                i = min(timeouts)[1]
+                raise timedout(classes[i], lims[i])
+            raise
+    finally:
+        for allotment in allotments:
+            if allotment is not None:
+                budget.release(allotment)
+    results = [decode_output(stdout, stderr) for stdout, stderr in outputs]
+    # an earlier command failing usually makes the later ones fail too, so report the first one
+    for args, process, result, cls, lim in zip(commands, processes, results, classes, lims):
+        if process.returncode != 0:
+            core.metrics.subprocess_failures.inc(binary=binaryname(args))
+            checklimits(cls, lim, process.returncode, result, getattr(process, "cputime", None))
+            logger.error(f"PID {process.pid} Failed: {args} result: {result}")
+            raise CMDError(f"Command {args} failed.") from CMDError(result)
+    logger.debug(f"PIDs {[process.pid for process in processes]} Done.")
+    return "".join(results)
+
+
 async def tts(text: str, model: typing.Literal["male", "female", "retro"] = "male"):
     ttswav = reserve_tempfile("wav")
     if model == "retro":
@@ -99,28 +771,84 @@ async def tts(text: str, model: typing.Literal["male", "female", "retro"] = "mal
     return outname
 
 
+def init():
+    getpool()
+    # imported here since vipsutils imports this module
+    import processing.vips.vipsutils
+
+    def warmedup(future: concurrent.futures.Future):
+        if future.exception():
+            logger.warning(f"failed to warm up pyvips: {future.exception()}")
+        else:
+            logger.debug("pyvips warmed up")
+
+    pool.submit(processing.vips.vipsutils.warmup).add_done_callback(warmedup)
+
+
+def getpool() -> concurrent.futures.ThreadPoolExecutor:
+    global pool
+    if pool is None:
+        pool = concurrent.futures.ThreadPoolExecutor(pool_size, thread_name_prefix="run_parallel")
+        logger.debug(f"started run_parallel pool with {pool_size} threads")
+    return pool
+
+
+def poolstats() -> dict:
+    """
+    :return: snapshot of how busy run_parallel()'s threads are
+    """
+    with pool_lock:
+        uptime = time.monotonic() - pool_started
+        return {
+            "size": pool_size,
+            "queued": pool_queued,
+            "running": pool_running,
+            "calls": pool_calls,
+            "busy_seconds": pool_busy,
+            "utilization": pool_busy / (uptime * pool_size) if uptime else 0
+        }
+
+
 def handle_tfs_parallel(func: typing.Callable, *args, **kwargs):
+    global pool_queued, pool_running, pool_busy, pool_calls
+    with pool_lock:
+        pool_queued -= 1
+        pool_running += 1
+    start = time.perf_counter()
+    # registered so its files count towards the temp budget and the janitor leaves them alone
+    files = utils.tempfiles.Session()
+    utils.tempfiles.sessions[id(files)] = files
     try:
-        utils.tempfiles.session.set([])
+        utils.tempfiles.session.set(files)
         res = func(*args, **kwargs)
-        return True, res, utils.tempfiles.session.get()
+        return True, res, files
     except Exception as e:
-        return False, e, utils.tempfiles.session.get()
+        return False, e, files
+    finally:
+        # run_parallel hands them to the job's session
+        utils.tempfiles.sessions.pop(id(files), None)
+        with pool_lock:
+            pool_running -= 1
+            pool_busy += time.perf_counter() - start
+            pool_calls += 1
 
 
 async def run_parallel(syncfunc: typing.Callable, *args, **kwargs):
     """
-    uses concurrent.futures.ProcessPoolExecutor to run CPU-bound functions in their own process
+    runs CPU-bound functions in a shared thread pool
 
     :param syncfunc: the blocking function
     :return: the result of the blocking function
     """
     # this is only used for essentially async code that just isnt asyncio, ie pyvips and ffmpeg, so a threadpool
     # executor is fine
-    with concurrent.futures.ThreadPoolExecutor(1) as pool:
-        success, res, files = await asyncio.get_running_loop().run_in_executor(
-            pool, functools.partial(handle_tfs_parallel, syncfunc, *args, **kwargs)
-        )
+    global pool_queued
+    with pool_lock:
+        pool_queued += 1
+    # the threads outlive each call, so give every call a fresh context instead of whatever the last one left behind
+    success, res, files = await asyncio.get_running_loop().run_in_executor(
+        getpool(), functools.partial(contextvars.Context().run, handle_tfs_parallel, syncfunc, *args, **kwargs)
+    )
     if files:
         tfs = utils.tempfiles.session.get()
         tfs += files
@@ -3,7 +3,7 @@ import typing
 import processing.common
 from processing import vips as vips
 from processing.ffmpeg.ffprobe import get_resolution, frame_n
-from processing.ffmpeg.ffutils import gif_output
+from processing.ffmpeg.ffutils import gif_output, ffinput
 from processing.ffmpeg.other import imageaudio, concatv
 from utils.tempfiles import reserve_tempfile
 from processing.common import run_command
@@ -12,16 +12,18 @@ from processing.common import run_command
 @gif_output
 async def motivate(media, captions: typing.Sequence[str]):
     text = await processing.common.run_parallel(vips.caption.motivate_text, captions,
-                                                vips.vipsutils.ImageSize(*await get_resolution(media)))
+                                                vips.vipsutils.ImageSize(*await get_resolution(media)),
+                                                tobuffer=processing.common.streaming)
+    textinput, textdata = ffinput(text)
     outfile = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-i", media, "-i", text, "-filter_complex",
+    await run_command("ffmpeg", "-i", media, *textinput, "-filter_complex",
                       "[0]pad=w=iw+(iw/60):h=ih+(iw/60):x=(iw/120):y=(iw/120):color=black[0p0];"
                       "[0p0]pad=w=iw+(iw/30):h=ih+(iw/30):x=(iw/60):y=(iw/60):color=white[0p1];"
                       "[0p1]pad=w=iw:h=ih+(iw/30):x=0:y=0[0p2];"
                       "[0p2][1]vstack=inputs=2[s];"
                       "[s]pad=w=iw+(iw/5):h=ih+(iw/10)+(iw/30):x=(iw/10):y=(iw/10):color=black",
                       "-c:v", "ffv1", "-c:a", "copy", "-fps_mode", "vfr",
-                      outfile)
+                      outfile, input=textdata)
     return outfile
 
 
@@ -51,10 +53,12 @@ async def twitter_caption(media, captions, dark=True):
     width, height = await get_resolution(media)
     # get text
     text = await processing.common.run_parallel(vips.caption.twitter_text, captions,
-                                                vips.vipsutils.ImageSize(width, height), dark)
+                                                vips.vipsutils.ImageSize(width, height), dark,
+                                                tobuffer=processing.common.streaming)
+    textinput, textdata = ffinput(text)
     border_radius = width * (16 / 500)
     outfile = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-i", media, "-i", text, "-filter_complex",
+    await run_command("ffmpeg", "-i", media, *textinput, "-filter_complex",
                       # round corners
                       # https://stackoverflow.com/a/62400465/9044183
                       # copied from round_corners here for efficiency as 1 ffmpeg stream
@@ -77,5 +81,5 @@ async def twitter_caption(media, captions, dark=True):
                       f"[bg]drawbox=c={'#15202b' if dark else '#ffffff'}:replace=1:t=fill[bg];"
                       f"[bg][fg]overlay=format=auto",
                       "-c:v", "ffv1", "-c:a", "copy", "-fps_mode", "vfr",
-                      outfile)
+                      outfile, input=textdata)
     return outfile
@@ -1,23 +1,187 @@
+import collections
+import io
+import mmap
+import os
+import typing
+
+from PIL import Image
+
+from core.clogs import logger
 from processing.common import run_command
-from processing.ffmpeg.ffprobe import mediatype, va_codecs, get_acodec, get_vcodec, get_frame_rate
+from processing.ffmpeg.ffprobe import mediatype, va_codecs, get_acodec, get_vcodec, get_frame_rate, get_duration
 from utils.tempfiles import reserve_tempfile
 
+# path, inode, mtime and size of a source gif -> its palette, as a png
+palettes: collections.OrderedDict[tuple, bytes] = collections.OrderedDict()
+palette_cache_size = 256
+# frames of a video looked at to build its palette
+palette_frames = 16
+
+
+def gifencodeargs(fps: float, palette=False):
+    """
+    ffmpeg output args to encode a gif
+    :param fps: fps of the input
+    :param palette: use the second input as the palette instead of making one from every frame of the first
+    """
+    # cap fps because gifs are wackyyyyyy
+    # TODO: https://superuser.com/q/1854904/1001487
+    fpscap = "fps=fps=50," if fps > 50 else ""
+    if palette:
+        filters = ["-filter_complex", f"[0:v]{fpscap}null[v];[v][1:v]paletteuse=bayer"]
+    else:
+        # make and use nice palette
+        filters = ["-vf", fpscap + "split[s0][s1];[s0]palettegen=reserve_transparent=1[p];[s1][p]paletteuse=bayer"]
+    return [
+        # prevent partial frames, makes filesize worse but fixes issues with transparency
+        "-gifflags", "-transdiff",
+        *filters,
+        # i fucking hate gifs so much man
+        "-fps_mode", "vfr"
+    ]
+
+
+def _onepalette(gif: str) -> bool:
+    """
+    walks the blocks of a gif without decoding any frames
+    :return: if every frame only uses the global color table, with the same transparent color
+    """
+    with open(gif, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:3] != b"GIF" or len(data) < 13:
+            return False
+
+        def table(pos: int, flags: int) -> bytes:
+            return data[pos:pos + 3 * 2 ** ((flags & 7) + 1)] if flags & 0x80 else b""
+
+        def skipsubblocks(pos: int) -> int:
+            while pos < len(data) and data[pos]:
+                pos += data[pos] + 1
+            return pos + 1
+
+        globaltable = table(13, data[10])
+        pos = 13 + len(globaltable)
+        transparent = set()
+        while pos < len(data):
+            block = data[pos]
+            if block == 0x21:
+                # graphic control extension, which has the frame's transparent color
+                if data[pos + 1] == 0xF9 and pos + 7 < len(data):
+                    transparent.add(data[pos + 6] if data[pos + 3] & 1 else None)
+                pos = skipsubblocks(pos + 2)
+            elif block == 0x2C:
+                if pos + 10 > len(data):
+                    return False
+                localtable = table(pos + 10, data[pos + 9])
+                # a local table that only repeats the start of the global one picks the same colors
+                if localtable and localtable != globaltable[:len(localtable)]:
+                    return False
+                # then the lzw minimum code size and the image data
+                pos = skipsubblocks(pos + 10 + len(localtable) + 1)
+            elif block == 0x3B:
+                break
+            else:
+                # not something we understand
+                return False
+        return len(transparent) <= 1
+
+
+def gifpalette(gif: str) -> typing.Optional[bytes]:
+    """
+    reads the global color table of a gif without decoding it
+    :return: the palette as a png paletteuse can use, or None if it doesn't have one or some frames use their own
+    """
+    if not _onepalette(gif):
+        return None
+    with Image.open(gif) as im:
+        palette = getattr(im, "global_palette", None)
+        if palette is None:
+            return None
+        rgb = palette.palette
+        transparency = im.info.get("transparency")
+    colors = [(*rgb[i:i + 3], 255) for i in range(0, len(rgb) - 2, 3)][:256]
+    if transparency is not None and transparency < len(colors):
+        colors[transparency] = (0, 0, 0, 0)
+    elif len(colors) < 256:
+        colors.append((0, 0, 0, 0))
+    # paletteuse wants exactly 256 colors, repeats don't hurt
+    colors += [colors[0]] * (256 - len(colors))
+    out = Image.new("RGBA", (16, 16))
+    out.putdata(colors)
+    buffer = io.BytesIO()
+    out.save(buffer, "png")
+    return buffer.getvalue()
+
+
+async def samplepalette(media: str) -> str:
+    """
+    makes a palette from a few frames spread over media, instead of analysing every frame
+    :return: palette png
+    """
+    out = reserve_tempfile("png")
+    try:
+        duration = await get_duration(media)
+        fps = await get_frame_rate(media)
+    except Exception:
+        duration = fps = None
+    if not duration or not fps or duration * fps <= palette_frames:
+        inputs = ["-i", media]
+        graph = "[0:v]palettegen=reserve_transparent=1:stats_mode=full"
+    else:
+        # seeking to each frame only decodes from the nearest keyframe, which is every frame for ffv1
+        inputs = []
+        for i in range(palette_frames):
+            inputs += ["-ss", str(duration * (i + .5) / palette_frames), "-t", str(1 / fps), "-i", media]
+        graph = "".join(f"[{i}:v]trim=end_frame=1[f{i}];" for i in range(palette_frames)) + \
+                "".join(f"[f{i}]" for i in range(palette_frames)) + \
+                f"concat=n={palette_frames}:v=1:a=0,palettegen=reserve_transparent=1:stats_mode=full"
+    await run_command("ffmpeg", "-hide_banner", *inputs, "-filter_complex", graph, "-frames:v", "1", out)
+    return out
+
 
-async def videotogif(video):
+async def palette(media: str, source=False) -> str:
+    """
+    gets a palette for encoding media as a gif
+    :param media: the media to encode, or the gif it was made from
+    :param source: media is a gif whose colors are already the right ones, so use its own palette if it has one
+    :return: palette png
+    """
+    if not source:
+        # intermediates are never the same file twice, so there's nothing to cache
+        return await samplepalette(media)
+    # source gifs get reused by every step of a command, and statting one is cheaper than reading it
+    st = os.stat(media)
+    key = os.path.abspath(media), st.st_ino, st.st_mtime_ns, st.st_size
+    if key in palettes:
+        palettes.move_to_end(key)
+        data = palettes[key]
+    else:
+        data = gifpalette(media)
+        if data is None:
+            with open(await samplepalette(media), "rb") as f:
+                data = f.read()
+        palettes[key] = data
+        while len(palettes) > palette_cache_size:
+            palettes.popitem(last=False)
+    out = reserve_tempfile("png")
+    with open(out, "wb") as f:
+        f.write(data)
+    return out
+
+
+async def videotogif(video, palettefrom: typing.Optional[str] = None):
+    """
+    encodes video as a gif
+    :param video: video
+    :param palettefrom: a gif with the same colors as video, i.e. the one it was made from, whose palette to reuse
+    :return: gif
+    """
     outname = reserve_tempfile("gif")
     fps = await get_frame_rate(video)
-    await run_command("ffmpeg", "-i", video,
-                      # prevent partial frames, makes filesize worse but fixes issues with transparency
-                      "-gifflags", "-transdiff",
-                      "-vf",
-                      # cap fps because gifs are wackyyyyyy
-                      # TODO: https://superuser.com/q/1854904/1001487
-                      ("fps=fps=50," if fps > 50 else "") + \
-                      # make and use nice palette
-                      "split[s0][s1];[s0]palettegen=reserve_transparent=1[p];[s1][p]paletteuse=bayer",
-                      # i fucking hate gifs so much man
-                      "-fps_mode", "vfr",
-                      outname)
+    if palettefrom is not None and await mediatype(palettefrom) != "GIF":
+        palettefrom = None
+    pal = await palette(palettefrom or video, source=palettefrom is not None)
+    logger.debug(f"encoding {video} as a gif with palette {pal}")
+    await run_command("ffmpeg", "-i", video, "-i", pal, *gifencodeargs(fps, palette=True), outname)
 
     return outname
 
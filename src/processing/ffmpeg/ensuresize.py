@@ -3,83 +3,76 @@ import glob
 import math
 import os
 import sys
-import typing
 
-import discord
 import humanize
-from discord.ext import commands
 
 import config
+import processing.vips.vipsutils
 import utils
 from core.clogs import logger
-from processing.common import NonBugError, run_command, ReturnedNothing
-from processing.ffmpeg.ffprobe import mediatype, get_frame_rate, get_duration, get_resolution
-from processing.ffmpeg.ffutils import changefps, trim, resize
+from processing.common import NonBugError, run_command, ReturnedNothing, run_parallel
+from processing.ffmpeg.ffprobe import mediatype, get_frame_rate, get_duration, get_resolution, hasaudio
+from processing.ffmpeg.ffutils import resize, FilterPlan, plansize
 from utils.tempfiles import reserve_tempfile
 
 
-async def edit_msg_with_webhookmessage_polyfill(msg: typing.Union[discord.Message, discord.WebhookMessage],
-                                                delete_after=None, **kwargs):
+async def planduration(plan: FilterPlan):
     """
-    helper function to add `delete_after` support to WebhookMessage
+    adds fps capping and trimming to plan if its media is over the config max fps or frame count
+    :param plan: FilterPlan of the media
+    :return: warning message if the media will be trimmed, otherwise None
     """
-    if isinstance(msg, discord.WebhookMessage):
-        async def wait_and_delete(msg):
-            await asyncio.sleep(delete_after)
-            await msg.delete()
-
-        await msg.edit(**kwargs)  # WebhookMessage doesn't have a delete_after attribute!
-        if delete_after:
-            asyncio.create_task(wait_and_delete(msg))
-    else:
-        await msg.edit(**kwargs, delete_after=delete_after)
-
-
-async def ensureduration(media, ctx: commands.Context):
-    """
-    ensures that media is under or equal to the config minimum frame count and fps
-    :param media: media to trim
-    :param ctx: discord context
-    :return: processed media or original media, within config.max_frames
-    """
-    if await ctx.bot.is_owner(ctx.author):
-        logger.debug(f"bot owner is exempt from duration checks.")
-        return media
-    if await mediatype(media) != "VIDEO":
-        return media
+    if await mediatype(plan.media) != "VIDEO":
+        return None
     max_fps = config.max_fps if hasattr(config, "max_fps") else None
-    fps = await get_frame_rate(media)
-    if fps > max_fps:
-        logger.debug(f"Capping FPS of {media} from {fps} to {max_fps}")
-        media = await changefps(media, max_fps)
-    # the function that splits frames actually has a vsync thing so this is more accurate to what's generated
+    fps = await get_frame_rate(plan.media)
+    if max_fps is not None and fps > max_fps:
+        logger.debug(f"Capping FPS of {plan.media} from {fps} to {max_fps}")
+        plan.fps(max_fps)
+        fps = max_fps
     max_frames = config.max_frames if hasattr(config, "max_frames") else None
-    fps = await get_frame_rate(media)
     try:
-        dur = await get_duration(media)
+        dur = await get_duration(plan.media)
     except Exception as e:
         dur = 0
         logger.debug(e)
     frames = int(fps * dur)
     if max_frames is None or frames <= max_frames:
-        return media
-    else:
-        newdur = max_frames / fps
-        tmsg = f"{config.emojis['warning']} input file is too long (~{frames} frames)! " \
-               f"Trimming to {round(newdur, 1)}s (~{max_frames} frames)... "
-        logger.debug(tmsg)
-        msg = await ctx.reply(tmsg)
-        media = await trim(media, newdur)
-        try:
-            await edit_msg_with_webhookmessage_polyfill(msg, delete_after=5, content=tmsg + "Done!")
-        except discord.NotFound as e:
-            logger.debug(e)
-        return media
+        return None
+    newdur = max_frames / fps
+    plan.trim(newdur)
+    tmsg = f"{config.emojis['warning']} input file is too long (~{frames} frames)! " \
+           f"Trimming to {round(newdur, 1)}s (~{max_frames} frames)... "
+    logger.debug(tmsg)
+    return tmsg
+
+
+async def plannormalize(media, resize=True, exempt=False):
+    """
+    plans bringing media within the config resolution, fps and frame count limits
+    :param media: media to normalize
+    :param resize: resize media outside config.min_size and config.max_size?
+    :param exempt: skip the downsizing and duration limits
+    :return: the FilterPlan, the old and new size if it will be resized, and a warning if it will be trimmed
+    """
+    plan = FilterPlan(media)
+    resized = await plansize(plan, config.min_size, config.max_size, exempt) if resize else None
+    tmsg = None if exempt else await planduration(plan)
+    return plan, resized, tmsg
+
+
+# encode this many pass 2 candidates at once, at slightly different bitrates. more finish in fewer rounds but use
+# that many times the CPU.
+size_fit_candidates = config.size_fit_candidates if hasattr(config, "size_fit_candidates") else 1
+# rounds of pass 2 encodes before giving up
+size_fit_rounds = 4
 
 
 async def twopasscapvideo(video, maxsize: int, audio_bitrate=128000):
     """
-    attempts to intelligently cap video filesize with two pass encoding
+    attempts to intelligently cap video filesize with two pass encoding.
+    pass 1 only runs once. its stats don't depend on the bitrate, so when a pass 2 comes out too big, it's redone at a
+    bitrate scaled by how far off it was, which nearly always fits on the next try.
 
     :param video: video file (str path)
     :param maxsize: max size (in bytes) of output file
@@ -90,31 +83,48 @@ async def twopasscapvideo(video, maxsize: int, audio_bitrate=128000):
         return video
     # https://trac.ffmpeg.org/wiki/Encode/H.264#twopass
     duration = await get_duration(video)
+    if not await hasaudio(video):
+        audio_bitrate = 0
+    audio_bytes = audio_bitrate * duration / 8
+    # leave a bit of room for the container
+    video_budget = maxsize * .98 - audio_bytes
     # bytes to bits
-    target_total_bitrate = (maxsize * 8) / duration
-    for tolerance in [.98, .95, .90, .75, .5, .25, .1]:
-        target_video_bitrate = (target_total_bitrate - audio_bitrate) * tolerance
-        if target_video_bitrate <= 0:
-            raise NonBugError("Cannot fit video into Discord.")
-        logger.info(f"trying to force {video} ({humanize.naturalsize(size)}) "
-                    f"under {humanize.naturalsize(maxsize)} with tolerance {tolerance}. "
-                    f"trying {humanize.naturalsize(target_video_bitrate / 8)}/s")
-        pass1log = utils.tempfiles.temp_file_name()
+    target_video_bitrate = video_budget * 8 / duration
+    if target_video_bitrate <= 0:
+        raise NonBugError("Cannot fit video into Discord.")
+    logger.info(f"trying to force {video} ({humanize.naturalsize(size)}) under {humanize.naturalsize(maxsize)}. "
+                f"trying {humanize.naturalsize(target_video_bitrate / 8)}/s")
+    pass1log = utils.tempfiles.temp_file_name()
+    await run_command('ffmpeg', '-y', '-i', video, '-c:v', 'h264', '-b:v', str(int(target_video_bitrate)), '-pass',
+                      '1', '-an', '-f', 'null', '-passlogfile', pass1log,
+                      'NUL' if sys.platform == "win32" else "/dev/null")
+    # log files are pass1log-N.log and pass1log-N.log.mbtree where N is an int, easiest to just glob them all
+    for f in glob.glob(pass1log + "*"):
+        reserve_tempfile(f)
+
+    async def pass2(bitrate: float):
         outfile = reserve_tempfile("mp4")
-        await run_command('ffmpeg', '-y', '-i', video, '-c:v', 'h264', '-b:v', str(target_video_bitrate), '-pass', '1',
-                          '-f', 'mp4', '-passlogfile', pass1log,
-                          'NUL' if sys.platform == "win32" else "/dev/null")
-        await run_command('ffmpeg', '-i', video, '-c:v', 'h264', '-b:v', str(target_video_bitrate), '-pass', '2',
-                          '-passlogfile', pass1log, '-c:a', 'aac', '-b:a', str(audio_bitrate), "-f", "mp4", "-movflags",
-                          "+faststart", outfile)
-        # log files are pass1log-N.log and pass1log-N.log.mbtree where N is an int, easiest to just glob them all
-        for f in glob.glob(pass1log + "*"):
-            reserve_tempfile(f)
-        if (size := os.path.getsize(outfile)) < maxsize:
+        await run_command('ffmpeg', '-i', video, '-c:v', 'h264', '-b:v', str(int(bitrate)), '-pass', '2',
+                          '-passlogfile', pass1log, *(['-c:a', 'aac', '-b:a', str(audio_bitrate)] if audio_bitrate
+                                                      else ['-an']),
+                          "-f", "mp4", "-movflags", "+faststart", outfile)
+        return bitrate, outfile, os.path.getsize(outfile)
+
+    for _ in range(size_fit_rounds):
+        if target_video_bitrate < 1000:
+            break
+        candidates = [target_video_bitrate * (1 - .05 * i) for i in range(size_fit_candidates)]
+        results = await asyncio.gather(*[pass2(bitrate) for bitrate in candidates])
+        fits = [(size, outfile) for _, outfile, size in results if size < maxsize]
+        if fits:
+            size, outfile = max(fits)
             logger.info(f"successfully created {humanize.naturalsize(size)} video!")
             return outfile
-        else:
-            logger.info(f"tolerance {tolerance} failed. output is {humanize.naturalsize(size)}")
+        bitrate, _, size = min(results, key=lambda r: r[2])
+        logger.info(f"{humanize.naturalsize(bitrate / 8)}/s failed. output is {humanize.naturalsize(size)}")
+        # the encoder overshot by about this much, and will again at a different bitrate. always go down some, in
+        # case it was the audio that's bigger than expected.
+        target_video_bitrate = bitrate * min(video_budget / max(size - audio_bytes, 1) * .97, .9)
     raise NonBugError(f"Unable to fit {video} within {humanize.naturalsize(maxsize)}")
 
 
@@ -165,7 +175,10 @@ async def assurefilesize(media):
     if mt == "VIDEO":
         # fancy ffmpeg based video thing
         return await twopasscapvideo(media, config.file_upload_limit)
-    elif mt in ["IMAGE", "GIF"]:
+    elif mt == "IMAGE":
+        # big pngs (mostly screenshots) usually compress or quantize well enough that they don't need shrinking
+        return await run_parallel(processing.vips.vipsutils.fitpng, media, config.file_upload_limit)
+    elif mt == "GIF":
         # file size should be roughly proportional to # of pixels so we can work with that :3
         return await intelligentdownsize(media, config.file_upload_limit)
     else:
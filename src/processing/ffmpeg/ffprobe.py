@@ -1,5 +1,9 @@
+import collections
 import json
+import mmap
+import os
 import sys
+import typing
 
 import apng
 
@@ -12,14 +16,145 @@ from PIL import Image, UnidentifiedImageError
 from processing.common import *
 
 
+class MediaInfo:
+    """
+    the parts of `ffprobe -show_streams -show_format` that the rest of the bot cares about.
+    filled once per file by probe() and shared by every helper in this module.
+    """
+    __slots__ = ("vcodec", "acodec", "width", "height", "r_frame_rate", "duration", "sample_rate", "mediatype",
+                 "frames", "vduration", "attached_pic", "rotation")
+
+    def __init__(self, data: dict):
+        self.vcodec: typing.Optional[dict] = None
+        self.acodec: typing.Optional[dict] = None
+        self.width: typing.Optional[int] = None
+        self.height: typing.Optional[int] = None
+        self.r_frame_rate: typing.Optional[str] = None
+        self.sample_rate: typing.Optional[int] = None
+        # frame count and duration of the video stream, if the container says
+        self.frames: typing.Optional[int] = None
+        self.vduration: typing.Optional[float] = None
+        # the video stream is cover art of an audio file
+        self.attached_pic = False
+        # degrees the video is rotated by in its metadata, which ffmpeg applies when decoding
+        self.rotation = 0.0
+        # filled lazily by mediatype()
+        self.mediatype: typing.Optional[str] = None
+        vstream = None
+        astream = None
+        for stream in data.get("streams", []):
+            if stream.get("codec_type") == "video" and vstream is None:
+                vstream = stream
+            elif stream.get("codec_type") == "audio" and astream is None:
+                astream = stream
+        if vstream is not None:
+            self.vcodec = {"codec_name": vstream.get("codec_name"),
+                           "codec_long_name": vstream.get("codec_long_name")}
+            self.width = vstream.get("width")
+            self.height = vstream.get("height")
+            self.r_frame_rate = vstream.get("r_frame_rate")
+            if str(vstream.get("nb_frames", "")).isdigit():
+                self.frames = int(vstream["nb_frames"])
+            self.vduration = _parse_duration(vstream.get("duration"))
+            if self.vduration is None:
+                # matroska only has it as a tag, i.e. DURATION or DURATION-eng
+                for tag, value in vstream.get("tags", {}).items():
+                    if tag.upper().startswith("DURATION"):
+                        self.vduration = _parse_duration(value)
+            self.attached_pic = bool(vstream.get("disposition", {}).get("attached_pic"))
+            # if rotated in metadata, swap width and height
+            rot = vstream.get("tags", {}).get("rotate")
+            if rot is None:
+                # newer ffmpeg versions put rotation in side data instead of tags
+                for sd in vstream.get("side_data_list", []):
+                    if "rotation" in sd:
+                        rot = sd["rotation"]
+            if rot is not None:
+                rot = float(rot)
+                self.rotation = rot
+                if rot % 90 == 0 and not rot % 180 == 0:
+                    self.width, self.height = self.height, self.width
+        if astream is not None:
+            self.acodec = {"codec_name": astream.get("codec_name"),
+                           "codec_long_name": astream.get("codec_long_name")}
+            if "sample_rate" in astream:
+                self.sample_rate = int(astream["sample_rate"])
+        duration = data.get("format", {}).get("duration")
+        # missing or N/A with APNGs
+        self.duration: typing.Optional[float] = float(duration) if duration not in [None, "N/A"] else None
+
+
+def _parse_duration(value) -> typing.Optional[float]:
+    """
+    :param value: seconds, or HH:MM:SS.fraction like matroska's tags
+    :return: seconds, or None if there isn't a duration
+    """
+    if value in [None, "N/A"]:
+        return None
+    try:
+        seconds = 0.0
+        for part in str(value).split(":"):
+            seconds = seconds * 60 + float(part)
+        return seconds
+    except ValueError:
+        return None
+
+
+# files are keyed by path plus inode/mtime/size so a reused or rewritten path is never served stale info
+_probe_cache: collections.OrderedDict[tuple, MediaInfo] = collections.OrderedDict()
+_probe_cache_size = 512
+
+
+def _file_key(filename) -> tuple:
+    st = os.stat(filename)
+    return os.path.abspath(filename), st.st_ino, st.st_mtime_ns, st.st_size
+
+
+def cached(filename) -> typing.Optional[MediaInfo]:
+    """
+    :return: the MediaInfo of a file if it's already been probed, without probing it
+    """
+    try:
+        key = _file_key(filename)
+    except OSError:
+        return None
+    return _probe_cache.get(key)
+
+
+async def probe(filename) -> MediaInfo:
+    """
+    runs ffprobe once on a file and caches the result
+    :param filename: filename
+    :return: MediaInfo of the file
+    """
+    key = _file_key(filename)
+    if key in _probe_cache:
+        _probe_cache.move_to_end(key)
+        return _probe_cache[key]
+    out = await run_command("ffprobe", "-v", "panic", "-show_streams", "-show_format", "-print_format", "json",
+                            filename)
+    info = MediaInfo(json.loads(out))
+    _probe_cache[key] = info
+    while len(_probe_cache) > _probe_cache_size:
+        _probe_cache.popitem(last=False)
+    return info
+
+
+def apng_duration(filename):
+    parsedapng = apng.APNG.open(filename)
+    apnglen = 0
+    # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
+    for png, control in parsedapng.frames:
+        if control.delay_den == 0:
+            control.delay_den = 100
+        apnglen += control.delay / control.delay_den
+    return len(parsedapng.frames), apnglen
+
+
 async def is_apng(filename):
-    out = await run_command("ffprobe", filename, "-v", "panic", "-select_streams", "v:0", "-print_format", "json",
-                            "-show_entries", "stream=codec_name")
-    data = json.loads(out)
-    if len(data["streams"]):  # 0 if audio file because it selects v:0, audio cannot be apng
-        return data["streams"][0]["codec_name"] == "apng"
-    else:
-        return False
+    info = await probe(filename)
+    # audio cannot be apng
+    return info.vcodec is not None and info.vcodec["codec_name"] == "apng"
 
 
 # https://askubuntu.com/questions/110264/how-to-find-frames-per-second-of-any-video-file
@@ -30,20 +165,12 @@ async def get_frame_rate(filename):
     :return: FPS
     """
     logger.info("Getting FPS...")
-    out = await run_command("ffprobe", filename, "-v", "panic", "-select_streams", "v:0", "-print_format", "json",
-                            "-show_entries", "stream=r_frame_rate,codec_name")
-    data = json.loads(out)
-    if data["streams"][0]["codec_name"] == "apng":  # ffmpeg no likey apng
-        parsedapng = apng.APNG.open(filename)
-        apnglen = 0
-        # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
-        for png, control in parsedapng.frames:
-            if control.delay_den == 0:
-                control.delay_den = 100
-            apnglen += control.delay / control.delay_den
-        return len(parsedapng.frames) / apnglen
+    info = await probe(filename)
+    if info.vcodec["codec_name"] == "apng":  # ffmpeg no likey apng
+        frames, apnglen = apng_duration(filename)
+        return frames / apnglen
     else:
-        rate = data["streams"][0]["r_frame_rate"].split("/")
+        rate = info.r_frame_rate.split("/")
         if len(rate) == 1:
             return float(rate[0])
         if len(rate) == 2:
@@ -59,20 +186,12 @@ async def get_duration(filename):
     :return: duration
     """
     logger.info("Getting duration...")
-    out = await run_command("ffprobe", "-v", "panic", "-show_entries", "format=duration", "-of",
-                            "default=noprint_wrappers=1:nokey=1", filename)
-    if out == "N/A":  # happens with APNGs
+    info = await probe(filename)
+    if info.duration is None:  # happens with APNGs
         # no garuntee that its an APNG here but i dont have any other plans so i want it to raise an exception
-        parsedapng = apng.APNG.open(filename)
-        apnglen = 0
-        # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
-        for png, control in parsedapng.frames:
-            if control.delay_den == 0:
-                control.delay_den = 100
-            apnglen += control.delay / control.delay_den
-        return apnglen
+        return apng_duration(filename)[1]
     else:
-        return float(out)
+        return info.duration
 
 
 async def get_resolution(filename):
@@ -81,19 +200,10 @@ async def get_resolution(filename):
     :param filename: filename
     :return: [width, height]
     """
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "v:0", "-show_entries",
-                            "stream=width,height:stream_tags=rotate",
-                            "-print_format", "json", filename)
-    out = json.loads(out)
-    w = out["streams"][0]["width"]
-    h = out["streams"][0]["height"]
-    # if rotated in metadata, swap width and height
-    if "tags" in out["streams"][0]:
-        if "rotate" in out["streams"][0]["tags"]:
-            rot = float(out["streams"][0]["tags"]["rotate"])
-            if rot % 90 == 0 and not rot % 180 == 0:
-                w, h = h, w
-    return [w, h]
+    info = await probe(filename)
+    if info.vcodec is None:
+        raise IndexError(f"{filename} has no video stream.")
+    return [info.width, info.height]
 
 
 async def get_vcodec(filename):
@@ -102,15 +212,8 @@ async def get_vcodec(filename):
     :param filename: filename
     :return: dict containing "codec_name" and "codec_long_name"
     """
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "v:0", "-show_entries",
-                            "stream=codec_name,codec_long_name",
-                            "-print_format", "json", filename)
-    out = json.loads(out)
-    if out["streams"]:
-        return out["streams"][0]
-    else:
-        # only checks for video codec, audio files return Nothinng
-        return None
+    # only checks for video codec, audio files return None
+    return (await probe(filename)).vcodec
 
 
 async def get_acodec(filename):
@@ -119,31 +222,24 @@ async def get_acodec(filename):
     :param filename: filename
     :return: dict containing "codec_name" and "codec_long_name"
     """
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "a:0", "-show_entries",
-                            "stream=codec_name,codec_long_name",
-                            "-print_format", "json", filename)
-    out = json.loads(out)
-    if out["streams"]:
-        return out["streams"][0]
-    else:
-        return None
+    return (await probe(filename)).acodec
+
+
+async def get_sample_rate(filename):
+    """
+    gets the sample rate of audio
+    :param filename: filename
+    :return: sample rate in Hz or None if there is no audio
+    """
+    return (await probe(filename)).sample_rate
 
 
 async def va_codecs(filename):
-    out = await run_command('ffprobe', '-v', 'panic', '-show_entries', 'stream=codec_name,codec_type', '-print_format',
-                            'json', filename)
-    out = json.loads(out)
-    acodec = None
-    vcodec = None
-    if out["streams"]:
-        for stream in out["streams"]:
-            if stream["codec_type"] == "video" and vcodec is None:
-                vcodec = stream["codec_name"]
-            elif stream["codec_type"] == "audio" and acodec is None:
-                acodec = stream["codec_name"]
-        return vcodec, acodec
-    else:
+    info = await probe(filename)
+    if info.vcodec is None and info.acodec is None:
         return None
+    return (info.vcodec["codec_name"] if info.vcodec else None,
+            info.acodec["codec_name"] if info.acodec else None)
 
 
 async def mediatype(image):
@@ -152,31 +248,123 @@ async def mediatype(image):
     :param image: filename of media
     :return: can be VIDEO, AUDIO, GIF, IMAGE or None (invalid or other).
     """
+    try:
+        key = _file_key(image)
+        if key in _probe_cache and _probe_cache[key].mediatype is not None:
+            return _probe_cache[key].mediatype
+    except OSError:
+        pass
+    mt = await _mediatype(image)
+    if mt is not None:
+        try:
+            (await probe(image)).mediatype = mt
+        except CMDError:
+            # PIL can open a few things ffprobe can't, those just don't get cached
+            pass
+    return mt
+
+
+# bytes read from the start of a file to recognize its format
+_sniff_size = 4096
+
+
+def _sniff(filename) -> typing.Optional[str]:
+    """
+    recognizes common formats from the first few KB of a file, without reading the rest of it
+    :param filename: filename
+    :return: "image" for image formats, "av" for audio and video containers, or None if it's something else
+    """
+    with open(filename, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None
+        with mmap.mmap(f.fileno(), min(size, _sniff_size), access=mmap.ACCESS_READ) as m:
+            head = m[:]
+    if head.startswith((b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF87a", b"GIF89a", b"BM", b"II*\x00", b"MM\x00*",
+                        b"\x00\x00\x01\x00")) or (head[:4] == b"RIFF" and head[8:12] == b"WEBP"):
+        return "image"
+    if head[4:8] == b"ftyp":
+        # heif and avif are mp4s of still images
+        return "image" if head[8:12] in [b"avif", b"avis", b"heic", b"heix", b"mif1", b"msf1"] else "av"
+    if head.startswith((b"\x1a\x45\xdf\xa3", b"OggS", b"fLaC", b"ID3", b"FLV", b"\x00\x00\x01\xba", b"caff", b"FORM",
+                        b"#!AMR", b"\x30\x26\xb2\x75")) or \
+            (head[:4] == b"RIFF" and head[8:12] in [b"AVI ", b"WAVE"]) or \
+            (len(head) > 188 and head[0] == head[188] == 0x47):  # mpeg-ts packets
+        return "av"
+    # mp3 and adts aac frame sync
+    if len(head) > 1 and head[0] == 0xff and head[1] & 0xe0 == 0xe0:
+        return "av"
+    return None
+
+
+def _streamtype(info: MediaInfo) -> typing.Optional[str]:
+    """
+    classifies media from what the container says about its streams, with the same priorities as _countpackets()
+    :return: the mediatype, or None if it can't be told without counting frames
+    """
+    if info.vcodec is None or info.attached_pic:
+        return "AUDIO" if info.acodec is not None else None
+    frames = info.frames
+    if frames is None:
+        # the format's duration is the audio's if there is any
+        duration = info.vduration if info.vduration is not None or info.acodec is not None else info.duration
+        try:
+            num, _, den = (info.r_frame_rate or "").partition("/")
+            fps = float(num) / float(den or 1)
+        except (ValueError, ZeroDivisionError):
+            fps = None
+        if not duration or not fps:
+            return None
+        frames = duration * fps
+        if frames < 2:
+            # could be one long frame, or a couple short ones
+            return None
+    if frames > 1:
+        return "GIF" if info.vcodec["codec_name"] == "gif" else "VIDEO"
+    if frames == 1:
+        return "AUDIO" if info.acodec is not None else "IMAGE"
+    return None
+
+
+async def _mediatype(image):
+    kind = _sniff(image)
     # ffmpeg doesn't work well with detecting images so let PIL do that
-    mime = magic.from_file(image, mime=True)
+    if kind != "av":
+        try:
+            with Image.open(image) as im:
+                anim = getattr(im, "is_animated", False)
+            if anim:
+                logger.debug(f"identified {im.format} with animated frames as GIF")
+                return "GIF"  # gifs dont have to be animated but if they aren't its easier to treat them like pngs
+            else:
+                logger.debug(f"identified {im.format} with no animated frames as IMAGE")
+                return "IMAGE"
+        except UnidentifiedImageError:
+            logger.debug(f"UnidentifiedImageError on {image}")
+    # PIL isn't sure so see what the container says about its streams, which is only its headers
     try:
-        with Image.open(image) as im:
-            anim = getattr(im, "is_animated", False)
-        if anim:
-            logger.debug(f"identified type {mime} with animated frames as GIF")
-            return "GIF"  # gifs dont have to be animated but if they aren't its easier to treat them like pngs
-        else:
-            logger.debug(f"identified type {mime} with no animated frames as IMAGE")
-            return "IMAGE"
-    except UnidentifiedImageError:
-        logger.debug(f"UnidentifiedImageError on {image}")
-    # PIL isn't sure so let ffmpeg take control
-    probe = await run_command('ffprobe', '-v', 'panic', '-count_packets', '-show_entries',
-                              'stream=codec_type,codec_name,nb_read_packets',
-                              '-print_format', 'json', image)
+        mt = _streamtype(await probe(image))
+    except CMDError:
+        mt = None
+    if mt is not None:
+        logger.debug(f"identified {image} as {mt} from its stream info")
+        return mt
+    # only short or odd files get here, so reading all of it is cheap
+    return await _countpackets(image)
+
+
+async def _countpackets(image):
+    packets = await run_command('ffprobe', '-v', 'panic', '-count_packets', '-show_entries',
+                                'stream=codec_type,codec_name,nb_read_packets',
+                                '-print_format', 'json', image)
     props = {
         "video": False,
         "audio": False,
         "gif": False,
         "image": False
     }
-    probe = json.loads(probe)
-    for stream in probe["streams"]:
+    packets = json.loads(packets)
+    for stream in packets["streams"]:
         if stream["codec_type"] == "audio":  # only can be pure audio
             props["audio"] = True
         elif stream["codec_type"] == "video":  # could be video or image or gif sadly
@@ -199,7 +387,7 @@ async def mediatype(image):
         return "AUDIO"
     if props["image"]:
         return "IMAGE"
-    logger.debug(f"mediatype None due to unclassified type {mime}")
+    logger.debug(f"mediatype None due to unclassified type of {image}")
     return None
 
 
@@ -227,5 +415,4 @@ async def frame_n(video, n: int):
 
 
 async def hasaudio(video):
-    return bool(
-        await run_command("ffprobe", "-i", video, "-show_streams", "-select_streams", "a", "-loglevel", "panic"))
+    return (await probe(video)).acodec is not None
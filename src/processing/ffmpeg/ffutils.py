@@ -1,15 +1,21 @@
 import asyncio
+import functools
+import glob
 import math
 
 import config
+import core.queue
 import processing.common
 from core.clogs import logger
-from processing.ffmpeg.conversion import videotogif, mediatopng
-from processing.ffmpeg.ffprobe import mediatype, get_duration, hasaudio, get_resolution
-from utils.tempfiles import reserve_tempfile
-from processing.common import run_command, NonBugError
+from processing.ffmpeg.conversion import videotogif, mediatopng, gifencodeargs, palette
+from processing.ffmpeg.ffprobe import mediatype, get_duration, hasaudio, get_resolution, get_frame_rate, probe
+from utils.tempfiles import reserve_tempfile, temp_file_name
+from processing.common import run_command, run_piped, NonBugError
 import processing.vips as vips
 
+# videos are only split for perframe() into segments at least this many seconds long. None to never split them.
+min_segment_duration = config.min_segment_duration if hasattr(config, "min_segment_duration") else 5
+
 
 async def forceaudio(video):
     """
@@ -27,16 +33,20 @@ async def forceaudio(video):
         return outname
 
 
-def gif_output(f):
+def gif_output(f=None, samecolors=False):
     """
     if the input is a gif, make the output a gif
+    :param samecolors: f doesn't add colors that weren't in the input, so the input's palette can be reused
     """
+    if f is None:
+        return functools.partial(gif_output, samecolors=samecolors)
 
+    @functools.wraps(f)
     async def wrapper(media, *args, **kwargs):
         mt = await mediatype(media)
         out = await f(media, *args, **kwargs)
         if mt == "GIF":
-            out = await videotogif(out)
+            out = await videotogif(out, media if samecolors else None)
         return out
 
     return wrapper
@@ -47,6 +57,7 @@ def dual_gif_output(f):
     if there are two gifs, make the output a gif if its a good idea
     """
 
+    @functools.wraps(f)
     async def wrapper(media1, media2, *args, **kwargs):
         mt1 = await mediatype(media1)
         mt2 = await mediatype(media2)
@@ -84,48 +95,114 @@ async def naive_vstack(file0, file1):
         # return await processing.vips.vstack(file0, file1)
 
 
-async def ensuresize(ctx, file, minsize, maxsize):
+def ffinput(media: str | bytes):
     """
-    Ensures valid media is between minsize and maxsize in resolution
-    :param ctx: discord context
-    :param file: media
+    ffmpeg args to read media that is either a file or an in-memory png from vips' write_to_buffer()
+    :param media: filename or png data
+    :return: input args, and data to send to stdin if any
+    """
+    if isinstance(media, bytes):
+        return ["-f", "png_pipe", "-i", "pipe:0"], media
+    return ["-i", media], None
+
+
+class FilterPlan:
+    """
+    lazily collects filters and output options for a file, so several normalization steps cost one
+    decode/encode pass instead of one each
+    """
+
+    def __init__(self, media):
+        self.media = media
+        self.vfilters: list[str] = []
+        self.outputargs: list[str] = []
+        self.reencode_audio = False
+        self.fps_cap = None
+        # scaling interpolates colors that weren't in the input
+        self.samecolors = True
+
+    def __bool__(self):
+        return bool(self.vfilters or self.outputargs)
+
+    def fps(self, fps):
+        # fps goes first so there are less frames to scale
+        self.vfilters.insert(0, f"fps=fps={fps}")
+        self.fps_cap = fps
+
+    def scale(self, width, height):
+        self.vfilters.append(f"scale='{width}:{height}',setsar=1:1")
+        self.outputargs += ["-pix_fmt", "rgba"]
+        self.samecolors = False
+
+    def trim(self, length):
+        self.outputargs += ["-t", str(length)]
+        # audio can't be cut precisely while being copied
+        self.reencode_audio = True
+
+    async def run(self):
+        """
+        runs everything in the plan as one ffmpeg command
+        :return: processed media, or the original media if there was nothing to do
+        """
+        if not self:
+            return self.media
+        mt = await mediatype(self.media)
+        vf = ["-vf", ",".join(self.vfilters)] if self.vfilters else []
+        args = ["ffmpeg", "-hide_banner", "-i", self.media, "-max_muxing_queue_size", "9999", "-sws_flags",
+                "spline+accurate_rnd+full_chroma_int+full_chroma_inp+bitexact", *vf, *self.outputargs]
+        if mt == "GIF" and processing.common.streaming:
+            # stream raw frames straight into the gif encoder instead of through an intermediate file
+            fps = self.fps_cap or await get_frame_rate(self.media)
+            out = reserve_tempfile("gif")
+            if self.samecolors:
+                pal = await palette(self.media, source=True)
+                encode = ["-i", pal, *gifencodeargs(fps, palette=True)]
+            else:
+                # the frames don't exist yet to sample a palette from, so make one from all of them as they go by
+                encode = gifencodeargs(fps)
+            await run_piped([*args, "-an", "-c:v", "rawvideo", "-pix_fmt", "rgba", "-f", "nut", "pipe:1"],
+                            ["ffmpeg", "-hide_banner", "-f", "nut", "-i", "pipe:0", *encode, out])
+            return out
+        out = reserve_tempfile("mkv")
+        await run_command(*args, "-c:v", "ffv1", "-c:a", "flac" if self.reencode_audio else "copy", "-fps_mode", "vfr",
+                          out)
+        # same as gif_output
+        if mt == "GIF":
+            out = await videotogif(out, self.media if self.samecolors else None)
+        return out
+
+
+async def plansize(plan: FilterPlan, minsize, maxsize, exempt=False):
+    """
+    adds a resize to plan if its media is outside minsize and maxsize in resolution
+    :param plan: FilterPlan of the media
     :param minsize: minimum width/height in pixels
     :param maxsize: maximum height in pixels
-    :return: original or resized media
-    """
-    resized = False
-    if await mediatype(file) not in ["IMAGE", "VIDEO", "GIF"]:
-        return file
-    w, h = await get_resolution(file)
-    owidth = w
-    oheight = h
+    :param exempt: skip downsizing
+    :return: ((old width, old height), (new width, new height)) if resized, otherwise None
+    """
+    if await mediatype(plan.media) not in ["IMAGE", "VIDEO", "GIF"]:
+        return None
+    owidth, oheight = await get_resolution(plan.media)
+    w, h = owidth, oheight
+    # same steps as resizing one side at a time, but only the final size is encoded.
+    # the other side is capped at maxsize * 2 when upscaling, otherwise someone puts in like a 1x1000 image and it gets
+    # resized to 200x200000 which is very large. it won't preserve aspect ratio but it's an edge case anyways. this
+    # applies to the owner too.
     if w < minsize:
-        # the min(-1,maxsize) thing is to prevent a case where someone puts in like a 1x1000 image and it gets resized
-        # to 200x200000 which is very large so even though it wont preserve aspect ratio it's an edge case anyways
-
-        file = await resize(file, minsize, f"min(-1, {maxsize * 2})")
-        w, h = await get_resolution(file)
-        resized = True
+        w, h = minsize, min(h * minsize / w, maxsize * 2)
     if h < minsize:
-        file = await resize(file, f"min(-1, {maxsize * 2})", minsize)
-        w, h = await get_resolution(file)
-        resized = True
-    if await ctx.bot.is_owner(ctx.author):
-        logger.debug(f"bot owner is exempt from downsize checks")
-        return file
-    if w > maxsize:
-        file = await resize(file, maxsize, "-1")
-        w, h = await get_resolution(file)
-        resized = True
-    if h > maxsize:
-        file = await resize(file, "-1", maxsize)
-        w, h = await get_resolution(file)
-        resized = True
-    if resized:
-        logger.info(f"Resized from {owidth}x{oheight} to {w}x{h}")
-        await ctx.reply(f"Resized input media from {int(owidth)}x{int(oheight)} to {int(w)}x{int(h)}.", delete_after=5,
-                        mention_author=False)
-    return file
+        w, h = min(w * minsize / h, maxsize * 2), minsize
+    if not exempt:
+        if w > maxsize:
+            w, h = maxsize, h * maxsize / w
+        if h > maxsize:
+            w, h = w * maxsize / h, maxsize
+    w, h = max(round(w), 1), max(round(h), 1)
+    if (w, h) == (owidth, oheight):
+        return None
+    plan.scale(w, h)
+    return (owidth, oheight), (w, h)
 
 
 def nthroot(num: float, n: float):
@@ -148,14 +225,14 @@ def expanded_atempo(arg: float):
         return ",".join([atempo for _ in range(numofatempos)])
 
 
-@gif_output
+@gif_output(samecolors=True)
 async def crop(file, w, h, x, y):
     outname = reserve_tempfile("mkv")
     await run_command('ffmpeg', '-i', file, '-filter:v', f'crop={w}:{h}:{x}:{y}', "-c:v", "ffv1", outname)
     return outname
 
 
-@gif_output
+@gif_output(samecolors=True)
 async def trim_top(file, trim_size):
     outname = reserve_tempfile("mkv")
     await run_command('ffmpeg', '-i', file, '-filter:v', f'crop=out_h=ih-{trim_size}:y={trim_size}', "-c:v", "ffv1",
@@ -220,7 +297,7 @@ async def scale2ref(video, reference):
     return await resize(video, w, h)
 
 
-@gif_output
+@gif_output(samecolors=True)
 async def changefps(file, fps):
     """
     changes FPS of media
@@ -234,7 +311,7 @@ async def changefps(file, fps):
     return outname
 
 
-@gif_output
+@gif_output(samecolors=True)
 async def trim(file, length, start=0):
     """
     trims media to length seconds
@@ -268,3 +345,80 @@ async def resize(image, width, height):
                       "-vf", f"scale='{width}:{height}',setsar=1:1", "-c:v", "ffv1", "-pix_fmt", "rgba", "-c:a",
                       "copy", "-fps_mode", "vfr", out)
     return out
+
+
+async def segmentcount(media) -> int:
+    """
+    :return: how many segments perframe() should split media into, one for this job plus one per idle core
+    """
+    if min_segment_duration is None or await mediatype(media) != "VIDEO":
+        return 1
+    # the rotation is metadata that might not survive copying the video into segments, and then only split videos
+    # would be filtered sideways
+    if (await probe(media)).rotation % 360:
+        return 1
+    return max(1, min(1 + core.queue.idle_cores(), int(await get_duration(media) // min_segment_duration)))
+
+
+async def split(video, n):
+    """
+    splits the video stream of a video into n segments of about the same length without reencoding it. cuts can only
+    be made on keyframes, so videos with few of them can end up with less or uneven segments.
+    :param video: file
+    :param n: number of segments
+    :return: the segments, in order
+    """
+    duration = await get_duration(video)
+    prefix = temp_file_name()
+    try:
+        await run_command("ffmpeg", "-hide_banner", "-i", video, "-map", "0:v:0", "-c", "copy", "-f", "segment",
+                          "-segment_times", ",".join(str(duration * i / n) for i in range(1, n)),
+                          "-reset_timestamps", "1", f"{prefix}-%03d.mkv")
+    finally:
+        segments = sorted(glob.glob(f"{prefix}-*.mkv"))
+        for segment in segments:
+            reserve_tempfile(segment)
+    return segments
+
+
+async def perframe(media, vf, limitclass=None):
+    """
+    runs a filter that treats every frame on its own, without looking at the frames around it. long videos are split
+    into segments that are filtered at the same time on idle cores and losslessly joined back together.
+    :param media: file
+    :param vf: ffmpeg video filter
+    :param limitclass: limit class of the ffmpeg commands, see processing.common.limits()
+    :return: processed media
+    """
+    out = reserve_tempfile("mkv")
+    n = await segmentcount(media)
+    segments = await split(media, n) if n > 1 else []
+    if len(segments) <= 1:
+        await run_command("ffmpeg", "-hide_banner", "-i", media, "-vf", vf, "-c:v", "ffv1", "-c:a", "copy",
+                          "-fps_mode", "vfr", out, limitclass=limitclass)
+        return out
+    logger.debug(f"filtering {media} in {len(segments)} segments")
+    filtered = [reserve_tempfile("mkv") for _ in segments]
+    # the segments run at the same time, so they split the job's share of the cpu evenly
+    allotments = processing.common.allot(len(segments))
+    tasks = [asyncio.create_task(run_command("ffmpeg", "-hide_banner", "-i", segment, "-vf", vf, "-c:v", "ffv1",
+                                             "-fps_mode", "vfr", outsegment, limitclass=limitclass,
+                                             allotment=allotment))
+             for segment, outsegment, allotment in zip(segments, filtered, allotments)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # if one fails, don't leave the rest running
+        for task in tasks:
+            task.cancel()
+        # commands cancelled before they started never released theirs
+        for allotment in allotments:
+            if allotment is not None:
+                processing.common.budget.release(allotment)
+    concatdemuxer = reserve_tempfile("txt")
+    with open(concatdemuxer, "w+") as f:
+        f.write("".join(f"file '{segment}'\n" for segment in filtered))
+    # the audio was never split, take it straight from the original
+    await run_command("ffmpeg", "-hide_banner", "-safe", "0", "-f", "concat", "-i", concatdemuxer, "-i", media,
+                      "-map", "0:v", "-map", "1:a?", "-c", "copy", out)
+    return out
@@ -8,14 +8,15 @@ import typing
 import processing.common
 from processing.ffmpeg.conversion import mediatopng
 import processing.vips as vips
-from processing.ffmpeg.ffprobe import mediatype, get_duration, get_frame_rate, count_frames, get_resolution, hasaudio
+from processing.ffmpeg.ffprobe import mediatype, get_duration, get_frame_rate, count_frames, get_resolution, hasaudio, \
+    get_sample_rate
 from processing.ffmpeg.ffutils import gif_output, expanded_atempo, forceaudio, dual_gif_output, scale2ref, changefps, \
-    resize
+    resize, perframe
 from utils.tempfiles import reserve_tempfile
 from processing.common import run_command, NonBugError
 
 
-@gif_output
+@gif_output(samecolors=True)
 async def speed(file, sp):
     """
     changes speed of media
@@ -45,7 +46,9 @@ async def speed(file, sp):
     return outname
 
 
-@gif_output
+# holds every frame in memory
+@processing.common.costly(2)
+@gif_output(samecolors=True)
 async def reverse(file):
     """
     reverses media (-1x speed)
@@ -58,17 +61,19 @@ async def reverse(file):
     return outname
 
 
-@gif_output
-async def random(file, frames: int):
+@processing.common.nondeterministic
+@gif_output(samecolors=True)
+async def random(file, frames: int, seed: typing.Optional[int] = None):
     """
     shuffle frames
     :param file: media
     :param frames: number of frames in internal cache
+    :param seed: seed for the shuffle, random if None
     :return: procesed media
     """
     outname = reserve_tempfile("mkv")
-    #
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-filter:v", f"random=frames={frames}",
+    seedarg = f":seed={seed}" if seed is not None else ""
+    await run_command("ffmpeg", "-hide_banner", "-i", file, "-filter:v", f"random=frames={frames}{seedarg}",
                       "-c:v", "ffv1", "-fps_mode", "vfr", outname)
     return outname
 
@@ -97,10 +102,7 @@ async def invert(file):
     :param file: media
     :return: processed media
     """
-    outname = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-vf", f"negate", "-c:v", "ffv1", "-fps_mode", "vfr",
-                      outname)
-    return outname
+    return await perframe(file, "negate")
 
 
 @gif_output
@@ -325,7 +327,7 @@ async def overlay(file0, file1, alpha: float, mode: str = 'overlay'):
     return outname
 
 
-@gif_output
+@gif_output(samecolors=True)
 async def rotate(file, rottype):
     types = {  # command input to ffmpeg vf
         "90": "transpose=1",
@@ -367,9 +369,7 @@ async def vibrato(file, frequency=5, depth=0.5):  # https://ffmpeg.org/ffmpeg-fi
 async def pitch(file, p=12):
     out = reserve_tempfile("mkv")
     # https://stackoverflow.com/a/71898956/9044183
-    samplerate = await run_command("ffprobe", "-v", "error", "-select_streams", "a", "-of",
-                                   "default=noprint_wrappers=1:nokey=1", "-show_entries", "stream=sample_rate", file)
-    samplerate = int(samplerate)
+    samplerate = await get_sample_rate(file)
     # http://www.geekybob.com/post/Adjusting-Pitch-for-MP3-Files-with-FFmpeg
     asetrate = max(int(samplerate * 2 ** (p / 12)), 1)
     atempo = 2 ** (-p / 12)
@@ -383,39 +383,33 @@ async def pitch(file, p=12):
 
 @gif_output
 async def hue(file, h: float):
-    out = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-i", file, "-vf", f"hue=h={h},format=rgba", "-c:v", "ffv1", "-fps_mode", "vfr",
-                      out)
-    return out
+    return await perframe(file, f"hue=h={h},format=rgba")
 
 
 @gif_output
 async def tint(file, col: discord.Color):
-    out = reserve_tempfile("mkv")
     # https://stackoverflow.com/a/3380739/9044183
     r, g, b = map(lambda x: x / 255, col.to_rgb())
-    await run_command("ffmpeg", "-i", file, "-vf",
-                      f"hue=s=0,"  # make grayscale
-                      f"lutrgb=r=val*{r}:g=val*{g}:b=val*{b}:a=val,"  # basically set white to our color 
-                      f"format=rgba", "-c:v", "ffv1", "-fps_mode", "vfr", out)
-    return out
+    return await perframe(file,
+                          f"hue=s=0,"  # make grayscale
+                          f"lutrgb=r=val*{r}:g=val*{g}:b=val*{b}:a=val,"  # basically set white to our color 
+                          f"format=rgba")
 
 
+# geq evaluates an expression per pixel
+@processing.common.costly(3)
 @gif_output
 async def round_corners(media, border_radius=10):
-    outfile = reserve_tempfile("mkv")
     # https://stackoverflow.com/a/62400465/9044183
-    await run_command("ffmpeg", "-i", media, "-filter_complex",
-                      f"format=rgba,"
-                      f"geq=lum='p(X,Y)':a='"
-                      f"if(gt(abs(W/2-X),W/2-{border_radius})*gt(abs(H/2-Y),"
-                      f"H/2-{border_radius}),"
-                      f"if(lte(hypot({border_radius}-(W/2-abs(W/2-X)),"
-                      f"{border_radius}-(H/2-abs(H/2-Y))),"
-                      f"{border_radius}),255,0),255)'",
-                      "-c:v", "ffv1", "-c:a", "copy", "-fps_mode", "vfr",
-                      outfile)
-    return outfile
+    return await perframe(media,
+                          f"format=rgba,"
+                          f"geq=lum='p(X,Y)':a='"
+                          f"if(gt(abs(W/2-X),W/2-{border_radius})*gt(abs(H/2-Y),"
+                          f"H/2-{border_radius}),"
+                          f"if(lte(hypot({border_radius}-(W/2-abs(W/2-X)),"
+                          f"{border_radius}-(H/2-abs(H/2-Y))),"
+                          f"{border_radius}),255,0),255)'",
+                          limitclass="ffmpeg-geq")
 
 
 @gif_output
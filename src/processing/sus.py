@@ -4,6 +4,7 @@ import string
 
 from PIL import Image, ImageDraw, ImageFont
 
+from processing.common import nondeterministic
 from utils.tempfiles import reserve_tempfile
 
 # the y coordinate for where the text and the face split
@@ -51,12 +52,15 @@ def get_text_dimensions(text_string, font):
 
 
 # get input string
-def sus(input_string: str):
+@nondeterministic
+def sus(input_string: str, seed=None):
     """
     Cuts and slices the popular Jerma sus meme to any message
     :param input_string: text to make the message with
+    :param seed: seed for picking slices of letters not in the original meme, random if None
     :return: filename of generated image
     """
+    rng = random.Random(seed)
     master_im = Image.open("rendering/images/imposter.jpg")
 
     input_string = input_string.lower().replace(":flushed:", "😳")
@@ -110,7 +114,7 @@ def sus(input_string: str):
                 scan_line_x_coords = cheatletters[char]
             else:
                 w = get_text_dimensions(char, font)[0] + 4
-                random_x = random.randint(0, master_im.width - 13)
+                random_x = rng.randint(0, master_im.width - 13)
                 scan_line_x_coords = [random_x, random_x + w]
                 cheatletters[char] = scan_line_x_coords
 
@@ -5,7 +5,7 @@ import pyvips
 
 from processing.vips.vipsutils import ImageSize, escape, outline, overlay_in_middle
 from utils.tempfiles import reserve_tempfile
-from processing.vips.vipsutils import normalize
+from processing.vips.vipsutils import normalize, save
 
 twemoji = "rendering/fonts/TwemojiCOLR0.otf"
 
@@ -68,7 +68,7 @@ def mediaforge_caption(captions: typing.Sequence[str], size: ImageSize):
     return outfile
 
 
-def motivate_text(captions: typing.Sequence[str], size: ImageSize):
+def motivate_text(captions: typing.Sequence[str], size: ImageSize, tobuffer=False):
     captions = escape(captions)
     textsize = size.width / 5
     width = math.floor(size.width + (size.width / 60))
@@ -120,9 +120,7 @@ def motivate_text(captions: typing.Sequence[str], size: ImageSize):
     # pad text to target width
     out = out.gravity(pyvips.CompassDirection.CENTRE, width, out.height, extend=pyvips.Extend.BACKGROUND,
                       background=[0, 0, 0, 255])
-    outfile = reserve_tempfile("png")
-    out.pngsave(outfile)
-    return outfile
+    return save(out, tobuffer)
 
 
 def meme(captions: typing.Sequence[str], size: ImageSize):
@@ -309,7 +307,7 @@ def generic_image_caption(image: str, captions: typing.Sequence[str], size: Imag
     return outfile
 
 
-def twitter_text(captions: typing.Sequence[str], size: ImageSize, dark: bool):
+def twitter_text(captions: typing.Sequence[str], size: ImageSize, dark: bool, tobuffer=False):
     captions = escape(captions)
     fontsize = size.width / 20
     # technically redundant but adds twemoji font
@@ -332,7 +330,4 @@ def twitter_text(captions: typing.Sequence[str], size: ImageSize, dark: bool):
                       extend=pyvips.Extend.BLACK)
 
     # save and return
-    # because it's run in executor, tempfiles
-    outfile = reserve_tempfile("png")
-    out.pngsave(outfile)
-    return outfile
+    return save(out, tobuffer)
@@ -5,7 +5,7 @@ import pyvips
 
 
 import processing.ffmpeg.ffprobe
-from processing.common import run_parallel, NonBugError
+from processing.common import run_parallel, NonBugError, nondeterministic
 from utils.tempfiles import reserve_tempfile
 import processing.vips.vipsutils
 from processing.vips.vipsutils import normalize
@@ -28,7 +28,10 @@ async def uncaption(file, frame_to_try: int, tolerance: float):
     return await processing.ffmpeg.ffutils.trim_top(file, cap_height)
 
 
-def jpeg(file, strength, stretch, quality):
+# only stretching is random
+@nondeterministic(when=lambda strength, stretch, quality, seed=None: stretch > 0)
+def jpeg(file, strength, stretch, quality, seed=None):
+    rng = random.Random(seed)
     im = normalize(pyvips.Image.new_from_file(file))
     orig_w = im.width
     orig_h = im.height
@@ -36,8 +39,8 @@ def jpeg(file, strength, stretch, quality):
     for i in range(strength - 1 if stretch > 0 else strength):
         if stretch > 0:
             # resize to anywhere between (original image width ± stretch, original image height ± stretch)
-            w_add = random.randint(-stretch, stretch)
-            h_add = random.randint(-stretch, stretch)
+            w_add = rng.randint(-stretch, stretch)
+            h_add = rng.randint(-stretch, stretch)
             im = processing.vips.vipsutils.resize(im, orig_w + w_add, orig_h + h_add)
         # save to jpeg and read back to image
         im = pyvips.Image.new_from_buffer(im.write_to_buffer(".jpg", Q=quality), ".jpg")
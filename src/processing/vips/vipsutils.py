@@ -1,11 +1,15 @@
 import dataclasses
+import glob
 import html
+import math
+import os
 import typing
 
+import humanize
 import pyvips
 
 import processing.ffmpeg.ffprobe
-from processing.common import run_parallel
+from processing.common import NonBugError, run_parallel
 from utils.tempfiles import reserve_tempfile
 
 
@@ -94,10 +98,68 @@ def stack(file0, file1, style):
     return outfile
 
 
+def warmup():
+    """
+    loads libvips and every font once, so the first caption command doesn't pay for fontconfig scanning them
+    """
+    for fontfile in sorted(glob.glob("rendering/fonts/*")):
+        if os.path.splitext(fontfile)[1].lower() in [".ttf", ".otf"]:
+            pyvips.Image.text(".", fontfile=fontfile).avg()
+
+
 def resize(img: pyvips.Image, width: int, height: int) -> pyvips.Image:
     return img.resize(width / img.width, vscale=height / img.height)
 
 
+def save(img: pyvips.Image, tobuffer=False) -> str | bytes:
+    """
+    saves an image as a png
+    :param img: image
+    :param tobuffer: return the png data in memory instead of writing a tempfile
+    :return: filename or png data
+    """
+    if tobuffer:
+        return img.write_to_buffer(".png")
+    outfile = reserve_tempfile("png")
+    img.pngsave(outfile)
+    return outfile
+
+
+def fitpng(file: str, maxsize: int) -> str:
+    """
+    makes a still image fit in maxsize bytes while losing as little as possible: first by compressing it harder, then
+    by quantizing it to a palette, and only then by shrinking it. every try is encoded in memory.
+    :param file: image
+    :param maxsize: max size in bytes
+    :return: png under maxsize
+    """
+    img = pyvips.Image.new_from_file(file).copy_memory()
+    options = {"compression": 9}
+    data = img.pngsave_buffer(**options)
+    if len(data) >= maxsize:
+        try:
+            # uses libimagequant, if libvips was built with it
+            quantized = {**options, "palette": True, "Q": 90, "dither": 1.0}
+            data = img.pngsave_buffer(**quantized)
+            options = quantized
+        except pyvips.Error:
+            pass
+    scale = 1.0
+    for _ in range(5):
+        if len(data) < maxsize:
+            outfile = reserve_tempfile("png")
+            with open(outfile, "wb") as f:
+                f.write(data)
+            return outfile
+        # size goes roughly with the number of pixels
+        scale *= math.sqrt(maxsize / len(data)) * .95
+        width, height = round(img.width * scale), round(img.height * scale)
+        if width < 1 or height < 1:
+            break
+        data = resize(img, width, height).pngsave_buffer(**options)
+    raise NonBugError(f"Unable to fit {file} within {humanize.naturalsize(maxsize)}")
+
+
 def normalize(img: pyvips.Image) -> pyvips.Image:
     # mono -> rgb
     if img.bands < 3:
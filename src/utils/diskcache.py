@@ -0,0 +1,131 @@
+import asyncio
+import collections
+import hashlib
+import os
+import shutil
+import typing
+
+import humanize
+
+from core.clogs import logger
+
+
+def hash_file(file):
+    h = hashlib.sha256()
+    with open(file, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class DiskCache:
+    """
+    a size-bounded LRU cache of files on disk, keyed by arbitrary strings.
+    the index lives in memory and is rebuilt from the directory on startup, so entries survive restarts.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        # key -> (path, size), least recently used first
+        self.entries: collections.OrderedDict[str, tuple[str, int]] = collections.OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+        # oldest access first so the least recently used files are evicted first
+        files = []
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith(".part"):
+                # left over from an interrupted put()
+                os.remove(path)
+            elif os.path.isfile(path):
+                st = os.stat(path)
+                files.append((st.st_atime, name, path, st.st_size))
+        for _, name, path, size in sorted(files):
+            self.entries[os.path.splitext(name)[0]] = (path, size)
+            self.size += size
+        logger.debug(f"loaded {len(self.entries)} cached files ({humanize.naturalsize(self.size)}) from {directory}")
+        self.evict()
+
+    def evict(self, limit: typing.Optional[int] = None):
+        """
+        removes the least recently used files until the cache fits
+        :param limit: bytes to shrink it to, max_bytes by default
+        """
+        limit = self.max_bytes if limit is None else limit
+        while self.size > limit and self.entries:
+            key, (path, size) = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            logger.debug(f"evicted {path} from cache")
+
+    async def get(self, key: str, dest: str) -> bool:
+        """
+        hardlinks a cached file out of the cache, or copies it if it's on another filesystem. the result must not be
+        modified in place.
+        :param key: cache key
+        :param dest: where to put the file
+        :return: True if the file was in the cache
+        """
+        if key not in self.entries:
+            self.misses += 1
+            return False
+        path, _ = self.entries[key]
+        self.entries.move_to_end(key)
+        try:
+            try:
+                # a copy would keep the file in the temp dir twice
+                os.link(path, dest)
+            except FileNotFoundError:
+                raise
+            except OSError:
+                await asyncio.to_thread(shutil.copyfile, path, dest)
+        except FileNotFoundError:
+            # evicted or deleted while we were copying
+            self.entries.pop(key, None)
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def extension(self, key: str):
+        """
+        :return: the file extension of a cached file, or None if it isn't cached or has none
+        """
+        if key not in self.entries:
+            return None
+        return os.path.splitext(self.entries[key][0])[1][1:] or None
+
+    async def put(self, key: str, src: str, move=False) -> bool:
+        """
+        copies a file into the cache
+        :param key: cache key, must be safe to use as a filename
+        :param src: file to store
+        :param move: move src into the cache instead of copying it
+        :return: False if it's too big to cache, in which case src is left alone
+        """
+        size = os.path.getsize(src)
+        if size > self.max_bytes:
+            return False
+        path = os.path.join(self.directory, key + os.path.splitext(src)[1])
+        # copy to a temporary name first so a half-written file is never served
+        await asyncio.to_thread(shutil.move if move else shutil.copyfile, src, path + ".part")
+        os.replace(path + ".part", path)
+        if key in self.entries:
+            oldpath, oldsize = self.entries.pop(key)
+            self.size -= oldsize
+            if oldpath != path:
+                os.remove(oldpath)
+        self.entries[key] = (path, size)
+        self.size += size
+        self.evict()
+        return True
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
@@ -6,20 +6,42 @@ import random
 import shutil
 import string
 import tempfile
+import time
+import typing
 
 import aiofiles.os
+import humanize
+import psutil
 
 import config
 from core.clogs import logger
 
+# bytes the files of every running TempFileSession can add up to before the queue stops starting new commands
+temp_budget = config.temp_budget if hasattr(config, "temp_budget") else None
+# when temp_dir is in memory and there's less than this many bytes of free memory, new temp files go on disk instead
+spill_below = config.temp_spill_below if hasattr(config, "temp_spill_below") else 1_000_000_000
+# temp files nothing has reserved for this many seconds are removed by the janitor
+orphan_age = config.temp_orphan_age if hasattr(config, "temp_orphan_age") else 3600
+# seconds between janitor runs
+janitor_interval = 300
+
 
 def init():
     global temp_dir
-    if os.path.isdir(temp_dir):
-        shutil.rmtree(temp_dir)
+    for directory in dirs():
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
     os.makedirs(temp_dir)
 
 
+def cleanup():
+    """
+    removes the temp dir and the disk one it spills into
+    """
+    for directory in dirs():
+        shutil.rmtree(directory, ignore_errors=True)
+
+
 if config.override_temp_dir is not None:
     temp_dir = config.override_temp_dir
 else:
@@ -31,6 +53,37 @@ else:
 logger.debug(f"temp dir is {temp_dir}")
 
 
+def spill_dir() -> str:
+    """
+    :return: where temp files go while there's not enough memory for them in temp_dir
+    """
+    return os.path.join(tempfile.gettempdir(), os.path.basename(temp_dir))
+
+
+def inmemory() -> bool:
+    return os.path.realpath(temp_dir).startswith("/dev/shm")
+
+
+def dirs() -> list[str]:
+    """
+    :return: the temp dir, and the one it spills into if it can spill
+    """
+    # a temp dir on disk never spills, and its spill dir could be anything
+    return [temp_dir, spill_dir()] if inmemory() else [temp_dir]
+
+
+def shouldspill() -> bool:
+    if not inmemory() or not spill_below:
+        return False
+    if psutil.virtual_memory().available < spill_below:
+        return True
+    # /dev/shm has its own size limit
+    try:
+        return shutil.disk_usage(temp_dir).free < spill_below
+    except OSError:
+        return False
+
+
 def get_random_string(length):
     return ''.join(random.choice(string.ascii_letters) for _ in range(length))
 
@@ -40,8 +93,16 @@ def is_named_used(name):
 
 
 def temp_file_name(extension=None):
+    directory = temp_dir
+    if shouldspill():
+        directory = spill_dir()
+        os.makedirs(directory, exist_ok=True)
+        logger.debug("low on memory, putting temp file on disk")
+        # cached files in memory can just be fetched again
+        for cache in caches:
+            cache.evict(0)
     while True:
-        name = os.path.join(temp_dir, get_random_string(8))
+        name = os.path.join(directory, get_random_string(8))
         if extension:
             name += f".{extension}"
         if not is_named_used(name):
@@ -62,6 +123,132 @@ def reserve_tempfile(arg):
     return arg
 
 
+class Session(list[str]):
+    """
+    the files of a TempFileSession, and the sizes of the ones that are done being written. a file is measured when
+    the next one is reserved, which is when whatever was writing it has usually finished, so usage() never has to
+    stat anything.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # file -> its size when it was measured
+        self.sizes: dict[str, int] = {}
+        # files reserved since the last measure()
+        self.pending: list[str] = []
+        # total of sizes
+        self.bytes = 0
+        # largest bytes has been
+        self.peak = 0
+
+    def measure(self):
+        """records the sizes of the files reserved since the last time"""
+        pending, self.pending = self.pending, []
+        for file in pending:
+            try:
+                size = os.path.getsize(file)
+            except OSError:
+                size = 0
+            self.bytes += size - self.sizes.get(file, 0)
+            self.sizes[file] = size
+        self.peak = max(self.peak, self.bytes)
+
+    def append(self, file: str):
+        self.measure()
+        super().append(file)
+        self.pending.append(file)
+
+    def extend(self, files: typing.Iterable[str]):
+        for file in files:
+            self.append(file)
+
+    def __iadd__(self, files: typing.Iterable[str]):
+        self.extend(files)
+        return self
+
+
+# id -> files of every TempFileSession that's open, and of the run_parallel calls in the thread pool
+sessions: dict[int, Session] = {}
+# utils.diskcache.DiskCaches kept in the temp dir, which count towards the budget too
+caches: list = []
+
+
+def sessionusage() -> int:
+    """
+    :return: bytes the finished files of every open session take up
+    """
+    return sum(s.bytes for s in list(sessions.values()))
+
+
+def usage() -> int:
+    """
+    :return: bytes the finished files of every open session and the caches in the temp dir take up
+    """
+    return sessionusage() + sum(cache.size for cache in caches)
+
+
+def overbudget() -> bool:
+    """
+    :return: if the temp files are over temp_budget. the caches are shrunk to fit first, since they're only there to
+        save downloading things again.
+    """
+    if temp_budget is None:
+        return False
+    room = temp_budget - sessionusage()
+    for cache in caches:
+        if cache.size > room:
+            cache.evict(max(room, 0))
+        room -= cache.size
+    return room <= 0
+
+
+def reclaim(age: typing.Optional[float] = None) -> int:
+    """
+    removes temp files no open session has reserved that haven't been touched in a while, left behind by sessions
+    that crashed or code that never reserved them
+    :param age: seconds since a file was last modified before it's removed, orphan_age by default
+    :return: number of files removed
+    """
+    age = orphan_age if age is None else age
+    reserved = {file for s in list(sessions.values()) for file in s}
+    cutoff = time.time() - age
+    removed = 0
+    for directory in dirs():
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        # only files directly in it, the download cache looks after its own directory
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.path not in reserved and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+            except OSError:
+                pass
+    if removed:
+        logger.info(f"Removed {removed} orphaned temp files.")
+    return removed
+
+
+async def janitor():
+    while True:
+        await asyncio.sleep(janitor_interval)
+        try:
+            await asyncio.to_thread(reclaim)
+        except Exception as e:
+            logger.error(e, exc_info=(type(e), e, e.__traceback__))
+
+
+janitortask: typing.Optional[asyncio.Task] = None
+
+
+def startjanitor():
+    global janitortask
+    if janitortask is None:
+        janitortask = asyncio.create_task(janitor())
+
+
 class TempFileSession:
     def __init__(self):
         pass
@@ -73,11 +260,16 @@ class TempFileSession:
         except LookupError:
             pass
         logger.debug("Created new TempFileSession")
-        session.set([])
+        files = Session()
+        sessions[id(files)] = files
+        session.set(files)
 
     async def __aexit__(self, *_):
-        files = session.get()
-        logger.debug(f"TempFileSession exiting with {len(files)} files: {files}")
+        files: Session = session.get()
+        sessions.pop(id(files), None)
+        files.measure()
+        logger.debug(f"TempFileSession exiting with {len(files)} files, {humanize.naturalsize(files.peak)} at most: "
+                     f"{files}")
         fls = await asyncio.gather(*[aiofiles.os.remove(file) for file in files], return_exceptions=True)
         for f in fls:
             if isinstance(f, Exception):
@@ -85,4 +277,4 @@ class TempFileSession:
         logger.debug(f"TempFileSession exited!")
 
 
-session: contextvars.ContextVar[list[str]] = contextvars.ContextVar("session")
+session: contextvars.ContextVar[Session] = contextvars.ContextVar("session")
@@ -1,3 +1,10 @@
+import asyncio
+import os
+import shutil
+import time
+import typing
+import urllib.parse
+
 import aiofiles
 import aiohttp
 import humanize
@@ -5,29 +12,53 @@ import humanize
 import config
 import processing.common
 import processing.ffmpeg.conversion
+import utils.tempfiles
 
 from core.clogs import logger
+from utils.diskcache import DiskCache, hash_file
 from utils.tempfiles import reserve_tempfile
 
+# downloads stored by content hash
+download_cache: typing.Optional[DiskCache] = None
+# normalized url -> (content hash, time downloaded)
+cached_urls: dict[str, tuple[str, float]] = {}
+# normalized url -> future that resolves to the content hash once the download is done, and where the downloader put it
+# if it was too big to cache
+inflight: dict[str, asyncio.Future] = {}
+download_cache_ttl = config.download_cache_ttl if hasattr(config, "download_cache_ttl") else 600
 
-async def saveurl(url: str) -> str:
+
+def init():
+    global download_cache
+    size = config.download_cache_size if hasattr(config, "download_cache_size") else 250_000_000
+    if size:
+        download_cache = DiskCache(os.path.join(utils.tempfiles.temp_dir, "downloads"), size)
+        # it's in memory with everything else, so it's part of the temp budget and goes first when memory is low
+        utils.tempfiles.caches.append(download_cache)
+    else:
+        logger.debug("download cache disabled")
+
+
+def normalizeurl(url: str) -> str:
     """
-    save a url
+    normalizes a url so different links to the same file share a cache entry
+    """
+    parts = urllib.parse.urlsplit(url)
+    query = urllib.parse.parse_qsl(parts.query, keep_blank_values=True)
+    if parts.hostname in ["cdn.discordapp.com", "media.discordapp.net"]:
+        # attachment links are re-signed every so often but still point to the same file
+        query = [(k, v) for k, v in query if k not in ["ex", "is", "hm"]]
+    return urllib.parse.urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path,
+                                    urllib.parse.urlencode(sorted(query)), ""))
 
-    :param url: web url of a file
-    :return: path to file
+
+async def download(url: str, name: str):
     """
-    tenorgif = url.startswith("https://media.tenor.com") and url.endswith("/mp4")  # tenor >:(
-    extension = None
-    if tenorgif:
-        extension = "mp4"
-    if extension is None:
-        after_slash = url.split("/")[-1].split("?")[0]
-        if "." in after_slash:
-            extension = after_slash.split(".")[-1]
-        # extension will stay None if no extension detected.
-    name = reserve_tempfile(extension)
+    download a url to a file
 
+    :param url: web url of a file
+    :param name: path to save it to
+    """
     # https://github.com/aio-libs/aiohttp/issues/3904#issuecomment-632661245
     async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'},
                                      timeout=aiohttp.ClientTimeout(total=600)) as session:
@@ -49,6 +80,96 @@ async def saveurl(url: str) -> str:
                 logger.error(f"aiohttp status {resp.status}")
                 logger.error(f"aiohttp status {await resp.read()}")
                 resp.raise_for_status()
+
+
+async def cacheddownload(url: str, name: str):
+    """
+    download a url to a file through the download cache. concurrent downloads of the same url share one request.
+
+    :param url: web url of a file
+    :param name: path to save it to
+    """
+    key = normalizeurl(url)
+    if key in cached_urls and time.time() - cached_urls[key][1] < download_cache_ttl:
+        if await download_cache.get(cached_urls[key][0], name):
+            logger.info(f"Using cached download of {url}")
+            return
+    if key in inflight:
+        logger.info(f"Waiting for in-progress download of {url}")
+        future = inflight[key]
+        await asyncio.wait([future])
+        if future.cancelled():
+            # whoever started it gave up, so do it ourselves
+            return await download(url, name)
+        if future.exception():
+            raise future.exception()
+        contenthash, uncached = future.result()
+        if uncached is not None:
+            try:
+                await asyncio.to_thread(shutil.copyfile, uncached, name)
+                return
+            except FileNotFoundError:
+                # its command already finished and deleted it
+                pass
+    else:
+        future = asyncio.get_running_loop().create_future()
+        inflight[key] = future
+        raw = utils.tempfiles.temp_file_name()
+        uncached = None
+        try:
+            await download(url, raw)
+            contenthash = await asyncio.to_thread(hash_file, raw)
+            if not await download_cache.put(contenthash, raw, move=True):
+                # too big for the cache, so it's just ours
+                await asyncio.to_thread(shutil.move, raw, name)
+                uncached = name
+        except Exception as e:
+            future.set_exception(e)
+            # mark as retrieved so asyncio doesn't complain when nobody else was waiting
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            now = time.time()
+            for k in [k for k, (_, t) in cached_urls.items() if now - t >= download_cache_ttl]:
+                del cached_urls[k]
+            cached_urls[key] = (contenthash, now)
+            future.set_result((contenthash, uncached))
+        finally:
+            del inflight[key]
+            if os.path.exists(raw):
+                os.remove(raw)
+        if uncached is not None:
+            return
+    if not await download_cache.get(contenthash, name):
+        # too big for the cache or already evicted
+        await download(url, name)
+
+
+async def saveurl(url: str) -> str:
+    """
+    save a url
+
+    :param url: web url of a file
+    :return: path to file
+    """
+    tenorgif = url.startswith("https://media.tenor.com") and url.endswith("/mp4")  # tenor >:(
+    extension = None
+    if tenorgif:
+        extension = "mp4"
+    if extension is None:
+        after_slash = url.split("/")[-1].split("?")[0]
+        if "." in after_slash:
+            extension = after_slash.split(".")[-1]
+        # extension will stay None if no extension detected.
+    name = reserve_tempfile(extension)
+
+    if download_cache is None:
+        await download(url, name)
+    else:
+        await cacheddownload(url, name)
     if tenorgif and name:
         name = await processing.ffmpeg.conversion.videotogif(name)
     return name
@@ -0,0 +1,32 @@
+"""
+Runs MediaForge commands for a bot in distributed mode, so processing can happen in other processes or on other machines.
+Set job_store in config.py to the same database as the bot's and run this with `poetry run python src/worker.py`.
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.getcwd())
+
+import config
+import core.jobstore
+import processing.common
+import utils.tempfiles
+
+
+def main():
+    if not core.jobstore.enabled:
+        sys.exit("job_store isn't set in config.py, there's nothing to take jobs from.")
+    # don't share (or wipe) the temp dir of a bot or other worker on the same machine
+    utils.tempfiles.temp_dir = f"{utils.tempfiles.temp_dir}-worker{os.getpid()}"
+    utils.tempfiles.init()
+    processing.common.init()
+    jobs = (config.worker_jobs if hasattr(config, "worker_jobs") else None) or os.cpu_count() or 1
+    try:
+        asyncio.run(core.jobstore.runworker(jobs))
+    finally:
+        utils.tempfiles.cleanup()
+
+
+if __name__ == "__main__":
+    main()